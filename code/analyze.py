@@ -1,33 +1,67 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import pandas
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy
-
-import pprint
-import pickle
+import os.path
 
 from config import *
+from columnar import ColumnStore, write_columns, META_FILE
+import metrics
+import masters
+
 
+# Plotting libraries are only imported when the first plot is drawn so that
+# non-plotting jobs (batch counts, worker processes) start fast
+plt = None
+
+
+def pyplot():
+    """Import matplotlib.pyplot on first use and configure plotting style"""
+    global plt
+    if plt is None:
+        import matplotlib
+        import matplotlib.pyplot
+
+        if PLOT_LARGE:
+            matplotlib.rc('xtick', labelsize=14)
+            matplotlib.rc('ytick', labelsize=14)
+            matplotlib.rc('legend', fontsize=14)
+        else:
+            matplotlib.rc('xtick', labelsize=10)
+            matplotlib.rc('ytick', labelsize=10)
+            matplotlib.rc('legend', fontsize=10)
+        plt = matplotlib.pyplot
+    return plt
 
-# configure plotting style
-if PLOT_LARGE:
-    matplotlib.rc('xtick', labelsize=14) 
-    matplotlib.rc('ytick', labelsize=14)
-    matplotlib.rc('legend', fontsize=14) 
-else:
-    matplotlib.rc('xtick', labelsize=10) 
-    matplotlib.rc('ytick', labelsize=10) 
-    matplotlib.rc('legend', fontsize=10) 
 
 def set_style():
-    plt.style.use(['seaborn-white', 'seaborn-paper'])
+    import matplotlib
+    pyplot().style.use(['seaborn-white', 'seaborn-paper'])
     matplotlib.rc("font", family="Times New Roman", size=22)
 
 # Functions for selecting data
 
+def select_rows(data, rows):
+    """Return releases at the specified row positions (e.g., from an index)"""
+    if isinstance(data, ColumnStore):
+        return data.to_dataframe(rows=rows)
+    return data.iloc[rows]
+
+
+def artist_ids(artists):
+    # artists are ids in loaded data, and dicts in the json dump
+    return [a['id'] if isinstance(a, dict) else a for a in artists]
+
+
+ARTIST_NAMES_ERROR = "Loaded data only has artist ids, select artists by name with an ArtistIndex (see artists.py)"
+
+
+def artist_names(artists):
+    if artists and not isinstance(artists[0], dict):
+        raise ValueError(ARTIST_NAMES_ERROR)
+    return [a['name'] for a in artists]
+
+
 def select_genre(data, genre):
     """Return all releases annotated with the specified genre"""
     return data[data['genres'].apply(lambda x: genre in x)]
@@ -48,19 +82,39 @@ def select_only_style(data, style):
     return data[data['styles'].apply(lambda x: len(x) == 1 and style in x)]
 
 
-def select_label(data, label):
-    """Return all releases from the specified label"""
+def select_label(data, label, index=None):
+    """
+    Return all releases from the specified label
+    - index: LabelIndex (see labels.py) to look up releases without a full scan
+    """
+    if index is not None:
+        return select_rows(data, index.rows(label))
+    if isinstance(data, ColumnStore):
+        return select_rows(data, data.contains('labels', label))
     return data[data['labels'].apply(lambda x: label in x)]
 
 
-def select_artistname(data, artist):
-    """Return all releases by the specified artist"""
-    return data[data['artists'].apply(lambda x: artist in [a['name'] for a in x])]
+def select_artistname(data, artist, index=None):
+    """
+    Return all releases by the specified artist
+    - index: ArtistIndex with artist names (see artists.py), required for
+      loaded data that only keeps artist ids
+    """
+    if index is not None:
+        return select_rows(data, index.rows_by_name(artist))
+    if isinstance(data, ColumnStore):
+        raise ValueError(ARTIST_NAMES_ERROR)
+    return data[data['artists'].apply(lambda x: artist in artist_names(x))]
 
 
-def select_artistid(data, artistid):
-    """Return all releases by the specified artistid"""
-    return data[data['artists'].apply(lambda x: artistid in [a['id'] for a in x])]
+def select_artistid(data, artistid, index=None):
+    """
+    Return all releases by the specified artistid
+    - index: ArtistIndex (see artists.py) to look up releases without a full scan
+    """
+    if index is not None:
+        return select_rows(data, index.rows(artistid))
+    return data[data['artists'].apply(lambda x: artistid in artist_ids(x))]
 
 
 def select_masterid(data, masterid):
@@ -141,13 +195,32 @@ def select(data, genre=None, style=None, format=None, year=None, country=None, t
     return selected
 
 
+def search_titles(data, index, query, mode='phrase', field=None,
+                  genre=None, style=None, format=None, year=None, country=None):
+    """
+    Return releases with release or track titles matching a query, optionally
+    filtered as in select
+    - index: TitleIndex (see titles.py) aligned with data
+    - mode: "term", "phrase" or "prefix" query
+    - field: only search "release" or "track" titles
+    """
+    selected = select_rows(data, index.search(query, mode, field))
+    return select(selected, genre=genre, style=style, format=format, year=year, country=country)
+
+
 # Functions for unique artists analysis (TODO)
 # Each unique artist is associated with a list of ids for all artist items in
 # which he/she participated (TODO: get this data from the artist dump)
 
-def select_artistids(data, artistids):
-    """Return all releases matching the specified list of artistid"""
-    return data[data['artists'].apply(lambda x: len(set(artistids) & set([a['id'] for a in x])) > 0)]
+def select_artistids(data, artistids, index=None):
+    """
+    Return all releases matching the specified list of artistid
+    - index: ArtistIndex (see artists.py) to look up releases without a full scan
+    """
+    if index is not None:
+        return select_rows(data, index.rows_any(artistids))
+    artistids = set(artistids)
+    return data[data['artists'].apply(lambda x: not artistids.isdisjoint(artist_ids(x)))]
 
 
 # Functions to gather vocabulary of genres/styles/formats/countries in data
@@ -155,6 +228,8 @@ def select_artistids(data, artistids):
 
 def find_genres(data):
     """Find out all genres present in data"""
+    if isinstance(data, ColumnStore):
+        return sorted(data.vocab('genres'))
     genres = set()
     for gg in data['genres']:
         for g in gg:
@@ -164,6 +239,8 @@ def find_genres(data):
 
 def find_styles(data):
     """Find out all styles present in data"""
+    if isinstance(data, ColumnStore):
+        return sorted(data.vocab('styles'))
     styles = set()
     for ss in data['styles']:
         for s in ss:
@@ -173,6 +250,8 @@ def find_styles(data):
 
 def find_formats(data):
     """Find out all formats present in data"""
+    if isinstance(data, ColumnStore):
+        return sorted(data.vocab('formats'))
     formats = set()
     for ff in data['formats']:
         for f in ff:
@@ -182,7 +261,9 @@ def find_formats(data):
 
 def find_countries(data):
     """Find out all countries present in data"""
-    releases = data[pandas.notnull(data['country'])]
+    if isinstance(data, ColumnStore):
+        return sorted(data.vocab('country'))
+    releases = data[data['country'].notnull()]
     countries = set()
     for c in releases['country']:
         countries.add(c)
@@ -191,6 +272,8 @@ def find_countries(data):
 
 def find_artists(data):
     """Find out all artists present in data"""
+    if isinstance(data, ColumnStore):
+        return set(data.vocab('artists'))
     artists = set()
     for aa in data['artists']:
         for a in aa:
@@ -202,7 +285,7 @@ def find_artists(data):
 
 def select_with_durations(data):
     """Return all releases with tracks annotated by duration"""
-    return data[pandas.notnull(data['tracks_duration_list'])]
+    return data[data['tracks_duration_list'].notnull()]
 
 
 def find_durations(data):
@@ -216,24 +299,36 @@ def find_durations(data):
 # Functions for per-year analysis
 
 
-def releases_per_year(data, start_year, end_year, format=None, genre=None, style=None, country=None):
+def releases_per_year(data, start_year, end_year, format=None, genre=None, style=None, country=None, by_master=False,
+                      samples=None, max_error=None):
     """
     Count the number of releases from 'start_year' to 'end_year'
     from the specified format, genre, style and country
+    - by_master: count master releases (unique works) instead of all their releases
+    - samples: estimate counts from StratifiedSamples (see approximate.py),
+      use samples.releases_per_year to also get confidence bounds
+    - max_error: maximum relative error of estimates (see approximate.py)
     """
+    if samples is not None:
+        check_samples(by_master)
+        estimates = samples.releases_per_year(start_year, end_year, format=format, genre=genre, style=style,
+                                              country=country, max_error=max_error)
+        return list(estimates['years']), list(estimates['estimate'])
+    if by_master:
+        data = masters.by_master(data)
     years = range(start_year, end_year+1)
     number_releases = [len(select(data, year=year, genre=genre, style=style, format=format, country=country)) for year in years]
     return years, number_releases
 
 
-def artists_per_year(data, start_year, end_year, format=None, genre=None, style=None, country=None):
+def artists_per_year(data, start_year, end_year, format=None, genre=None, style=None, country=None, by_master=False):
     """
     Count the number of artists from 'start_year' to 'end_year'
     from the specified format, genre, style and country
+    - by_master: count master releases (unique works) instead of all their releases
     """
-    years = range(start_year, end_year+1)
-    number_releases = [len(select(data, year=year, genre=genre, style=style, format=format, country=country)) for year in years]
-    return years, number_releases
+    if by_master:
+        data = masters.by_master(data)
     years = range(start_year, end_year+1)
     number_artists = []
     for year in years:
@@ -246,11 +341,14 @@ def artists_per_year(data, start_year, end_year, format=None, genre=None, style=
     return years, number_artists
 
 
-def tracks_per_year(data, start_year, end_year, format=None, genre=None, style=None, country=None):
+def tracks_per_year(data, start_year, end_year, format=None, genre=None, style=None, country=None, by_master=False):
     """
     Count the number of tracks from 'start_year' to 'end_year'
     from the specified format, genre, style and country
+    - by_master: count master releases (unique works) instead of all their releases
     """
+    if by_master:
+        data = masters.by_master(data)
     years = range(start_year, end_year+1)
     number_tracks = []
     for year in years:
@@ -264,7 +362,7 @@ def tracks_per_year(data, start_year, end_year, format=None, genre=None, style=N
 
 # Functions for data statistics/coverage
 
-def releases_stats(data):
+def releases_stats(data=None, stats_file=None):
     """
     Compute statistics for a dataset
     - present genres, styles, formats and countries and their total number
@@ -273,7 +371,15 @@ def releases_stats(data):
     - total number of unofficial releases and tracks
     - total number of releases and tracks from compilations
     - total number of mixed releases and tracks
+
+    If 'stats_file' is given (e.g., dump_stats), statistics accumulated when
+    the dump was loaded are returned without scanning data (see datastats.py,
+    the number of artists is then estimated within about 1%).
     """
+    if stats_file is not None:
+        from datastats import StatsAccumulator
+        return StatsAccumulator.load(stats_file).summary()
+
     stats = {}
 
     stats['all_genres'] = find_genres(data)
@@ -310,15 +416,25 @@ def releases_stats(data):
     return stats
 
 
-def releases_coverage(data, data_stats=None):
+def releases_coverage(data, data_stats=None, by_master=False, samples=None, max_error=None):
     """
     Compute coverage for a dataset (percentages of releases, tracks and
     artists) in terms of genres, styles, countries and formats
+    - by_master: compute coverage of master releases (unique works)
+    - samples: estimate coverage in terms of releases and tracks from
+      StratifiedSamples (see approximate.py), with confidence interval
+      half-widths in 'coverage_genres_error', etc.
+    - max_error: maximum relative error of estimates (see approximate.py)
     """
+    import pandas
+    if samples is not None:
+        check_samples(by_master)
+        return samples.releases_coverage(max_error=max_error)
+    if by_master:
+        data = masters.by_master(data)
     if data_stats is None:
         data_stats = releases_stats(data)
 
-    # TODO add coverage in terms of labels
     stats = {
         'coverage_genres': {
              'releases (%)': {},
@@ -368,6 +484,12 @@ def releases_coverage(data, data_stats=None):
         stats['coverage_formats']['tracks (%)'][f] = 100. * releases['tracks_number'].sum() / data_stats['total_tracks']
         stats['coverage_formats']['artists (%)'][f] = 100. * len(find_artists(releases)) / data_stats['total_artists']
 
+    # labels are too many to select one by one, compute their coverage at once
+    if 'labels' in data:
+        from labels import label_coverage
+        data_stats['coverage_labels'] = label_coverage(data, data_stats['total_tracks'],
+                                                       data_stats['total_artists'])
+
     for type_key in ["coverage_genres", "coverage_styles", "coverage_countries", "coverage_formats"]:
 
         stats_tmp = [[v for k, v in stats[type_key]['releases (%)'].items()],
@@ -385,12 +507,13 @@ def releases_coverage(data, data_stats=None):
 
 def show_releases_coverage(coverage_df, type="genre", show_top=15):
     """
-    Visualize coverage for a dataset in terms of genres, styles, countries, and
-    formats given a DataFrame with coverage statistics
+    Visualize coverage for a dataset in terms of genres, styles, countries,
+    formats and labels given a DataFrame with coverage statistics
 
-    - type: genre, style, country, format
+    - type: genre, style, country, format, label
     - show_top: number of top categories to show
     """
+    plt = pyplot()
     if type == "genre":
         title = 'Genre'
     elif type == "style":
@@ -399,6 +522,8 @@ def show_releases_coverage(coverage_df, type="genre", show_top=15):
         title = 'Country'
     elif type == "format":
         title = 'Format'
+    elif type == "label":
+        title = 'Label'
     else:
         print("Wrong 'type' value (expected 'genre' or 'style'): %s" % type)
         return
@@ -420,7 +545,8 @@ def coverage_countries_evolution(data,
                                  countries=['US', 'UK', 'Germany', 'Brazil'],
                                  genre=None, style=None, type='releases',
                                  title=None,
-                                 start_year=START_YEAR, end_year=END_YEAR):
+                                 start_year=START_YEAR, end_year=END_YEAR,
+                                 processes=None, by_master=False):
     """
     Visualize coverage for a dataset in terms countries by year
     - start_year and end_year define the time interval to consider
@@ -429,7 +555,13 @@ def coverage_countries_evolution(data,
     - type='releases': compute coverage in terms of releases
     - type='tracks': compute coverage in terms of tracks
     - title: plot title to show
+    - processes: compute countries in parallel using this number of processes
+    - by_master: count master releases (unique works) instead of all their releases
     """
+    plt = pyplot()
+
+    if by_master:
+        data = masters.by_master(data)
 
     if type == 'releases':
         compute = releases_per_year
@@ -444,7 +576,16 @@ def coverage_countries_evolution(data,
             title = title + " (%s)" % style
 
     stats = {}
+    if processes:
+        from parallel import per_year_counts
+        queries = [dict(genre=genre, style=style, country=c) for c in countries]
+        counts = per_year_counts(data, queries, type, start_year, end_year, processes)
+        stats = dict(zip(countries, counts))
+        stats['years'] = range(start_year, end_year+1)
+
     for c in countries:
+        if c in stats:
+            continue
         years, counts = compute(data, start_year, end_year,
                                 genre=genre, style=style, country=c)
         stats[c] = counts
@@ -465,7 +606,8 @@ def coverage_genres_evolution(data,
                               genres,
                               type='releases',
                               title=None,
-                              start_year=START_YEAR, end_year=END_YEAR):
+                              start_year=START_YEAR, end_year=END_YEAR,
+                              by_master=False):
     """
     Visualize coverage for a dataset in terms countries by year
     - start_year and end_year define the time interval to consider
@@ -474,7 +616,12 @@ def coverage_genres_evolution(data,
     - type='releases': compute coverage in terms of releases
     - type='tracks': compute coverage in terms of tracks
     - title: plot title to show
+    - by_master: count master releases (unique works) instead of all their releases
     """
+    plt = pyplot()
+
+    if by_master:
+        data = masters.by_master(data)
 
     if type == 'releases':
         compute = releases_per_year
@@ -503,6 +650,29 @@ def coverage_genres_evolution(data,
 
 # Functions for track duration analysis
 
+def duration_count(stats):
+    if 'tracks' in stats:
+        return stats['tracks']
+    return len(stats['durations'])
+
+
+def boxplot_stats(stats, genres, labels):
+    """
+    Return boxes for matplotlib's bxp from duration statistics: quartiles and
+    5% / 95% whiskers, computed from 'durations' only when they are missing
+    """
+    boxes = []
+    for g, label in zip(genres, labels):
+        s = stats[g]
+        if 'p25' in s:
+            p5, p25, p50, p75, p95 = s['5%'], s['p25'], s['median'], s['p75'], s['95%']
+        else:
+            p5, p25, p50, p75, p95 = np.percentile(s['durations'], [5, 25, 50, 75, 95])
+        boxes.append({'label': label, 'med': p50, 'q1': p25, 'q3': p75,
+                      'whislo': p5, 'whishi': p95, 'fliers': []})
+    return boxes
+
+
 def plot_track_durations(stats, type, sortby="median",
                          top_n=None, bottom_n=None,
                          title=None,
@@ -523,7 +693,11 @@ def plot_track_durations(stats, type, sortby="median",
     - bottom_n - only show bottom n genre (styles) ordered by 'sortby'
     - shorten_stylenames: prints style name without genre name)
       (e.g., "Ambient" instead of "Electronic - Ambient")
+
+    Boxes are drawn from precomputed quantiles (see boxplot_stats), so
+    'durations' lists are not needed (e.g., StyleEmbedding.duration_stats()).
     """
+    plt = pyplot()
 
     if title is None:
         if type == "genre":
@@ -556,29 +730,28 @@ def plot_track_durations(stats, type, sortby="median",
         sorted_genres = sorted_genres[:bottom_n]
 
     genres = [g for v, g in sorted_genres]
-    values = [stats[g]['durations'] for g in genres]
 
     # 400 genre rows fit well into vertical size of 80 (0.2 row per 1 unit of size)
     plt.figure(figsize=(7, len(sorted_genres)*0.2))
 
     if type == "genre" or type == "genre_only":
-        labels = ["%s (%d)" % (g, len(stats[g]['durations'])) for g in genres]
+        labels = ["%s (%d)" % (g, duration_count(stats[g])) for g in genres]
         plt.xlim([0, 25])
     elif type == "style" or type == "style_only":
         if shorten_stylenames:
-            labels = ["%s (%d)" % (g[1], len(stats[g]['durations'])) for g in genres]
+            labels = ["%s (%d)" % (g[1], duration_count(stats[g])) for g in genres]
         else:
-            labels = ["%s - %s (%d)" % (g[0], g[1], len(stats[g]['durations'])) for g in genres]
+            labels = ["%s - %s (%d)" % (g[0], g[1], duration_count(stats[g])) for g in genres]
         plt.xlim([0, 40])
 
-    plt.boxplot(values, vert=False, labels=labels, whis=[5, 95])
+    plt.gca().bxp(boxplot_stats(stats, genres, labels), vert=False, showfliers=False)
     if PLOT_TITLES:
         plt.title(title)
     plt.gca().xaxis.grid(True)
     plt.show()
 
 
-def track_duration_per_genre(data, genres, type="genre"):
+def track_duration_per_genre(data, genres, type="genre", processes=None):
     """
     Analyze tracks durations per genre (style)
     - data: input dataframe with release information
@@ -592,9 +765,15 @@ def track_duration_per_genre(data, genres, type="genre"):
     - title: plot title to show
     - shorten_stylenames: prints style name without genre name
       (e.g., "Ambient" instead of "Electronic - Ambient")
+    - processes: analyze genres in parallel using this number of processes
 
     Returns data required for plotting
     """
+    if processes:
+        from parallel import duration_stats
+        return duration_stats(data, genres, type, processes)
+
+    from scipy.stats import iqr
 
     if type == "genre":
         select_func = select_genre
@@ -621,12 +800,27 @@ def track_duration_per_genre(data, genres, type="genre"):
         stats[g]['95%'] = np.percentile(stats[g]['durations'], 95)
         stats[g]['5%'] = np.percentile(stats[g]['durations'], 5)
         stats[g]['95vs5'] = stats[g]['95%'] - stats[g]['5%']
-        stats[g]['iqr'] = scipy.stats.iqr(stats[g]['durations'])
+        stats[g]['iqr'] = iqr(stats[g]['durations'])
+        stats[g]['p25'] = np.percentile(stats[g]['durations'], 25)
+        stats[g]['p75'] = np.percentile(stats[g]['durations'], 75)
+        stats[g]['tracks'] = len(stats[g]['durations'])
 
     return stats
 
 
 def plot_track_durations_2d(stats, genres, xlim=[1, 8], ylim=[0,9], annotate=False):
+    """
+    Plot styles by median track duration and IQR
+    - stats: the output of track_duration_per_genre with type="style", or a
+      StyleEmbedding (see embeddings.py) which has duration quantiles of all
+      styles precomputed
+    - genres: plot styles of these genres
+    """
+    from embeddings import StyleEmbedding
+    if isinstance(stats, StyleEmbedding):
+        stats = stats.duration_stats()
+
+    plt = pyplot()
     plt.figure(figsize=(12, 12))
 
     for genre in genres:
@@ -660,15 +854,20 @@ def plot_track_durations_evolution(stats, genres=None, start_year=START_YEAR, en
     Plot evolution of track durations per genre by year
     - stats: the output of track_durations_evolution method
     - genres: list of genres (styles) to plot (all by default)
+    Confidence bands are shaded if stats have them (bands=True in
+    track_durations_evolution).
     """
+    plt = pyplot()
     if genres is None:
         genres = stats.keys()
 
     for g, c in zip(genres, prepare_colors(len(genres))):
         years = stats[g]['year']
-        plt.plot(years, stats[g]['p25'], label="25%")
-        plt.plot(years, stats[g]['median'], label="50%")
-        plt.plot(years, stats[g]['p75'], label="75%")
+        for key, label in [('p25', "25%"), ('median', "50%"), ('p75', "75%")]:
+            line, = plt.plot(years, stats[g][key], label=label)
+            if key + '_lower' in stats[g]:
+                plt.fill_between(years, stats[g][key + '_lower'], stats[g][key + '_upper'],
+                                 color=line.get_color(), alpha=0.2, linewidth=0)
 
         plt.legend()
         #plt.legend(loc="upper left", bbox_to_anchor=(1,1))
@@ -689,13 +888,22 @@ def plot_track_durations_evolution(stats, genres=None, start_year=START_YEAR, en
 
 def track_durations_evolution(data, genres, type="genre", 
                               start_year=START_YEAR, end_year=END_YEAR, 
-                              ignore_compilations=False):
+                              ignore_compilations=False, bands=False, replicates=1000):
     """
     Analyze evolution of track durations per genre by year
     - data: input dataframe with release information
     - genres: list of genres or styles to analyze
     - type: use "genre" for genres, "style" for styles
+    - bands: also compute 95% bootstrap confidence bands of quantiles
+      ('median_lower', 'median_upper', etc.) for all genres at once
+      (see bootstrap.py), using this number of 'replicates'
     """
+    if bands:
+        from bootstrap import duration_bands
+        if ignore_compilations:
+            data = data[data['compilation'] == False]
+        return duration_bands(data, genres, type, start_year, end_year, replicates=replicates)
+
     stats = {}
     for g in genres:
         if type == "genre":
@@ -726,29 +934,141 @@ def track_durations_evolution(data, genres, type="genre",
 
 # Functions for loading and saving dumps
 
-def sample_release_dump(input_dump, sampled_dump, fraction):
+def sample_release_dump(input_dump, sampled_dump, fraction=None, size=None,
+                        stratify=None, quotas=None, seed=None, chunksize=100000):
     """
     Sample input release dump
     - fraction: the fraction of releases to sample (e.g., 0.1 is 10%)
+    - size: the number of releases to sample (instead of 'fraction')
+    - stratify: sample 'fraction' (or 'size') proportionally within each
+                'year', 'country' or 'genre' (first genre of a release)
+    - quotas: dict with the number of releases to sample per stratum
+              (e.g., {'US': 1000, 'UK': 500} with stratify='country')
+    - seed: random seed, sampling is deterministic for the same seed
+    - input_dump: filename for the input dump
+    - sampled_dump: filename for the output dump
+
+    The input dump must be a columnar dump (see convert_release_dump), it
+    is sampled chunk by chunk without loading it into memory. The sample is
+    written as a columnar dump unless 'sampled_dump' has a .hdf extension,
+    in which case the whole sample is held in memory to write it.
+    """
+    from sampling import sample_rows, write_rows
+
+    if not os.path.isdir(input_dump):
+        raise ValueError("%s is not a columnar dump, convert it with "
+                         "convert_release_dump before sampling" % input_dump)
+    print("Loading release dump from %s" % input_dump)
+    data = ColumnStore(input_dump)
+    if fraction is not None:
+        print("Sampling %d%% of releases" % int(fraction*100))
+    elif size is not None:
+        print("Sampling %d releases" % size)
+    rows = sample_rows(data, fraction=fraction, size=size, stratify=stratify,
+                       quotas=quotas, seed=seed, chunksize=chunksize)
+    print("Releases in the sample: %d" % len(rows))
+
+    print("Saving the sample dump to %s" % sampled_dump)
+    write_rows(data, rows, sampled_dump, chunksize=chunksize)
+    return
+
+
+def build_release_samples(input_dump, samples_dir, fractions=[0.01, 0.1], seed=None):
+    """
+    Precompute stratified samples of a release dump (by year and first genre)
+    for approximate queries with confidence intervals (see approximate.py)
+    - fractions: fractions of releases in samples
+    - samples_dir: directory for the output samples
+    """
+    from approximate import StratifiedSamples
+    data = load_release_dump(input_dump, mapped=True)
+    print("Sampling %s of releases" % ', '.join('%g%%' % (100 * f) for f in fractions))
+    samples = StratifiedSamples.build(data, fractions, seed=seed, full=False)
+    print("Saving samples to %s" % samples_dir)
+    samples.save(samples_dir)
+
+
+def load_release_samples(samples_dir, input_dump=None):
+    """
+    Load samples built with build_release_samples to pass as 'samples' to
+    releases_per_year, compare_genres, compare_formats and releases_coverage
+    - input_dump: release dump to answer from when samples are not accurate
+      enough for a requested 'max_error'
+    """
+    from approximate import StratifiedSamples
+    data = load_release_dump(input_dump, mapped=True) if input_dump else None
+    return StratifiedSamples.load(samples_dir, data)
+
+
+def check_samples(by_master):
+    if by_master:
+        raise ValueError("Build samples from masters.by_master(data) to estimate master release counts")
+
+
+def convert_release_dump(input_dump, columnar_dump):
+    """
+    Convert a hdf release dump into a columnar layout that can be loaded
+    with memory mapping (see load_release_dump)
     - input_dump: filename for the input hdf dump
-    - sampled_dump: filename for the output hdf dump
+    - columnar_dump: directory for the output columnar dump
     """
+    import pandas
     print("Loading release dump from %s" % input_dump)
     data = pandas.read_hdf(input_dump)
-    print("Sampling %d%% of releases" % int(fraction*100))
-    data = data.sample(frac=fraction)
-    print("Releases in the sample: %d" % len(data))
-
-    print("Saving the sample dump DataFrame to %s" % sampled_dump)
-    data.to_hdf(sampled_dump, 'w')
+    print("Saving the columnar dump to %s" % columnar_dump)
+    write_columns(data, columnar_dump)
     return
 
 
-def load_release_dump(input_dump):
+def export_release_dump(input_dump, output_dump):
+    """
+    Export a release dump (hdf or columnar) for other engines (see interchange.py)
+    - output_dump: Arrow IPC file if it has an .arrow extension, otherwise
+      a Parquet dataset directory partitioned by year
+    """
+    from interchange import write_arrow, write_parquet
+    data = load_release_dump(input_dump, mapped=True)
+    print("Exporting the release dump to %s" % output_dump)
+    if output_dump.endswith('.arrow'):
+        write_arrow(data, output_dump)
+    else:
+        write_parquet(data, output_dump)
+
+
+def load_release_dump(input_dump, columns=None, start_year=None, end_year=None, mapped=False):
     """
     Loads hf release dump given the filename
+
+    If 'input_dump' is a columnar dump directory (see convert_release_dump),
+    it is decoded into a DataFrame (only the specified 'columns' if given).
+    Decoding every column builds the Python lists of the multi-valued columns
+    and is slower than reading the HDF dump (about 1.1s against 0.2s for 200k
+    releases), so only decode the columns you need. Use mapped=True to get the memory-mapped ColumnStore instead: it is
+    ready instantly, only the columns that are accessed are read from disk,
+    and the pages are shared with other processes mapping the same dump. A
+    ColumnStore is only accepted by the functions that document it (e.g.,
+    select_label, select_rows, ArtistIndex, LabelIndex, style_trends).
+
+    Parquet datasets and Arrow IPC files (see export_release_dump) are read
+    with only the specified 'columns' and only the partitions of releases
+    from 'start_year' to 'end_year'.
     """
-    return pandas.read_hdf(input_dump)
+    if input_dump.endswith('.arrow'):
+        from interchange import read_arrow
+        return read_arrow(input_dump, columns, start_year, end_year)
+    if os.path.isdir(input_dump) and not os.path.isfile(os.path.join(input_dump, META_FILE)):
+        from interchange import read_parquet
+        return read_parquet(input_dump, columns, start_year, end_year)
+    if os.path.isdir(input_dump):
+        store = ColumnStore(input_dump)
+        if mapped:
+            return store
+        return store.to_dataframe(columns)
+    import pandas
+    data = pandas.read_hdf(input_dump)
+    if columns is not None:
+        data = data[columns]
+    return data
 
 # Functions for format analysis
 
@@ -758,12 +1078,27 @@ def compare_formats(data,
                     style=None,
                     type='releases',
                     start_year=START_YEAR,
-                    end_year=END_YEAR):
+                    end_year=END_YEAR,
+                    by_master=False,
+                    samples=None,
+                    max_error=None):
     """
     Analyze formats evolution.
     - data: input DataFrame with releases
     - type: measure music in terms of "releases" or "tracks"
+    - by_master: count master releases (unique works) instead of all their releases
+    - samples: estimate counts from StratifiedSamples (see approximate.py) and
+      return DataFrames of estimates, lower and upper confidence bounds
+    - max_error: maximum relative error of estimates (see approximate.py)
     """
+    import pandas
+    if samples is not None:
+        check_samples(by_master)
+        return samples.compare_formats(formats, genre=genre, style=style, type=type,
+                                       start_year=start_year, end_year=end_year, max_error=max_error)
+    if by_master:
+        data = masters.by_master(data)
+
     stats = {}
 
     if type == 'releases':
@@ -778,18 +1113,23 @@ def compare_formats(data,
     return pandas.DataFrame(stats)
 
 
-def plot_compare_formats(stats, type, formats=['Vinyl', 'Cassette', 'CD', 'CDr', 'File'], genre=None, absolute=False):
+def plot_compare_formats(stats, type, formats=['Vinyl', 'Cassette', 'CD', 'CDr', 'File'], genre=None, absolute=False,
+                         bands=None):
     """
     Plot results of analysis of formats
     - stats: the output of compare_formats method
     - type: "releases" or "tracks"
     - formats: list of formats to compare
     - absolute: show absolute values instead of percentages
+    - bands: (lower, upper) DataFrames of confidence bands to shade, in the
+      plotted unit (see bootstrap.compare_bands)
     """
+    plt = pyplot()
     if absolute:
         #plt.plot(stats['years'], stats['all'], label='All')
         for f in formats:
-            plt.plot(stats['years'], stats[f], label=f)
+            line, = plt.plot(stats['years'], stats[f], label=f)
+            plot_band(plt, bands, f, line.get_color())
 
         plt.legend(loc="upper left", bbox_to_anchor=(1, 1))
 
@@ -800,7 +1140,8 @@ def plot_compare_formats(stats, type, formats=['Vinyl', 'Cassette', 'CD', 'CDr',
             print(title)
     else:
         for f in formats:
-            plt.plot(stats['years'], 100. * stats[f] / stats['all'], label=f)
+            line, = plt.plot(stats['years'], 100. * stats[f] / stats['all'], label=f)
+            plot_band(plt, bands, f, line.get_color())
         #plt.legend(loc="upper left", bbox_to_anchor=(1,1))
         plt.legend()
         title = "Percentage of %s per format by year (%s)" % (type, genre)
@@ -816,14 +1157,22 @@ def plot_compare_formats(stats, type, formats=['Vinyl', 'Cassette', 'CD', 'CDr',
 def compare_genres(data,
                    metric='releases',
                    genres=None, styles=None, country=None, format=None,
-                   start_year=START_YEAR, end_year=END_YEAR):
+                   start_year=START_YEAR, end_year=END_YEAR,
+                   processes=None, by_master=False, samples=None, max_error=None):
     """
     Analyze genre or styles evolution
     - data: input DataFrame with releases
     - type: measure music in terms of "releases", "tracks", or "artists"
     - genres: list of genres to analyze
     - styles: list of styles to analyze (genres and styles cannot be specified together)
+    - processes: analyze genres (styles) in parallel using this number of processes
+    - by_master: count master releases (unique works) instead of all their releases
+    - samples: estimate counts from StratifiedSamples (see approximate.py) and
+      return DataFrames of estimates, lower and upper confidence bounds
+      ("releases" and "tracks" only)
+    - max_error: maximum relative error of estimates (see approximate.py)
     """
+    import pandas
     if genres and styles:
         print("ERROR: cannot specify 'genres' and 'styles' simultaneously")
         return
@@ -832,6 +1181,14 @@ def compare_genres(data,
     elif styles:
         genre_or_style = "style"
 
+    if samples is not None:
+        check_samples(by_master)
+        return samples.compare_genres(metric, genres=genres, styles=styles, country=country, format=format,
+                                      start_year=start_year, end_year=end_year, max_error=max_error)
+
+    if by_master:
+        data = masters.by_master(data)
+
     if metric == 'releases':
         compute = releases_per_year
     elif metric == 'tracks':
@@ -840,6 +1197,17 @@ def compare_genres(data,
         compute = artists_per_year
 
     stats = {}
+    if processes:
+        from parallel import per_year_counts
+        keys = ['all'] + (genres or styles)
+        queries = [dict(country=country, format=format)]
+        queries += [dict(genre=g, country=country, format=format) for g in genres or []]
+        queries += [dict(style=s, country=country, format=format) for s in styles or []]
+        counts = per_year_counts(data, queries, metric, start_year, end_year, processes)
+        stats = dict(zip(keys, counts))
+        stats['years'] = range(start_year, end_year+1)
+        return pandas.DataFrame(stats)
+
     stats['years'], stats['all'] = compute(data, start_year, end_year, country=country, format=format)
 
     if genres:
@@ -852,14 +1220,17 @@ def compare_genres(data,
     return pandas.DataFrame(stats)
 
 
-def plot_compare_genres(stats, metric, genres, absolute=False, shorten=False):
+def plot_compare_genres(stats, metric, genres, absolute=False, shorten=False, bands=None):
     """
     Plot results of analysis of genre or style evolution
     - stats: the output of compare_genres method
     - metric: measure music in terms of "releases", "tracks", or "artists"
     - genres: genres or styles to plot
     - absolute: show absolute values instead of percentages
+    - bands: (lower, upper) DataFrames of confidence bands to shade, in the
+      plotted unit (see bootstrap.compare_bands)
     """
+    plt = pyplot()
 
     # TODO some code to re-factor
     """
@@ -891,6 +1262,7 @@ def plot_compare_genres(stats, metric, genres, absolute=False, shorten=False):
                 genre_or_style = "genre"
 
             plt.plot(stats['years'], stats[g], label=str_g, color=c)
+            plot_band(plt, bands, g, c)
 
         title = "Number of " + metric + " per " + genre_or_style + " by year"
         if PLOT_TITLES:
@@ -910,6 +1282,7 @@ def plot_compare_genres(stats, metric, genres, absolute=False, shorten=False):
                 genre_or_style = "genre"
 
             plt.plot(stats['years'], 100. * stats[g] / stats['all'], label=str_g, color=c)
+            plot_band(plt, bands, g, c)
 
         title = "Percentage of " + metric + " per " + genre_or_style + " by year"
         if PLOT_TITLES:
@@ -920,7 +1293,71 @@ def plot_compare_genres(stats, metric, genres, absolute=False, shorten=False):
     plt.legend(loc="upper left", bbox_to_anchor=(1,1))
     plt.show()
 
-# TODO add functions for regional trends (move code from my old notebook)
+
+def plot_band(plt, bands, key, color=None):
+    """Shade the confidence band of 'key' from (lower, upper) DataFrames, if any"""
+    if bands is None:
+        return
+    lower, upper = bands
+    plt.fill_between(lower['years'], lower[key], upper[key], color=color, alpha=0.2, linewidth=0)
+
+# Functions for regional trends
+
+def release_cube(data, type='genre'):
+    """
+    Build the country x year x genre (or style) x format cube of releases for
+    regional trends (see cube.py). Save it with cube.save(filename) and load
+    it back with cube.ReleaseCube.load(filename).
+    """
+    from cube import ReleaseCube
+    with metrics.stage('release_cube', items=len(data)):
+        return ReleaseCube.build(data, type)
+
+
+def regional_trends(cube, countries=None, genre=None, style=None, format=None,
+                    type='releases', regions=None, top=10, period='year',
+                    title=None, start_year=START_YEAR, end_year=END_YEAR):
+    """
+    Visualize the number of releases, tracks or artists across years by
+    country or region, from a cube built with release_cube
+    - countries: list of countries to plot (by default the 'top' countries)
+    - genre or style: only consider releases from this genre (or style, for a
+      cube of styles)
+    - format: only consider releases in this format
+    - type: 'releases', 'tracks' or 'artists' (distinct artists)
+    - regions: dict of country -> region, plot regions instead of countries
+    - period: 'year' or 'decade'
+    Returns the table of periods x countries (or regions).
+    """
+    plt = pyplot()
+
+    value = style if cube.type == 'style' else genre
+    if regions:
+        by = 'region'
+    else:
+        by = 'country'
+        if countries is None:
+            countries = list(cube.top_countries(top, type, genre=value, format=format,
+                                                start_year=start_year, end_year=end_year)['country'])
+
+    stats = cube.trends(type, by, countries=countries, genre=value, format=format,
+                        start_year=start_year, end_year=end_year, regions=regions, period=period)
+
+    if not title:
+        title = "Number of " + type + " across " + period + "s by " + by
+        if value:
+            title = title + " (%s)" % (rename_style(value) if isinstance(value, tuple) else value)
+
+    columns = list(stats.columns)
+    for c, color in zip(columns, prepare_colors(len(columns))):
+        plt.plot(stats.index, stats[c].replace(0, float('nan')), label=c, color=color)
+    plt.legend(loc="upper left", bbox_to_anchor=(1, 1))
+    if PLOT_TITLES:
+        plt.title(title)
+    plt.show()
+
+    return stats
+
 
 # Functions for genre and styles co-occurrence analysis
 
@@ -947,13 +1384,15 @@ def genre_cooccurences(data, genre, type="genre"):
 """
 
 
-def genre_cooccurences_matrix(data, genres=None, type="genre", rename=None):
+def genre_cooccurences_matrix(data, genres=None, type="genre", rename=None, processes=None):
     """
     Compute a genre co-occurrence matrix
     - data: input DataFrame with releases
     - type: "genre" or "style"
     - rename: rename function for genres or styles
+    - processes: compute matrix rows in parallel using this number of processes
     """
+    import pandas
 
     if type == "genre":
         find_func = find_genres
@@ -967,6 +1406,21 @@ def genre_cooccurences_matrix(data, genres=None, type="genre", rename=None):
     if not genres:
         genres = find_func(data)
 
+    if processes:
+        from parallel import cooccurrence_rows
+        nonempty_genres, rows = cooccurrence_rows(data, genres, type, processes)
+        result = {}
+        genres = []
+        for i, (g1, matches) in enumerate(zip(nonempty_genres, rows)):
+            matches = list(matches)
+            matches[i] = 100.
+            if rename:
+                g1 = rename(g1)
+            result[g1] = matches
+            genres.append(g1)
+        df = pandas.DataFrame(result, index=genres).transpose()
+        return df.reindex(columns=sorted(df.columns))
+
     result = {}
 
     nonempty_genres = {}
@@ -990,12 +1444,25 @@ def genre_cooccurences_matrix(data, genres=None, type="genre", rename=None):
         genres.append(g1)
 
     df = pandas.DataFrame(result, index=genres).transpose()
-    return df.reindex_axis(sorted(df.columns), axis=1)
+    return df.reindex(columns=sorted(df.columns))
 
 
-def plot_genre_cooccurences_matrix(matrix, figsize=None, title=None):
-    plt.figure(figsize=(80, 80))
-    seaborn.heatmap(results_cooccurences['genre'], annot=True, fmt='.1f')
+def plot_genre_cooccurences_matrix(matrix, figsize=None, title=None, annotate=None):
+    """
+    Plot a co-occurrence matrix (the output of genre_cooccurences_matrix)
+    - figsize: figure size, by default 0.5 inches per genre (style)
+    - annotate: write percentages in cells, by default only for matrices
+      of up to 50 genres (styles)
+    """
+    plt = pyplot()
+    import seaborn
+    if figsize is None:
+        size = max(8, 0.5 * len(matrix))
+        figsize = (size, size)
+    if annotate is None:
+        annotate = len(matrix) <= 50
+    plt.figure(figsize=figsize)
+    seaborn.heatmap(matrix, annot=annotate, fmt='.1f')
 
 
     if title is None:
@@ -1036,23 +1503,29 @@ def style_cooccurences_by_year(data, style, styles=None, start_year=START_YEAR,
 
 
 def plot_style_cooccurences_by_year(stats):
+    import pandas
+    plt = pyplot()
     styles = stats['styles'].keys()
 
     # Plot only styles that have high co-occurrence, at least in some year
-    show_styles = [g for g in styles if (100. * stats[g]/stats['All']).max() >= 10]
+    # (years without releases of the queried style have no share)
+    total = np.asarray(stats['All'], dtype=np.float64)
+    years = total > 0
+    show_styles = [g for g in styles
+                   if years.any() and (100. * np.asarray(stats['styles'][g])[years] / total[years]).max() >= 10]
 
     #for g in show_styles:
     #    print g, (100. * stats[g]/stats['All']).max()
 
     for g, c in zip(show_styles, prepare_colors(len(show_styles))):
-        tmp = pandas.DataFrame({'All': stats['All'], g: stats[g]})
+        tmp = pandas.DataFrame({'All': stats['All'], g: stats['styles'][g]})
         plt.plot(stats['years'], 100. * tmp[g] / tmp['All'],
                  label="%s - %s" % (g[0], g[1]),
                  color=c)
 
     plt.legend(loc="upper left", bbox_to_anchor=(1, 1))
 
-    title = "Percentage of %s releases also annotated by other styles by year (%)" % stats['query_style']
+    title = "Percentage of %s - %s releases also annotated by other styles by year (%%)" % stats['query_style']
     if PLOT_TITLES:
         plt.title(title)
     else:
@@ -1062,3 +1535,17 @@ def plot_style_cooccurences_by_year(stats):
     plt.ylim([0, 60])
     plt.show()
     return
+
+
+# Time the analyses and dump operations of this module (see metrics.py),
+# outputs are configured by the scripts
+metrics.instrument(globals(), 'analyze', [
+    'select', 'search_titles', 'releases_per_year', 'artists_per_year',
+    'tracks_per_year', 'releases_stats', 'releases_coverage',
+    'coverage_countries_evolution', 'coverage_genres_evolution',
+    'track_duration_per_genre', 'track_durations_evolution',
+    'sample_release_dump', 'build_release_samples', 'load_release_samples',
+    'check_samples', 'convert_release_dump', 'export_release_dump',
+    'load_release_dump', 'compare_formats', 'compare_genres', 'release_cube',
+    'regional_trends', 'genre_cooccurences_matrix',
+    'style_cooccurences_by_year'])
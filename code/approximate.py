@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Approximate answers with confidence intervals from precomputed stratified
+samples of releases.
+
+Releases are split into strata by release year and first genre. Every
+release gets a random key, and a sample of fraction f keeps the releases with
+the smallest keys in each stratum (at least 'min_per_stratum' of them), so
+that smaller samples are subsets of larger ones. Stratum sizes and track
+totals of the whole dataset are kept with the samples.
+
+Counts (releases or tracks) are estimated by scaling sampled counts of every
+stratum by its sampling fraction, and their variance is the sum of stratum
+variances (with finite population correction). Confidence intervals use the
+normal approximation. Percentages are estimated counts divided by exact
+totals.
+
+Queries are answered from the smallest sample first. If a 'max_error' is
+given and some estimate has a larger relative error (half-width of its
+confidence interval divided by the estimate), the query escalates to the
+next larger sample, and finally to the full data if it is available (exact
+answers, no error). Distinct artists can't be estimated from samples.
+
+A yearly count without any matching sampled release is estimated as 0, but
+the releases of that year that were not sampled may still match: its upper
+bound follows the rule of three (with n sampled releases of the year and
+none matching, the matching share is below 3/n with 95% confidence), and
+its relative error is unbounded, so that a 'max_error' query escalates.
+
+Usage:
+    samples = StratifiedSamples.build(data, fractions=[0.01, 0.1])
+    samples.save('releases.samples')
+    samples = StratifiedSamples.load('releases.samples', data)
+    stats, lower, upper = samples.compare_genres(genres=['Rock', 'Jazz'], max_error=0.1)
+'''
+
+import os
+import json
+import numpy as np
+import pandas
+
+from columnar import ColumnStore, write_columns, encode_multivalued
+from labels import release_rows
+from sampling import stratum_labels, dataframe_labels
+
+
+SAMPLE_COLUMNS = ['@id', 'released', 'country', 'genres', 'styles', 'formats', 'tracks_number']
+STRATA_FILE = 'strata.npz'
+STRATA_JSON = 'strata.json'
+
+
+def z_value(confidence):
+    from scipy.stats import norm
+    return norm.ppf(0.5 + confidence / 2.)
+
+
+def release_strata(data, keys=None):
+    """
+    Return the stratum of every release by (year, first genre) and the list
+    of (year, genre) keys of strata (year -1 if unknown, genre None if none)
+    - keys: use these strata instead of the ones present in data
+    """
+    if isinstance(data, ColumnStore):
+        years = stratum_labels(data, 0, len(data), 'year')
+        genres = stratum_labels(data, 0, len(data), 'genre')
+        vocab = data.vocab('genres')
+    else:
+        years, _ = dataframe_labels(data, 'year')
+        genres, vocab = dataframe_labels(data, 'genre')
+    pairs, labels = np.unique(np.c_[years, genres], axis=0, return_inverse=True)
+    names = [(int(y), vocab[g] if g >= 0 else None) for y, g in pairs]
+    labels = labels.ravel().astype(np.int64)
+    if keys is None:
+        return labels, names
+    index = dict((tuple(k), i) for i, k in enumerate(keys))
+    missing = [n for n in names if n not in index]
+    if missing:
+        raise ValueError("Releases from strata missing in samples: %s" % missing[:10])
+    return np.array([index[n] for n in names], dtype=np.int64)[labels], keys
+
+
+def stratified_totals(strata, sizes, population, values, groups, number):
+    """
+    Estimate totals of a measure per group from a stratified sample
+    - strata: stratum of every sampled element
+    - sizes: number of sampled releases per stratum
+    - population: number of releases per stratum
+    - values: value of every element (e.g., 1 for releases, tracks)
+    - groups: group of every element (elements can repeat a release, e.g.,
+      once per genre, if they belong to different groups)
+    - number: number of groups
+    Returns estimates and their variances per group.
+    """
+    sizes = sizes.astype(np.float64)
+    population = population.astype(np.float64)
+    weight = np.where(sizes > 0, population / np.maximum(sizes, 1), 0)
+    # (group, stratum) sums of values and squared values
+    strata_number = len(sizes)
+    keys = groups * strata_number + strata
+    cells, index = np.unique(keys, return_inverse=True)
+    s1 = np.bincount(index, weights=values)
+    s2 = np.bincount(index, weights=values * values)
+    cell_groups, cell_strata = cells // strata_number, cells % strata_number
+
+    n = sizes[cell_strata]
+    estimates = np.bincount(cell_groups, weights=weight[cell_strata] * s1, minlength=number)
+    # sample variance within the stratum (elements outside the group count as 0)
+    variance = np.where(n > 1, (s2 - s1 * s1 / np.maximum(n, 1)) / np.maximum(n - 1, 1), 0)
+    correction = 1 - n / population[cell_strata]
+    variances = np.bincount(cell_groups,
+                            weights=population[cell_strata] ** 2 * correction * variance / np.maximum(n, 1),
+                            minlength=number)
+    return estimates, np.maximum(variances, 0)
+
+
+class SampleLevel(object):
+    """A sample of releases with the stratum of every sampled release"""
+
+    def __init__(self, fraction, releases, strata, number_strata):
+        self.fraction = fraction
+        self.releases = releases.reset_index(drop=True)
+        self.strata = strata
+        self.sizes = np.bincount(strata, minlength=number_strata)
+        self.encoded = {}
+
+    def multivalued(self, name):
+        if name not in self.encoded:
+            offsets, codes, vocab = encode_multivalued(self.releases[name].values)
+            self.encoded[name] = (offsets, codes, vocab)
+        return self.encoded[name]
+
+    def has(self, name, value):
+        """Boolean mask of sampled releases with 'value' in a multi-valued column"""
+        offsets, codes, vocab = self.multivalued(name)
+        mask = np.zeros(len(self.releases), dtype=bool)
+        if value in vocab:
+            mask[release_rows(offsets)[codes == vocab.index(value)]] = True
+        return mask
+
+    def mask(self, genre=None, style=None, format=None, country=None):
+        mask = np.ones(len(self.releases), dtype=bool)
+        if genre:
+            mask &= self.has('genres', genre)
+        if style:
+            mask &= self.has('styles', style)
+        if format:
+            mask &= self.has('formats', format)
+        if country:
+            mask &= (self.releases['country'] == country).values
+        return mask
+
+    def values(self, metric):
+        if metric == 'releases':
+            return np.ones(len(self.releases))
+        if metric == 'tracks':
+            return np.nan_to_num(self.releases['tracks_number'].values.astype(np.float64))
+        raise ValueError("Only 'releases' and 'tracks' can be estimated from samples, not %s" % metric)
+
+    def years(self):
+        released = self.releases['released'].values.astype(np.float64)
+        return np.where(np.isnan(released), -1, np.nan_to_num(released)).astype(np.int64)
+
+
+class StratifiedSamples(object):
+    """
+    Nested stratified samples of releases (see the module description)
+    - levels: SampleLevel objects by increasing fraction, the last one is the
+      full data when it is available
+    - population, tracks: number of releases and tracks per stratum
+    - strata: (year, first genre) of every stratum
+    """
+
+    def __init__(self, levels, population, tracks, strata):
+        self.levels = levels
+        self.population = population
+        self.tracks = tracks
+        self.strata = strata
+
+    @classmethod
+    def build(cls, data, fractions=[0.01, 0.1], seed=None, min_per_stratum=20, full=True):
+        """
+        Sample releases (a DataFrame or a ColumnStore)
+        - fractions: fractions of releases to sample
+        - seed: random seed, samples are deterministic for a given seed
+        - min_per_stratum: minimum number of releases sampled per stratum
+          (intervals of strata with only a few sampled releases are too
+          narrow: a 95% interval covers about 60% of counts with 2 releases
+          per stratum, and 93-99% with 20)
+        - full: answer from the full data when samples are not accurate enough
+        """
+        strata, names = release_strata(data)
+        number_strata = len(names)
+        population = np.bincount(strata, minlength=number_strata)
+        if isinstance(data, ColumnStore):
+            tracks_number = np.asarray(data.numeric('tracks_number'), dtype=np.float64)
+        else:
+            tracks_number = data['tracks_number'].values.astype(np.float64)
+        tracks = np.bincount(strata, weights=np.nan_to_num(tracks_number), minlength=number_strata)
+
+        # rank of every release within its stratum by random key
+        keys = np.random.RandomState(seed).random_sample(len(strata))
+        order = np.lexsort((keys, strata))
+        starts = np.r_[0, np.cumsum(population)[:-1]]
+        rank = np.empty(len(strata), dtype=np.int64)
+        rank[order] = np.arange(len(strata)) - np.repeat(starts, population)
+
+        levels = []
+        for fraction in sorted(fractions):
+            quota = np.minimum(population, np.maximum(np.round(fraction * population), min_per_stratum))
+            rows = np.flatnonzero(rank < quota[strata])
+            levels.append(SampleLevel(fraction, take_releases(data, rows), strata[rows], number_strata))
+        samples = cls(levels, population, tracks, names)
+        if full:
+            samples.add_full(data)
+        return samples
+
+    def add_full(self, data):
+        """Use the full data (exact answers) when samples are not accurate enough"""
+        strata, _ = release_strata(data, self.strata)
+        if isinstance(data, ColumnStore):
+            data = data.to_dataframe(SAMPLE_COLUMNS)
+        self.levels = [l for l in self.levels if l.fraction < 1]
+        self.levels.append(SampleLevel(1.0, data[SAMPLE_COLUMNS], strata, len(self.strata)))
+
+    def save(self, path):
+        """Save samples (not the full data) to a directory"""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        samples = [l for l in self.levels if l.fraction < 1]
+        with open(os.path.join(path, STRATA_JSON), 'w') as f:
+            json.dump({'strata': self.strata, 'fractions': [l.fraction for l in samples]}, f)
+        np.savez(os.path.join(path, STRATA_FILE), population=self.population, tracks=self.tracks,
+                 **dict(('strata_%d' % i, l.strata) for i, l in enumerate(samples)))
+        for i, level in enumerate(samples):
+            write_columns(level.releases, os.path.join(path, 'sample_%d' % i))
+
+    @classmethod
+    def load(cls, path, data=None):
+        """
+        Load samples saved with save()
+        - data: full data to escalate to (a DataFrame or a ColumnStore)
+        """
+        with open(os.path.join(path, STRATA_JSON), 'r') as f:
+            meta = json.load(f)
+        strata = [tuple(k) for k in meta['strata']]
+        f = np.load(os.path.join(path, STRATA_FILE))
+        levels = []
+        for i, fraction in enumerate(meta['fractions']):
+            releases = ColumnStore(os.path.join(path, 'sample_%d' % i)).to_dataframe(SAMPLE_COLUMNS)
+            levels.append(SampleLevel(fraction, releases, f['strata_%d' % i], len(strata)))
+        samples = cls(levels, f['population'], f['tracks'], strata)
+        if data is not None:
+            samples.add_full(data)
+        return samples
+
+    def _estimate(self, level, values, rows, groups, number):
+        # estimates for (sampled release, group) pairs
+        return stratified_totals(level.strata[rows], level.sizes, self.population,
+                                 values[rows], groups, number)
+
+    def _answer(self, compute, max_error, confidence):
+        # answer from the smallest sample meeting the error bound
+        z = z_value(confidence)
+        for i, level in enumerate(self.levels):
+            estimates, variances = compute(level)
+            errors = z * np.sqrt(variances)
+            last = i == len(self.levels) - 1
+            if max_error is None or last or relative_error(estimates, errors) <= max_error:
+                break
+        if max_error is not None and relative_error(estimates, errors) > max_error:
+            print("WARNING: relative error %.3f above %.3f with the largest sample" %
+                  (relative_error(estimates, errors), max_error))
+        if level.fraction < 1:
+            print("Answered from a %g%% sample" % (100 * level.fraction))
+        return estimates, errors
+
+    def per_year(self, start_year, end_year, queries, metric='releases',
+                 max_error=None, confidence=0.95):
+        """
+        Estimate yearly counts for several queries at once
+        - queries: list of dicts with genre, style, format and country
+        - metric: "releases" or "tracks"
+        Returns years, estimates and confidence interval half-widths (arrays
+        of queries x years).
+        """
+        years = np.arange(start_year, end_year + 1)
+        number = len(queries) * len(years)
+
+        # releases (or tracks) and strata of every year
+        strata_years = np.array([y for y, _ in self.strata], dtype=np.int64) - start_year
+        strata_in_range = (strata_years >= 0) & (strata_years < len(years))
+        totals = self.population if metric == 'releases' else self.tracks
+        year_totals = np.bincount(strata_years[strata_in_range], weights=totals[strata_in_range],
+                                  minlength=len(years))
+        z = z_value(confidence)
+
+        def compute(level):
+            values = level.values(metric)
+            year_index = level.years() - start_year
+            in_range = (year_index >= 0) & (year_index < len(years))
+            rows, groups = [], []
+            for q, query in enumerate(queries):
+                selected = np.flatnonzero(level.mask(**query) & in_range)
+                rows.append(selected)
+                groups.append(q * len(years) + year_index[selected])
+            rows = np.concatenate(rows).astype(np.int64)
+            groups = np.concatenate(groups).astype(np.int64)
+            estimates, variances = self._estimate(level, values, rows, groups, number)
+
+            # rule of three for years without matching sampled releases
+            sampled = np.bincount(strata_years[strata_in_range], weights=level.sizes[strata_in_range],
+                                  minlength=len(years))
+            population = np.bincount(strata_years[strata_in_range],
+                                     weights=self.population[strata_in_range], minlength=len(years))
+            bound = np.where(sampled < population,
+                             -np.log(1 - confidence) * year_totals / np.maximum(sampled, 1), 0)
+            bound = np.tile(bound, len(queries))
+            missing = np.flatnonzero(estimates == 0)
+            variances[missing] = (bound[missing] / z) ** 2
+            return estimates, variances
+
+        estimates, errors = self._answer(compute, max_error, confidence)
+        shape = (len(queries), len(years))
+        return years, estimates.reshape(shape), errors.reshape(shape)
+
+    def releases_per_year(self, start_year, end_year, format=None, genre=None, style=None,
+                          country=None, metric='releases', max_error=None, confidence=0.95):
+        """
+        Estimate the number of releases (or tracks) per year, as in
+        analyze.releases_per_year. Returns a DataFrame of years, estimates
+        and lower and upper confidence bounds.
+        """
+        years, estimates, errors = self.per_year(
+            start_year, end_year, [dict(genre=genre, style=style, format=format, country=country)],
+            metric, max_error, confidence)
+        return pandas.DataFrame({'years': years, 'estimate': estimates[0],
+                                 'lower': np.maximum(estimates[0] - errors[0], 0),
+                                 'upper': estimates[0] + errors[0]},
+                                columns=['years', 'estimate', 'lower', 'upper'])
+
+    def _compare(self, keys, queries, metric, start_year, end_year, max_error, confidence):
+        years, estimates, errors = self.per_year(start_year, end_year, queries, metric,
+                                                 max_error, confidence)
+        tables = []
+        for values in [estimates, estimates - errors, estimates + errors]:
+            table = dict(zip(keys, np.maximum(values, 0)))
+            table['years'] = years
+            tables.append(pandas.DataFrame(table))
+        return tuple(tables)
+
+    def compare_genres(self, metric='releases', genres=None, styles=None, country=None, format=None,
+                       start_year=None, end_year=None, max_error=None, confidence=0.95):
+        """
+        Estimate genre or style evolution as in analyze.compare_genres.
+        Returns DataFrames of estimates, lower and upper confidence bounds.
+        """
+        keys = ['all'] + (genres or styles)
+        queries = [dict(country=country, format=format)]
+        queries += [dict(genre=g, country=country, format=format) for g in genres or []]
+        queries += [dict(style=s, country=country, format=format) for s in styles or []]
+        return self._compare(keys, queries, metric, start_year, end_year, max_error, confidence)
+
+    def compare_formats(self, formats, genre=None, style=None, type='releases',
+                        start_year=None, end_year=None, max_error=None, confidence=0.95):
+        """
+        Estimate format evolution as in analyze.compare_formats.
+        Returns DataFrames of estimates, lower and upper confidence bounds.
+        """
+        keys = ['all'] + formats
+        queries = [dict(genre=genre, style=style)]
+        queries += [dict(format=f, genre=genre, style=style) for f in formats]
+        return self._compare(keys, queries, type, start_year, end_year, max_error, confidence)
+
+    def releases_coverage(self, max_error=None, confidence=0.95):
+        """
+        Estimate coverage of genres, styles, countries and formats in terms of
+        releases and tracks (%), as in analyze.releases_coverage. Returns a
+        dict with a DataFrame of estimates per type ('coverage_genres', ...)
+        and one of confidence interval half-widths ('coverage_genres_error', ...).
+        """
+        columns = [('coverage_genres', 'genres'), ('coverage_styles', 'styles'),
+                   ('coverage_countries', 'country'), ('coverage_formats', 'formats')]
+        totals = {'releases': float(self.population.sum()), 'tracks': float(self.tracks.sum())}
+
+        def groups(level, name):
+            # (sampled release, value code) pairs and value names
+            if name == 'country':
+                codes, vocab = pandas.factorize(level.releases['country'])
+                rows = np.flatnonzero(codes >= 0)
+                return rows, codes[rows].astype(np.int64), list(vocab)
+            offsets, codes, vocab = level.multivalued(name)
+            return release_rows(offsets), codes.astype(np.int64), vocab
+
+        vocabs = []
+
+        def compute(level):
+            # estimates of all values, types and metrics in a single array
+            results, variances = [], []
+            del vocabs[:]
+            for _, name in columns:
+                rows, codes, vocab = groups(level, name)
+                vocabs.append(vocab)
+                for metric in ['releases', 'tracks']:
+                    estimates, var = self._estimate(level, level.values(metric), rows, codes, len(vocab))
+                    results.append(100. * estimates / totals[metric])
+                    variances.append((100. / totals[metric]) ** 2 * var)
+            return np.concatenate(results), np.concatenate(variances)
+
+        estimates, errors = self._answer(compute, max_error, confidence)
+
+        stats = {'total_releases': int(totals['releases']), 'total_tracks': totals['tracks']}
+        start = 0
+        index = ['releases (%)', 'tracks (%)']
+        for (key, _), vocab in zip(columns, vocabs):
+            tables = []
+            for values in [estimates, errors]:
+                rows = [values[start:start + len(vocab)], values[start + len(vocab):start + 2 * len(vocab)]]
+                tables.append(pandas.DataFrame(rows, columns=vocab, index=index))
+            start += 2 * len(vocab)
+            order = tables[0].sort_values(by='releases (%)', axis=1, ascending=False).columns
+            stats[key] = tables[0][order]
+            stats[key + '_error'] = tables[1][order]
+        return stats
+
+
+def relative_error(estimates, errors):
+    # unbounded for zero estimates with an upper bound (see the module description)
+    if ((estimates <= 0) & (errors > 0)).any():
+        return float('inf')
+    nonzero = estimates > 0
+    if not nonzero.any():
+        return 0.
+    return float(np.max(errors[nonzero] / estimates[nonzero]))
+
+
+def take_releases(data, rows):
+    if isinstance(data, ColumnStore):
+        return data.to_dataframe(SAMPLE_COLUMNS, rows=rows)
+    return data[SAMPLE_COLUMNS].iloc[rows]
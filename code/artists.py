@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Artist inverted index: artist id -> rows of releases by that artist.
+
+The index is stored in CSR form (offsets per artist into an array of release
+rows), so that looking up releases of one or several artists costs O(result)
+instead of a scan over all releases. Artist names are kept in a separate
+dictionary (artist id -> name) collected while loading the json dump, as the
+release DataFrame only keeps artist ids.
+'''
+
+import os
+import json
+import numpy as np
+import pandas
+
+from columnar import ColumnStore, invert_csr
+
+
+def load_artist_names(filename):
+    """Load the artist id -> name dictionary saved by load_releases"""
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save_artist_names(names, filename):
+    with open(filename, 'w') as f:
+        json.dump(names, f)
+
+
+class ArtistIndex(object):
+    """
+    Index of releases by artist
+    - ids: list of artist ids
+    - offsets: CSR offsets (releases of artist ids[i] are rows[offsets[i]:offsets[i+1]])
+    - rows: release rows sorted by artist
+    - names: dict of artist id -> name
+    """
+
+    def __init__(self, ids, offsets, rows, names=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.rows_by_artist = rows
+        self.names = names or {}
+        self.codes = dict((a, i) for i, a in enumerate(ids))
+        self._name_ids = None
+
+    @classmethod
+    def build(cls, data, names=None):
+        """Build the index for a release DataFrame or a ColumnStore"""
+        if isinstance(data, ColumnStore):
+            ids = data.vocab('artists')
+            _, codes = data.multivalued('artists')
+            codes = np.asarray(codes, dtype=np.int64)
+            rows = data.row_ids('artists')
+        else:
+            vocab = {}
+            codes = []
+            rows = []
+            for row, artists in enumerate(data['artists']):
+                for a in artists:
+                    codes.append(vocab.setdefault(a, len(vocab)))
+                    rows.append(row)
+            ids = [None] * len(vocab)
+            for a, code in vocab.items():
+                ids[code] = a
+            codes = np.array(codes, dtype=np.int64)
+            rows = np.array(rows, dtype=np.int64)
+
+        # unique (artist, row) pairs, an artist may be credited twice on a release
+        length = max(len(data), 1)
+        pairs = np.unique(codes * length + rows)
+        offsets, rows = invert_csr(pairs // length, pairs % length, len(ids))
+        return cls(list(ids), offsets, rows, names)
+
+    def save(self, path):
+        """Save the index to a directory"""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(path, 'rows.npy'), self.rows_by_artist)
+        with open(os.path.join(path, 'artists.json'), 'w') as f:
+            json.dump({'ids': self.ids, 'names': self.names}, f)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved with save(), mapping arrays from disk"""
+        with open(os.path.join(path, 'artists.json'), 'r') as f:
+            meta = json.load(f)
+        offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode='r')
+        return cls(meta['ids'], offsets, rows, meta['names'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def code(self, artistid):
+        # ids are strings in the dump, accept integers as well
+        code = self.codes.get(artistid)
+        if code is None:
+            code = self.codes.get(str(artistid))
+        return code
+
+    def rows(self, artistid):
+        """Return rows of all releases by the specified artist id"""
+        code = self.code(artistid)
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.asarray(self.rows_by_artist[self.offsets[code]:self.offsets[code+1]])
+
+    def rows_any(self, artistids):
+        """Return rows of all releases by any of the specified artist ids"""
+        parts = [self.rows(a) for a in artistids]
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(parts))
+
+    def ids_for_name(self, name):
+        """Return ids of all artists with the specified name"""
+        if self._name_ids is None:
+            self._name_ids = {}
+            for a, n in self.names.items():
+                self._name_ids.setdefault(n, []).append(a)
+        return self._name_ids.get(name, [])
+
+    def rows_by_name(self, name):
+        """Return rows of all releases by artists with the specified name"""
+        return self.rows_any(self.ids_for_name(name))
+
+    def releases_number(self):
+        """Return the number of releases per artist (aligned with ids)"""
+        return np.diff(self.offsets)
+
+    def discography_stats(self, data):
+        """
+        Compute per-artist discography statistics in a single pass:
+        number of releases and tracks, first and last release year.
+        Returns a DataFrame indexed by artist id.
+        """
+        if isinstance(data, ColumnStore):
+            released = np.asarray(data.numeric('released'))
+            tracks = np.asarray(data.numeric('tracks_number'), dtype=np.int64)
+        else:
+            released = data['released'].values.astype(np.float64)
+            tracks = data['tracks_number'].values.astype(np.int64)
+
+        rows = np.asarray(self.rows_by_artist)
+        counts = self.releases_number()
+        nonempty = counts > 0
+        starts = self.offsets[:-1][nonempty]
+
+        stats = pandas.DataFrame(index=self.ids)
+        stats['releases'] = counts
+        years = released[rows]
+        for column, values in [('tracks', np.add.reduceat(tracks[rows], starts) if len(rows) else []),
+                               ('first_year', np.fmin.reduceat(years, starts) if len(rows) else []),
+                               ('last_year', np.fmax.reduceat(years, starts) if len(rows) else [])]:
+            column_values = np.full(len(self.ids), np.nan)
+            column_values[nonempty] = values
+            stats[column] = column_values
+        if self.names:
+            stats['name'] = [self.names.get(a) for a in self.ids]
+        return stats
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+End-to-end benchmark of the preprocessing pipeline and key analysis
+functions on synthetic release dumps (see synthetic.py).
+
+For each scale (number of releases) a synthetic XML dump is generated and
+every stage is timed: XML to json conversion (get_release), json loading
+(load_releases), select() queries, releases_coverage and
+genre_cooccurences_matrix. Throughput and peak memory are recorded for each
+stage and compared against a stored baseline.
+
+Usage:
+    python benchmark.py [--scales 1000 10000] [--save] [--threshold 1.25]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import resource
+
+from config import *
+from synthetic import write_synthetic_dump
+
+
+SCALES = [1000, 10000, 100000]
+
+# select() queries timed in the 'select' stage
+SELECT_QUERIES = [
+    dict(genre='Rock'),
+    dict(genre='Electronic', year=2000),
+    dict(style=('Electronic', 'House'), country='US'),
+    dict(format='Vinyl', year=1980),
+    dict(genre='Jazz', format='CD', country='Germany'),
+]
+
+
+def current_rss():
+    """Current resident set size in MB (peak RSS if /proc is not available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024. / 1024.
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class MemorySampler(threading.Thread):
+    """Sample RSS in the background to find the peak memory of a stage"""
+
+    def __init__(self, interval=0.01):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, current_rss())
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+def measure(func, items, *args, **kwargs):
+    """
+    Run 'func' and return its result and stats: time in seconds, throughput
+    (items per second) and peak RSS in MB
+    """
+    sampler = MemorySampler()
+    sampler.start()
+    start = time.time()
+    result = func(*args, **kwargs)
+    seconds = time.time() - start
+    peak = sampler.stop()
+    stats = {
+        'seconds': seconds,
+        'throughput': items / seconds if seconds else float('inf'),
+        'peak_rss_mb': peak,
+    }
+    return result, stats
+
+
+def run_selects(data):
+    import analyze
+    return [len(analyze.select(data, **q)) for q in SELECT_QUERIES]
+
+
+def benchmark_scale(releases, workdir, seed=0):
+    """Run all stages on a synthetic dump with 'releases' releases"""
+    import preprocess_releases_xml_to_json as xml_to_json
+    import preprocess_releases_json_to_hdf_pandas as json_to_hdf
+    import analyze
+
+    dump_xml = os.path.join(workdir, 'releases.%d.xml.gz' % releases)
+    dump_json = os.path.join(workdir, 'releases.%d.json.dump' % releases)
+    stats = {}
+
+    _, stats['generate'] = measure(write_synthetic_dump, releases, dump_xml, releases, seed)
+
+    xml_to_json.processed = 0
+    xml_to_json.errors = 0
+    _, stats['get_release'] = measure(xml_to_json.convert_dump, releases, dump_xml, dump_json)
+    stats['get_release']['errors'] = xml_to_json.errors
+
+    data, stats['load_releases'] = measure(json_to_hdf.load_releases, releases,
+                                           ignore_genres=IGNORE_GENRES, input_dump=dump_json)
+    releases = len(data)
+
+    _, stats['select'] = measure(run_selects, len(SELECT_QUERIES), data)
+    _, stats['releases_coverage'] = measure(analyze.releases_coverage, releases, data)
+    _, stats['genre_cooccurences_matrix'] = measure(analyze.genre_cooccurences_matrix, releases, data)
+    return stats
+
+
+def compare(results, baseline, threshold):
+    """
+    Print results next to the baseline and return the list of stages that
+    got slower than 'threshold' times the baseline
+    """
+    regressions = []
+    print("%-10s %-28s %10s %10s %8s %12s %10s" %
+          ('releases', 'stage', 'seconds', 'baseline', 'ratio', 'items/s', 'peak MB'))
+    for scale in sorted(results, key=int):
+        for stage, s in sorted(results[scale].items()):
+            base = baseline.get(scale, {}).get(stage)
+            ratio = s['seconds'] / base['seconds'] if base and base['seconds'] else None
+            flag = ''
+            if ratio is not None and ratio > threshold and stage != 'generate':
+                flag = ' REGRESSION'
+                regressions.append((scale, stage, ratio))
+            print("%-10s %-28s %10.3f %10s %8s %12.1f %10.1f%s" % (
+                scale, stage, s['seconds'],
+                '%.3f' % base['seconds'] if base else '-',
+                '%.2f' % ratio if ratio is not None else '-',
+                s['throughput'], s['peak_rss_mb'], flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the release pipeline on synthetic dumps")
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES,
+                        help="numbers of releases to generate")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for synthetic dumps")
+    parser.add_argument('--baseline', default=results_benchmark,
+                        help="json file with baseline results")
+    parser.add_argument('--save', action='store_true',
+                        help="store results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="report stages slower than threshold * baseline")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='discogs_benchmark_')
+    results = {}
+    try:
+        for scale in args.scales:
+            print("Benchmarking %d releases" % scale)
+            results[str(scale)] = benchmark_scale(scale, workdir, args.seed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        if not os.path.isdir(os.path.dirname(args.baseline)):
+            os.makedirs(os.path.dirname(args.baseline))
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Baseline saved to %s" % args.baseline)
+
+    if regressions:
+        print("%d stages slower than %.2f times the baseline" % (len(regressions), args.threshold))
+        sys.exit(1)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Bootstrap confidence bands for yearly trend curves, computed on aggregated
+data instead of resampling releases.
+
+Resampling the releases of a year with replacement only changes aggregates in
+known ways, so replicates are drawn directly from per-year counts and sorted
+duration arrays, for all categories (genres, styles, formats) and years in
+one vectorized batch:
+- number of releases of a category in a year: Poisson bootstrap, the
+  resampled count is Poisson(count)
+- percentage of releases of a year in a category: multinomial bootstrap of
+  the year's releases, whose marginal for a category is
+  Binomial(total, count / total)
+- quantiles of track durations of a category in a year: the k-th smallest
+  value of a resample of n sorted durations is the value at position
+  floor(n * V) with V ~ Beta(k, n - k + 1), so that no resample is built
+  (k = q * (n - 1) + 1 for quantile q, as interpolated by np.percentile)
+
+Bands are percentile intervals over 'replicates' bootstrap replicates.
+Replicates are drawn in chunks of cells to bound memory.
+'''
+
+import numpy as np
+import pandas
+
+from columnar import ColumnStore, encode_multivalued
+from labels import release_rows
+from tracks import csr_take
+
+
+def alpha_bounds(confidence):
+    return [50. * (1 - confidence), 50. * (1 + confidence)]
+
+
+def cell_chunks(cells, replicates, max_values=10000000):
+    chunk = max(1, max_values // max(replicates, 1))
+    for start in range(0, cells, chunk):
+        yield start, min(start + chunk, cells)
+
+
+def release_years(data):
+    if isinstance(data, ColumnStore):
+        released = np.asarray(data.numeric('released'), dtype=np.float64)
+    else:
+        released = data['released'].values.astype(np.float64)
+    return np.where(np.isnan(released), -1, np.nan_to_num(released)).astype(np.int64)
+
+
+def years_between(years, start_year=None, end_year=None):
+    # all known years by default
+    known = years[years >= 0]
+    if start_year is None:
+        start_year = known.min() if len(known) else 0
+    if end_year is None:
+        end_year = known.max() if len(known) else -1
+    return np.arange(start_year, end_year + 1)
+
+
+def category_pairs(data, type, categories=None):
+    """
+    Return unique (release, category index) pairs for genres, styles or
+    formats, and the list of categories (all present ones by default)
+    """
+    column = {'genre': 'genres', 'style': 'styles', 'format': 'formats'}[type]
+    if isinstance(data, ColumnStore):
+        offsets, codes = data.multivalued(column)
+        vocab = data.vocab(column)
+    else:
+        offsets, codes, vocab = encode_multivalued(data[column].values)
+    rows = release_rows(offsets)
+    codes = np.asarray(codes, dtype=np.int64)
+    if categories is None:
+        categories = sorted(vocab)
+    index = dict((c, i) for i, c in enumerate(categories))
+    mapping = np.array([index.get(v, -1) for v in vocab] + [-1], dtype=np.int64)
+    codes = mapping[codes] if len(codes) else codes
+    keep = codes >= 0
+    pairs = np.unique(rows[keep] * len(categories) + codes[keep]) if len(categories) else rows[:0]
+    return pairs // max(len(categories), 1), pairs % max(len(categories), 1), categories
+
+
+def yearly_counts(data, type='genre', categories=None, start_year=None, end_year=None):
+    """
+    Count releases per category and year in one pass
+    - data: releases (a DataFrame or a ColumnStore)
+    - type: "genre", "style" or "format"
+    - categories: only count these (all by default)
+    Returns categories, years, counts (categories x years) and total
+    releases per year.
+    """
+    years = release_years(data)
+    year_range = years_between(years, start_year, end_year)
+    start_year = year_range[0] if len(year_range) else 0
+    in_range = (years >= start_year) & (years < start_year + len(year_range))
+
+    rows, codes, categories = category_pairs(data, type, categories)
+    selected = in_range[rows]
+    cells = codes[selected] * len(year_range) + years[rows[selected]] - start_year
+    counts = np.bincount(cells, minlength=len(categories) * len(year_range))
+    totals = np.bincount(years[in_range] - start_year, minlength=len(year_range))
+    return categories, year_range, counts.reshape(len(categories), len(year_range)), totals
+
+
+def count_bands(counts, totals=None, replicates=1000, confidence=0.95, seed=None):
+    """
+    Bootstrap bands of release counts
+    - counts: array of counts (e.g., categories x years)
+    - totals: total releases (e.g., per year, broadcast against counts) to
+      get bands of percentages of totals instead of absolute counts
+    Returns lower and upper bounds with the shape of counts.
+    """
+    random = np.random.RandomState(seed)
+    counts = np.asarray(counts, dtype=np.int64)
+    shape = counts.shape
+    counts = counts.ravel()
+    if totals is not None:
+        totals = np.broadcast_to(np.asarray(totals, dtype=np.int64), shape).ravel()
+        shares = np.where(totals > 0, counts / np.maximum(totals, 1).astype(np.float64), 0)
+
+    lower = np.zeros(len(counts))
+    upper = np.zeros(len(counts))
+    for start, stop in cell_chunks(len(counts), replicates):
+        if totals is None:
+            samples = random.poisson(counts[start:stop], size=(replicates, stop - start))
+        else:
+            n = totals[start:stop]
+            samples = 100. * random.binomial(n, shares[start:stop], size=(replicates, stop - start)) \
+                / np.maximum(n, 1)
+        lower[start:stop], upper[start:stop] = np.percentile(samples, alpha_bounds(confidence), axis=0)
+    return lower.reshape(shape), upper.reshape(shape)
+
+
+def compare_bands(stats, keys=None, absolute=False, replicates=1000, confidence=0.95, seed=None):
+    """
+    Bootstrap bands for the output of compare_genres or compare_formats
+    (release counts)
+    - keys: genres, styles or formats to compute bands for (all by default)
+    - absolute: bands of counts, otherwise of percentages of 'all' releases
+      (as plotted by plot_compare_genres and plot_compare_formats)
+    Returns DataFrames of lower and upper bounds with 'years' and keys.
+    """
+    if keys is None:
+        keys = [k for k in stats.columns if k not in ['years', 'all']]
+    counts = np.array([stats[k].values for k in keys], dtype=np.int64)
+    totals = None if absolute else stats['all'].values
+    lower, upper = count_bands(counts, totals, replicates, confidence, seed)
+    bands = []
+    for values in [lower, upper]:
+        table = dict(zip(keys, values))
+        table['years'] = stats['years'].values
+        bands.append(pandas.DataFrame(table))
+    return tuple(bands)
+
+
+def release_durations(data):
+    """Return (offsets, durations) of track durations of releases in CSR layout"""
+    if isinstance(data, ColumnStore):
+        offsets, durations = data.ragged('tracks_duration_list')
+        return np.asarray(offsets), np.asarray(durations, dtype=np.float64)
+    lists = [d if isinstance(d, (list, tuple, np.ndarray)) else [] for d in data['tracks_duration_list']]
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(d) for d in lists])
+    return offsets, np.array([x for d in lists for x in d], dtype=np.float64)
+
+
+def sorted_durations(data, type='genre', categories=None, start_year=None, end_year=None):
+    """
+    Group track durations by category and year, sorted within each group
+    - type: "genre", "style" or "format"
+    Returns categories, years, and (offsets, durations) in CSR layout over
+    categories x years cells.
+    """
+    years = release_years(data)
+    d_offsets, durations = release_durations(data)
+
+    year_range = years_between(years, start_year, end_year)
+    start_year = year_range[0] if len(year_range) else 0
+
+    rows, codes, categories = category_pairs(data, type, categories)
+    selected = (years[rows] >= start_year) & (years[rows] < start_year + len(year_range))
+    rows, codes = rows[selected], codes[selected]
+    pair_offsets, elements = csr_take(d_offsets, rows)
+    pair_cells = codes * len(year_range) + years[rows] - start_year
+    cells = np.repeat(pair_cells, np.diff(pair_offsets))
+    values = durations[elements]
+    valid = ~np.isnan(values)
+    cells, values = cells[valid], values[valid]
+
+    order = np.lexsort((values, cells))
+    offsets = np.zeros(len(categories) * len(year_range) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(cells, minlength=len(categories) * len(year_range)))
+    return categories, year_range, (offsets, values[order])
+
+
+def sorted_quantiles(offsets, values, q):
+    """Quantile q (0-1) of every sorted CSR segment, interpolated as np.percentile (NaN if empty)"""
+    sizes = np.diff(offsets)
+    position = q * np.maximum(sizes - 1, 0)
+    low = np.floor(position).astype(np.int64)
+    high = np.minimum(low + 1, np.maximum(sizes - 1, 0))
+    result = np.full(len(sizes), np.nan)
+    nonempty = sizes > 0
+    start = offsets[:-1][nonempty]
+    fraction = (position - low)[nonempty]
+    result[nonempty] = values[start + low[nonempty]] * (1 - fraction) + \
+        values[start + high[nonempty]] * fraction
+    return result
+
+
+def quantile_bands(offsets, values, q, replicates=1000, confidence=0.95, seed=None):
+    """
+    Bootstrap bands of quantile q (0-1) of every sorted CSR segment
+    Returns lower and upper bounds per segment (NaN if empty).
+    """
+    random = np.random.RandomState(seed)
+    sizes = np.diff(offsets)
+    cells = np.flatnonzero(sizes > 0)
+    lower = np.full(len(sizes), np.nan)
+    upper = np.full(len(sizes), np.nan)
+    for start, stop in cell_chunks(len(cells), replicates):
+        chunk = cells[start:stop]
+        n = sizes[chunk]
+        # (interpolated) rank of the quantile in a resample
+        k = q * (n - 1) + 1.
+        positions = np.floor(n * random.beta(k, n - k + 1, size=(replicates, len(chunk)))).astype(np.int64)
+        samples = values[offsets[chunk] + np.minimum(positions, n - 1)]
+        lower[chunk], upper[chunk] = np.percentile(samples, alpha_bounds(confidence), axis=0)
+    return lower, upper
+
+
+def duration_bands(data, genres, type='genre', start_year=None, end_year=None,
+                   quantiles=[('p25', 0.25), ('median', 0.5), ('p75', 0.75)],
+                   replicates=1000, confidence=0.95, seed=None):
+    """
+    Track duration quantiles per genre (style) and year with bootstrap bands,
+    in the format of analyze.track_durations_evolution with additional
+    '<quantile>_lower' and '<quantile>_upper' lists
+    """
+    categories, years, (offsets, values) = sorted_durations(data, type, genres, start_year, end_year)
+    sizes = np.diff(offsets).reshape(len(categories), len(years))
+    results = {}
+    for name, q in quantiles:
+        results[name] = sorted_quantiles(offsets, values, q).reshape(sizes.shape)
+        lower, upper = quantile_bands(offsets, values, q, replicates, confidence, seed)
+        results[name + '_lower'] = lower.reshape(sizes.shape)
+        results[name + '_upper'] = upper.reshape(sizes.shape)
+
+    stats = {}
+    for i, g in enumerate(categories):
+        present = sizes[i] > 0
+        stats[g] = {'year': list(years[present])}
+        for key, values in results.items():
+            stats[g][key] = list(values[i][present])
+    return stats
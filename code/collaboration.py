@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Sparse artist collaboration graph built from release and track credits.
+
+The json dump is streamed once. For every release, all credited artists
+(release artists and track artists) are collected and each pair of them is
+recorded once, together with the release year and genres. The graph is a
+symmetric scipy.sparse matrix of artists x artists weighted by the number of
+shared releases. Slices by genre and years are built from the recorded pairs
+without reading the dump again.
+'''
+
+import json
+from array import array
+from itertools import combinations
+import numpy as np
+
+from config import *
+from columnar import to_numpy
+from preprocess_releases_json_to_hdf_pandas import extract_year
+
+
+# Discogs pseudo-artists that would connect unrelated artists ("Various")
+IGNORE_ARTISTS = ['194']
+
+
+def release_artists(release, track_artists=True, names=None):
+    """
+    Return the set of artist ids credited on a release (and its tracks),
+    optionally collecting artist names into 'names' dict
+    """
+    artists = list(release.get('artists') or [])
+    if track_artists:
+        for t in release.get('tracklist') or []:
+            artists += t.get('artists') or []
+    if names is not None:
+        for a in artists:
+            names[a['id']] = a['name']
+    return set(a['id'] for a in artists)
+
+
+class CollaborationGraph(object):
+    """
+    Artist co-credit graph
+    - ids: artist ids (matrix rows/columns)
+    - names: dict of artist id -> name
+    - pairs: (artist code, artist code, release number) for every co-credit
+    - years: release year per release number (-1 if unknown or implausible)
+    - genre_offsets, genre_codes: genres per release number (CSR)
+    - genres: genre vocabulary
+    """
+
+    def __init__(self, ids, names, src, dst, release, years, genre_offsets, genre_codes, genres):
+        self.ids = ids
+        self.names = names
+        self.codes = dict((a, i) for i, a in enumerate(ids))
+        self.src = src
+        self.dst = dst
+        self.release = release
+        self.years = years
+        self.genre_offsets = genre_offsets
+        self.genre_codes = genre_codes
+        self.genres = genres
+        self._matrix = None
+
+    @classmethod
+    def build(cls, input_dump=None, size=None, track_artists=True,
+              ignore_artists=IGNORE_ARTISTS, max_artists=None):
+        """
+        Build the graph streaming the json dump once
+        - input_dump: json dump filename (dump_json by default)
+        - size: only read 'size' first releases
+        - track_artists: also use track credits
+        - ignore_artists: artist ids to ignore ("Various" by default)
+        - max_artists: skip releases with more credited artists than this
+          (e.g., large compilations), as pairs grow quadratically
+        """
+        if input_dump is None:
+            input_dump = dump_json
+        ignore_artists = set(ignore_artists or [])
+
+        codes = {}
+        names = {}
+        genre_vocab = {}
+        src, dst, release_numbers = array('i'), array('i'), array('i')
+        years = array('h')
+        genre_offsets, genre_codes = [0], array('i')
+
+        with open(input_dump, 'r') as f:
+            for i, jsonline in enumerate(f):
+                if i == size:
+                    break
+                release = json.loads(jsonline)
+                number = len(years)
+                year = extract_year(release.get('released') or '')
+                # malformed dates (e.g., "20170101") don't fit an int16 year
+                years.append(year if year is not None and 0 < year < 10000 else -1)
+                for g in release.get('genres') or []:
+                    genre_codes.append(genre_vocab.setdefault(g, len(genre_vocab)))
+                genre_offsets.append(len(genre_codes))
+
+                artists = release_artists(release, track_artists, names) - ignore_artists
+                if len(artists) < 2 or (max_artists and len(artists) > max_artists):
+                    continue
+                artists = sorted(codes.setdefault(a, len(codes)) for a in artists)
+                for a1, a2 in combinations(artists, 2):
+                    src.append(a1)
+                    dst.append(a2)
+                    release_numbers.append(number)
+
+                if not (i + 1) % 500000:
+                    print("Processed %d releases" % (i + 1))
+
+        ids = [None] * len(codes)
+        for a, code in codes.items():
+            ids[code] = a
+        genres = [None] * len(genre_vocab)
+        for g, code in genre_vocab.items():
+            genres[code] = g
+
+        return cls(ids, names,
+                   to_numpy(src, np.int32), to_numpy(dst, np.int32),
+                   to_numpy(release_numbers, np.int32), to_numpy(years, np.int16),
+                   np.array(genre_offsets, dtype=np.int64),
+                   to_numpy(genre_codes, np.int32), genres)
+
+    def save(self, filename):
+        """Save the graph to a .npz file"""
+        np.savez(filename, src=self.src, dst=self.dst, release=self.release,
+                 years=self.years, genre_offsets=self.genre_offsets, genre_codes=self.genre_codes,
+                 meta=np.array([json.dumps({'ids': self.ids, 'names': self.names, 'genres': self.genres})]))
+
+    @classmethod
+    def load(cls, filename):
+        """Load a graph saved with save()"""
+        f = np.load(filename)
+        meta = json.loads(str(f['meta'][0]))
+        return cls(meta['ids'], meta['names'], f['src'], f['dst'], f['release'],
+                   f['years'], f['genre_offsets'], f['genre_codes'], meta['genres'])
+
+    def release_mask(self, genre=None, start_year=None, end_year=None):
+        """Boolean mask of releases in a genre and year range"""
+        mask = np.ones(len(self.years), dtype=bool)
+        if start_year is not None:
+            mask &= self.years >= start_year
+        if end_year is not None:
+            mask &= (self.years <= end_year) & (self.years >= 0)
+        if genre is not None:
+            in_genre = np.zeros(len(self.years), dtype=bool)
+            if genre in self.genres:
+                rows = np.repeat(np.arange(len(self.years)), np.diff(self.genre_offsets))
+                in_genre[rows[self.genre_codes == self.genres.index(genre)]] = True
+            mask &= in_genre
+        return mask
+
+    def matrix(self, genre=None, start_year=None, end_year=None):
+        """
+        Return the symmetric artist x artist co-credit matrix (scipy.sparse
+        CSR) weighted by the number of shared releases, optionally only
+        counting releases from a genre and a year range
+        """
+        from scipy import sparse
+
+        sliced = genre is not None or start_year is not None or end_year is not None
+        if not sliced and self._matrix is not None:
+            return self._matrix
+
+        src, dst = self.src, self.dst
+        if sliced:
+            pairs = self.release_mask(genre, start_year, end_year)[self.release]
+            src, dst = src[pairs], dst[pairs]
+
+        n = len(self.ids)
+        weights = np.ones(2 * len(src), dtype=np.int32)
+        matrix = sparse.coo_matrix((weights, (np.r_[src, dst], np.r_[dst, src])), shape=(n, n)).tocsr()
+        matrix.sum_duplicates()
+        if not sliced:
+            self._matrix = matrix
+        return matrix
+
+    def neighbours(self, artistid, top=None, matrix=None):
+        """
+        Return (artist id, shared releases) for collaborators of an artist,
+        sorted by the number of shared releases
+        - matrix: a sliced matrix to use instead of the whole graph
+        """
+        code = self.codes.get(artistid, self.codes.get(str(artistid)))
+        if code is None:
+            return []
+        if matrix is None:
+            matrix = self.matrix()
+        start, end = matrix.indptr[code], matrix.indptr[code+1]
+        neighbours, weights = matrix.indices[start:end], matrix.data[start:end]
+        order = np.argsort(-weights, kind='mergesort')[:top]
+        return [(self.ids[neighbours[i]], int(weights[i])) for i in order]
+
+    def degree(self, artistid, matrix=None):
+        """Return the number of distinct collaborators of an artist"""
+        code = self.codes.get(artistid, self.codes.get(str(artistid)))
+        if code is None:
+            return 0
+        if matrix is None:
+            matrix = self.matrix()
+        return int(matrix.indptr[code+1] - matrix.indptr[code])
+
+    def degrees(self, matrix=None):
+        """Return the number of distinct collaborators for all artists (aligned with ids)"""
+        if matrix is None:
+            matrix = self.matrix()
+        return np.diff(matrix.indptr)
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Columnar on-disk layout for the release DataFrame produced by
+preprocess_releases_json_to_hdf_pandas.py.
+
+Every column is stored as a raw binary file that can be mapped with
+numpy.memmap, so that several processes can share the same data through the
+page cache instead of each holding a pickled copy of the DataFrame:
+- numeric columns: one value per release
+- categorical columns: one int32 code per release (-1 for missing values)
+- multi-valued columns (lists of genres, styles, formats, artists, labels):
+  CSR layout with int64 offsets (one per release + 1) and int32 codes
+- ragged columns (lists of numbers, e.g., track durations):
+  CSR layout with int64 offsets and float values
+
+Vocabularies and the schema are stored in a json file next to the columns.
+'''
+
+import os
+import json
+import numpy as np
+
+
+# Schema of the release DataFrame
+NUMERIC_COLUMNS = [('@id', 'int64'),
+                   ('master_id', 'int32'),
+                   ('released', 'float64'),
+                   ('tracks_number', 'int32'),
+                   ('tracks_duration', 'float64'),
+                   ('compilation', 'bool'),
+                   ('mixed', 'bool'),
+                   ('unofficial', 'bool')]
+CATEGORICAL_COLUMNS = ['country', '@status']
+MULTIVALUED_COLUMNS = ['genres', 'styles', 'formats', 'artists', 'labels']
+RAGGED_COLUMNS = [('tracks_duration_list', 'float32')]
+
+META_FILE = 'meta.json'
+
+
+def column_filename(name, suffix=None):
+    # '@id' -> 'id.bin', ('styles', 'codes') -> 'styles.codes.bin'
+    name = name.lstrip('@')
+    if suffix:
+        name += '.' + suffix
+    return name + '.bin'
+
+
+def is_null(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def encode_value(value):
+    # styles are (genre, style) tuples, artists may still be dicts with ids
+    if isinstance(value, dict):
+        return value['id']
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def decode_vocab(vocab):
+    # json stores tuples as lists
+    return [tuple(v) if isinstance(v, list) else v for v in vocab]
+
+
+def object_array(values):
+    # np.array() would turn a list of tuples into a 2d array
+    array = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        array[i] = v
+    return array
+
+
+def to_numpy(buffer, dtype):
+    # np.frombuffer fails on empty buffers with older numpy versions
+    if not len(buffer):
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(buffer, dtype=dtype)
+
+
+def encode_multivalued(values):
+    """
+    Dictionary-encode a sequence of lists (e.g., a DataFrame column) into CSR
+    form. Returns (offsets, codes, vocabulary).
+    """
+    vocab = {}
+    counts = np.zeros(len(values), dtype=np.int64)
+    codes = []
+    for i, vv in enumerate(values):
+        if isinstance(vv, (list, tuple)):
+            counts[i] = len(vv)
+            codes.extend(vocab.setdefault(encode_value(v), len(vocab)) for v in vv)
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    vocab_list = [None] * len(vocab)
+    for v, code in vocab.items():
+        vocab_list[code] = v
+    return offsets, np.array(codes, dtype=np.int32), vocab_list
+
+
+def invert_csr(codes, rows, values):
+    """
+    Build an inverted index from (value code, row) pairs: rows of each value
+    are index_rows[index_offsets[code]:index_offsets[code+1]], in row order.
+    Returns (index_offsets, index_rows).
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    order = np.argsort(codes, kind='mergesort')
+    offsets = np.zeros(values + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(codes, minlength=values))
+    return offsets, np.asarray(rows)[order]
+
+
+class ColumnWriter(object):
+    """
+    Write release DataFrames to a columnar layout chunk by chunk.
+    Call append() for every chunk and close() to store vocabularies.
+    """
+
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.length = 0
+        self.vocabs = dict((name, {}) for name in CATEGORICAL_COLUMNS + MULTIVALUED_COLUMNS)
+        self.offsets = dict((name, 0) for name in MULTIVALUED_COLUMNS)
+        self.offsets.update((name, 0) for name, _ in RAGGED_COLUMNS)
+
+        # start all files from scratch, CSR offsets start with 0
+        for name, _ in NUMERIC_COLUMNS:
+            open(self._file(name), 'wb').close()
+        for name in CATEGORICAL_COLUMNS:
+            open(self._file(name), 'wb').close()
+        for name in self.offsets:
+            with open(self._file(name, 'offsets'), 'wb') as f:
+                f.write(np.zeros(1, dtype=np.int64).tobytes())
+            open(self._file(name, 'values'), 'wb').close()
+
+    def _file(self, name, suffix=None):
+        return os.path.join(self.path, column_filename(name, suffix))
+
+    def _write(self, name, array, suffix=None):
+        with open(self._file(name, suffix), 'ab') as f:
+            f.write(np.ascontiguousarray(array).tobytes())
+
+    def _code(self, name, value):
+        vocab = self.vocabs[name]
+        value = encode_value(value)
+        code = vocab.get(value)
+        if code is None:
+            code = len(vocab)
+            vocab[value] = code
+        return code
+
+    def append(self, data):
+        """Append a chunk of releases (a DataFrame)"""
+        n = len(data)
+
+        for name, dtype in NUMERIC_COLUMNS:
+            if name in data:
+                values = data[name]
+                if dtype != 'float64':
+                    values = values.fillna(0)
+                values = values.values.astype(dtype)
+            elif dtype == 'float64':
+                values = np.full(n, np.nan)
+            else:
+                values = np.zeros(n, dtype=dtype)
+            self._write(name, values)
+
+        for name in CATEGORICAL_COLUMNS:
+            codes = np.full(n, -1, dtype=np.int32)
+            if name in data:
+                for i, v in enumerate(data[name]):
+                    if not is_null(v):
+                        codes[i] = self._code(name, v)
+            self._write(name, codes)
+
+        for name in MULTIVALUED_COLUMNS:
+            counts = np.zeros(n, dtype=np.int64)
+            codes = []
+            if name in data:
+                for i, vv in enumerate(data[name]):
+                    if isinstance(vv, (list, tuple)):
+                        counts[i] = len(vv)
+                        codes.extend(self._code(name, v) for v in vv)
+            self._append_csr(name, counts, np.array(codes, dtype=np.int32))
+
+        for name, dtype in RAGGED_COLUMNS:
+            counts = np.zeros(n, dtype=np.int64)
+            values = []
+            if name in data:
+                for i, vv in enumerate(data[name]):
+                    if isinstance(vv, (list, tuple, np.ndarray)):
+                        counts[i] = len(vv)
+                        values.extend(vv)
+            self._append_csr(name, counts, np.array(values, dtype=dtype))
+
+        self.length += n
+
+    def _append_csr(self, name, counts, values):
+        offsets = self.offsets[name] + np.cumsum(counts)
+        if len(offsets):
+            self.offsets[name] = int(offsets[-1])
+        self._write(name, offsets, 'offsets')
+        self._write(name, values, 'values')
+
+    def close(self):
+        """Store the schema and vocabularies"""
+        vocabs = {}
+        for name, vocab in self.vocabs.items():
+            values = [None] * len(vocab)
+            for v, code in vocab.items():
+                values[code] = list(v) if isinstance(v, tuple) else v
+            vocabs[name] = values
+
+        meta = {
+            'length': self.length,
+            'numeric': dict(NUMERIC_COLUMNS),
+            'categorical': CATEGORICAL_COLUMNS,
+            'multivalued': MULTIVALUED_COLUMNS,
+            'ragged': dict(RAGGED_COLUMNS),
+            'values': self.offsets,
+            'vocabs': vocabs,
+        }
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+
+def write_columns(data, path):
+    """Write a release DataFrame to a columnar layout in the 'path' directory"""
+    writer = ColumnWriter(path)
+    writer.append(data)
+    writer.close()
+    return path
+
+
+class ColumnStore(object):
+    """
+    Read-only access to a columnar release layout. Columns are mapped from
+    disk on first access and are never copied into process memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.length = self.meta['length']
+        self._cache = {}
+        self._vocabs = {}
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, name):
+        return name in self.columns()
+
+    def _map(self, name, dtype, length, suffix=None):
+        key = (name, suffix)
+        if key not in self._cache:
+            if length:
+                self._cache[key] = np.memmap(os.path.join(self.path, column_filename(name, suffix)),
+                                             dtype=dtype, mode='r', shape=(length,))
+            else:
+                self._cache[key] = np.zeros(0, dtype=dtype)
+        return self._cache[key]
+
+    def numeric(self, name):
+        """Return values of a numeric column"""
+        return self._map(name, self.meta['numeric'][name], self.length)
+
+    def categorical(self, name):
+        """Return codes of a categorical column (-1 for missing values)"""
+        return self._map(name, 'int32', self.length)
+
+    def multivalued(self, name):
+        """Return (offsets, codes) of a multi-valued column"""
+        offsets = self._map(name, 'int64', self.length + 1, 'offsets')
+        codes = self._map(name, 'int32', self.meta['values'][name], 'values')
+        return offsets, codes
+
+    def ragged(self, name):
+        """Return (offsets, values) of a ragged numeric column"""
+        offsets = self._map(name, 'int64', self.length + 1, 'offsets')
+        values = self._map(name, self.meta['ragged'][name], self.meta['values'][name], 'values')
+        return offsets, values
+
+    def vocab(self, name):
+        """Return the vocabulary of a categorical or multi-valued column"""
+        if name not in self._vocabs:
+            self._vocabs[name] = decode_vocab(self.meta['vocabs'][name])
+        return self._vocabs[name]
+
+    def code(self, name, value):
+        """Return the code for a value in a column vocabulary (None if absent)"""
+        key = ('code', name)
+        if key not in self._cache:
+            self._cache[key] = dict((v, i) for i, v in enumerate(self.vocab(name)))
+        return self._cache[key].get(encode_value(value))
+
+    def row_ids(self, name):
+        """Return the release row for every value of a multi-valued column"""
+        key = ('row_ids', name)
+        if key not in self._cache:
+            offsets = self._map(name, 'int64', self.length + 1, 'offsets')
+            self._cache[key] = np.repeat(np.arange(self.length, dtype=np.int64), np.diff(offsets))
+        return self._cache[key]
+
+    def contains(self, name, value, only=False):
+        """
+        Return a boolean mask of releases that have 'value' in a multi-valued
+        column. Use only=True to select releases with that single value.
+        """
+        mask = np.zeros(self.length, dtype=bool)
+        code = self.code(name, value)
+        if code is None:
+            return mask
+        offsets, codes = self.multivalued(name)
+        mask[self.row_ids(name)[codes == code]] = True
+        if only:
+            mask &= np.diff(offsets) == 1
+        return mask
+
+    def equals(self, name, value):
+        """Return a boolean mask of releases with 'value' in a categorical column"""
+        code = self.code(name, value)
+        if code is None:
+            return np.zeros(self.length, dtype=bool)
+        return self.categorical(name) == code
+
+    # Decoding columns back into pandas objects
+
+    def _slices(self, offsets, values, rows):
+        # gather the values of 'rows' from a CSR column at once, and return
+        # them as a list with the (start, end) of every row in that list
+        lengths = (offsets[rows + 1] - offsets[rows]).astype(np.int64)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        positions = np.arange(ends[-1] if len(ends) else 0, dtype=np.int64)
+        positions += np.repeat(offsets[rows] - starts, lengths)
+        return values[positions], zip(starts.tolist(), ends.tolist())
+
+    def column(self, name, rows=None):
+        """
+        Decode a column into a list of values as stored in the release
+        DataFrame (lists for multi-valued columns, NaN for missing values).
+        - rows: only decode these rows (boolean mask or array of row numbers)
+        """
+        if rows is None:
+            rows = np.arange(self.length)
+        elif np.asarray(rows).dtype == bool:
+            rows = np.flatnonzero(rows)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+
+        if name in self.meta['numeric']:
+            return np.asarray(self.numeric(name)[rows])
+
+        if name in self.meta['categorical']:
+            vocab = object_array(self.vocab(name) + [np.nan])
+            return vocab[np.asarray(self.categorical(name)[rows])]
+
+        if name in self.meta['multivalued']:
+            offsets, values = self.multivalued(name)
+            values, slices = self._slices(offsets, values, rows)
+            values = object_array(self.vocab(name))[values].tolist()
+            return [values[start:end] for start, end in slices]
+
+        if name in self.meta['ragged']:
+            offsets, values = self.ragged(name)
+            values, slices = self._slices(offsets, values, rows)
+            values = values.astype(np.float64).tolist()
+            return [values[start:end] if end > start else np.nan for start, end in slices]
+
+        raise KeyError(name)
+
+    def columns(self):
+        """Return names of all columns in the store"""
+        return sorted(list(self.meta['numeric']) + self.meta['categorical'] +
+                      self.meta['multivalued'] + list(self.meta['ragged']))
+
+    def to_dataframe(self, columns=None, rows=None):
+        """
+        Build a release DataFrame from the store.
+        - columns: only decode these columns (all by default)
+        - rows: only decode these rows (boolean mask or array of row numbers)
+        """
+        import pandas
+        if columns is None:
+            columns = self.columns()
+        return pandas.DataFrame(dict((name, self.column(name, rows)) for name in columns),
+                                columns=columns)
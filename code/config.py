@@ -2,13 +2,23 @@
 # -*- coding: utf-8 -*-
 
 # Configure filenames used to store and process dump for analysis
-import yaml
-import seaborn
 
 dump_url = 'https://discogs-data.s3-us-west-2.amazonaws.com/data/2017/discogs_20170401_releases.xml.gz'
 dump_gz = '../data/discogs_20170401_releases.xml.gz'
 dump_json = '../data/discogs_20170401_releases.json.dump'
 dump_pandas = '../data/discogs_20170401_releases.100.hdf'
+dump_columns = '../data/discogs_20170401_releases.100.columns'
+dump_artist_names = '../data/discogs_20170401_artist_names.json'
+dump_artist_index = '../data/discogs_20170401_releases.100.artists'
+dump_tracks = '../data/discogs_20170401_releases.100.tracks'
+dump_titles = '../data/discogs_20170401_releases.100.titles'
+
+# Dataset statistics sidecars of the json dump and of the loaded dump (see datastats.py)
+dump_json_stats = '../data/discogs_20170401_releases.json.stats'
+dump_stats = '../data/discogs_20170401_releases.100.stats'
+
+# Releases rejected by the conversion of the dump (see quarantine.py)
+dump_quarantine = '../data/discogs_20170401_releases.quarantine.gz'
 
 results_stats = '../results/data_stats.pickle'
 results_duration = '../results/data_duration.pickle'
@@ -19,9 +29,62 @@ results_genre_trends = '../results/data_genre_trends.pickle'
 results_style_trends = '../results/data_style_trends.pickle'
 results_genre_cooccurrences = '../results/results_genre_cooccurrences.pickle'
 results_genre_cooccurrences_by_year = '../results/results_genre_cooccurrences_by_year.pickle'
+results_benchmark = '../results/benchmark_baseline.json'
+results_report = '../results/report'
+
+# Fingerprints of up to date pipeline stages (see pipeline.py)
+pipeline_state = '../results/pipeline.json'
+
+# Performance metrics outputs (see metrics.py), set to None to disable
+metrics_log = '../results/metrics.jsonl'
+metrics_prometheus = None
+
+# Local analytics query service (see server.py), only listens on localhost
+server_port = 8642
+server_threads = 8
+server_cache_size = 256
 
 # Discogs genre tree
-GENRE_TREE = yaml.load(open('../taxonomy/discogs_taxonomy.yaml'))
+taxonomy = '../taxonomy/discogs_taxonomy.yaml'
+
+
+class _GenreTree(object):
+    """Discogs genre tree (genre -> list of styles), loaded on first access"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tree = None
+
+    def load(self):
+        if self.tree is None:
+            import yaml
+            self.tree = yaml.safe_load(open(self.filename))
+        return self.tree
+
+    def __getitem__(self, genre):
+        return self.load()[genre]
+
+    def __contains__(self, genre):
+        return genre in self.load()
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __getattr__(self, name):
+        # dict methods (keys, items, get, ...)
+        if name.startswith('_') or name in ('filename', 'tree'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return repr(self.load())
+
+
+GENRE_TREE = _GenreTree(taxonomy)
+
 
 # The list of genre to ignore in the analysis.
 # For the sake of simplicity, we don't want some genres that are very
@@ -41,5 +104,6 @@ PLOT_LARGE = False
 
 # Plotting helper function
 def prepare_colors(number):
+    import seaborn
     return seaborn.color_palette("hls", number)
 
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Materialized cube of releases over (country, year, genre or style, format)
+for regional trends.
+
+The cube is built in one vectorized pass over encoded release columns. Each
+cell holds the number of releases and tracks. Releases have several genres
+(styles) and formats, so these dimensions also have an "all" member (-1)
+counting every release once. Country and year have a single value per
+release (-1 if unknown), so rollups over countries (e.g., regions) and years
+(e.g., decades) are sums of cells.
+
+Distinct artists can't be summed across cells. The cube keeps the unique
+(country, year, genre, artist) combinations for all formats, and counts
+distinct artists of any rollup from them.
+
+Cubes are saved to a single .npz file.
+'''
+
+import json
+import numpy as np
+import pandas
+
+from columnar import ColumnStore, encode_multivalued, decode_vocab
+from labels import release_rows
+from tracks import csr_take
+
+
+DIMENSIONS = ['country', 'region', 'year', 'decade', 'genre', 'format']
+MEASURES = ['releases', 'tracks', 'artists']
+
+
+def release_columns(data, type):
+    """
+    Return encoded columns of releases: country codes, years, tracks, and
+    (offsets, codes, vocabulary) for genres (styles), formats and artists
+    """
+    genre_column = 'genres' if type == 'genre' else 'styles'
+    if isinstance(data, ColumnStore):
+        countries = np.asarray(data.categorical('country'), dtype=np.int64)
+        country_vocab = data.vocab('country')
+        released = np.asarray(data.numeric('released'))
+        tracks = np.nan_to_num(np.asarray(data.numeric('tracks_number'), dtype=np.float64)).astype(np.int64)
+        lists = [tuple(np.asarray(a) for a in data.multivalued(name)) + (data.vocab(name),)
+                 for name in [genre_column, 'formats', 'artists']]
+    else:
+        codes, country_vocab = pandas.factorize(data['country'])
+        countries = codes.astype(np.int64)
+        country_vocab = list(country_vocab)
+        released = data['released'].values.astype(np.float64)
+        tracks = np.nan_to_num(data['tracks_number'].values.astype(np.float64)).astype(np.int64)
+        lists = [encode_multivalued(data[name].values) for name in [genre_column, 'formats', 'artists']]
+
+    years = np.where(np.isnan(released), -1, np.nan_to_num(released)).astype(np.int64)
+    return countries, country_vocab, years, tracks, lists
+
+
+def with_all(offsets, codes):
+    """
+    Unique (release, code) pairs of a CSR column plus an "all" (-1) pair for
+    every release, sorted by release. Returns (offsets, codes).
+    """
+    releases = len(offsets) - 1
+    rows = np.r_[release_rows(offsets), np.arange(releases)]
+    values = np.r_[np.asarray(codes, dtype=np.int64), np.full(releases, -1, dtype=np.int64)]
+    # codes shifted by one so that "all" sorts first
+    width = values.max() + 2 if len(values) else 1
+    pairs = np.unique(rows * width + values + 1)
+    rows, values = pairs // width, pairs % width - 1
+    offsets = np.zeros(releases + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(rows, minlength=releases))
+    return offsets, values
+
+
+class ReleaseCube(object):
+    """
+    Cube of releases (see the module description)
+    - type: "genre" or "style"
+    - cells: DataFrame with country, year, genre, format codes and
+      releases and tracks measures
+    - artists: DataFrame of unique country, year, genre codes and artist codes
+    - countries, genres, formats: vocabularies of codes
+    """
+
+    def __init__(self, type, cells, artists, countries, genres, formats):
+        self.type = type
+        self.cells = cells
+        self.artists = artists
+        self.countries = countries
+        self.genres = genres
+        self.formats = formats
+
+    @classmethod
+    def build(cls, data, type='genre'):
+        """Build the cube for releases (a DataFrame or a ColumnStore)"""
+        countries, country_vocab, years, tracks, lists = release_columns(data, type)
+        (g_offsets, g_codes, genres), (f_offsets, f_codes, formats), (a_offsets, a_codes, _) = lists
+
+        # (release, genre) x (release, format) combinations of every release
+        g_offsets, g_codes = with_all(g_offsets, g_codes)
+        f_offsets, f_codes = with_all(f_offsets, f_codes)
+        g_releases = release_rows(g_offsets)
+        _, f_elements = csr_take(f_offsets, g_releases)
+        g_elements = np.repeat(np.arange(len(g_codes)), np.diff(f_offsets)[g_releases])
+        releases = g_releases[g_elements]
+
+        cells = pandas.DataFrame({
+            'country': countries[releases],
+            'year': years[releases],
+            'genre': g_codes[g_elements],
+            'format': f_codes[f_elements],
+            'tracks': tracks[releases],
+        })
+        cells['releases'] = 1
+        cells = cells.groupby(['country', 'year', 'genre', 'format'], sort=True).sum().reset_index()
+
+        # unique (country, year, genre, artist) combinations
+        _, a_elements = csr_take(a_offsets, g_releases)
+        a_genres = np.repeat(np.arange(len(g_codes)), np.diff(a_offsets)[g_releases])
+        a_releases = g_releases[a_genres]
+        artists = pandas.DataFrame({
+            'country': countries[a_releases],
+            'year': years[a_releases],
+            'genre': g_codes[a_genres],
+            'artist': np.asarray(a_codes, dtype=np.int64)[a_elements],
+        }).drop_duplicates()
+
+        return cls(type, cells, artists, list(country_vocab), list(genres), list(formats))
+
+    def save(self, filename):
+        """Save the cube to a .npz file"""
+        arrays = dict(('cells_' + c, self.cells[c].values) for c in self.cells.columns)
+        arrays.update(('artists_' + c, self.artists[c].values) for c in self.artists.columns)
+        meta = {'type': self.type, 'countries': self.countries, 'genres': self.genres, 'formats': self.formats}
+        np.savez(filename, meta=np.array([json.dumps(meta)]), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a cube saved with save()"""
+        f = np.load(filename)
+        meta = json.loads(str(f['meta'][0]))
+        cells = pandas.DataFrame(dict((k[len('cells_'):], f[k]) for k in f.files if k.startswith('cells_')))
+        artists = pandas.DataFrame(dict((k[len('artists_'):], f[k]) for k in f.files if k.startswith('artists_')))
+        return cls(meta['type'], cells, artists, meta['countries'],
+                   decode_vocab(meta['genres']), meta['formats'])
+
+    def _codes(self, vocab, values):
+        if not isinstance(values, list):
+            values = [values]
+        lookup = dict((v, i) for i, v in enumerate(vocab))
+        return [lookup.get(v, -2) for v in values]
+
+    def _labels(self, table, dimension, regions):
+        # group labels of cells (or artist combinations) for a dimension
+        if dimension == 'year':
+            return table['year'].values
+        if dimension == 'decade':
+            years = table['year'].values
+            return np.where(years < 0, -1, years // 10 * 10)
+        if dimension in ['country', 'region']:
+            names = np.array(self.countries + [None], dtype=object)
+            if dimension == 'region':
+                regions = regions or {}
+                names = np.array([regions.get(c, 'Other') for c in self.countries] + ['Other'], dtype=object)
+            return names[table['country'].values]
+        vocab = self.genres if dimension == 'genre' else self.formats
+        names = np.empty(len(vocab) + 1, dtype=object)
+        names[:-1] = [v if not isinstance(v, tuple) else '%s - %s' % v for v in vocab]
+        return names[table[dimension].values]
+
+    def _mask(self, table, by, country, genre, format, start_year, end_year):
+        mask = np.ones(len(table), dtype=bool)
+        for dimension, value, vocab in [('genre', genre, self.genres), ('format', format, self.formats)]:
+            if dimension not in table:
+                continue
+            if value is not None:
+                mask &= np.isin(table[dimension].values, self._codes(vocab, value))
+            elif dimension not in by:
+                mask &= table[dimension].values == -1
+            else:
+                mask &= table[dimension].values >= 0
+        if country is not None:
+            mask &= np.isin(table['country'].values, self._codes(self.countries, country))
+        if start_year is not None:
+            mask &= table['year'].values >= start_year
+        if end_year is not None:
+            mask &= (table['year'].values <= end_year) & (table['year'].values >= 0)
+        return mask
+
+    def query(self, measure='releases', by=['year'], country=None, genre=None, format=None,
+              start_year=None, end_year=None, regions=None):
+        """
+        Aggregate a measure over slices of the cube
+        - measure: "releases", "tracks" or "artists" (distinct artists)
+        - by: dimensions to group by among "country", "region", "year",
+          "decade", "genre" (genre or style) and "format"
+        - country, genre, format: only consider these values (a value or a list)
+        - start_year, end_year: only consider releases from these years
+        - regions: dict of country -> region for the "region" dimension
+          (other countries are grouped as "Other")
+        Returns a DataFrame with a column per dimension and the measure.
+        """
+        if measure not in MEASURES:
+            raise ValueError("Unknown measure %s" % measure)
+        for dimension in by:
+            if dimension not in DIMENSIONS:
+                raise ValueError("Unknown dimension %s" % dimension)
+        if measure == 'artists' and (format is not None or 'format' in by):
+            raise ValueError("Distinct artists are only available for all formats")
+
+        table = self.artists if measure == 'artists' else self.cells
+        table = table[self._mask(table, by, country, genre, format, start_year, end_year)]
+        groups = dict((dimension, self._labels(table, dimension, regions)) for dimension in by)
+
+        if measure == 'artists':
+            groups['artist'] = table['artist'].values
+            result = pandas.DataFrame(groups).drop_duplicates()
+            if not by:
+                return pandas.DataFrame({'artists': [len(result)]})
+            return result.groupby(list(by), sort=True).size().reset_index(name='artists')
+
+        groups[measure] = table[measure].values
+        result = pandas.DataFrame(groups)
+        if not by:
+            return pandas.DataFrame({measure: [result[measure].sum()]})
+        return result.groupby(list(by), sort=True)[measure].sum().reset_index()
+
+    def top_countries(self, top=10, measure='releases', genre=None, format=None,
+                      start_year=None, end_year=None):
+        """Return the 'top' countries by a measure (e.g., for a genre)"""
+        result = self.query(measure, ['country'], genre=genre, format=format,
+                            start_year=start_year, end_year=end_year)
+        result = result[result['country'].notnull()]
+        return result.sort_values(measure, ascending=False)[:top].reset_index(drop=True)
+
+    def trends(self, measure='releases', by='country', countries=None, genre=None, format=None,
+               start_year=None, end_year=None, regions=None, period='year'):
+        """
+        Return trends as a table of years (or decades) x countries (regions,
+        genres or formats) for plotting
+        - by: "country", "region", "genre" or "format"
+        - period: "year" or "decade"
+        """
+        result = self.query(measure, [period, by], country=countries, genre=genre, format=format,
+                            start_year=start_year, end_year=end_year, regions=regions)
+        result = result[result[period] >= 0]
+        return result.pivot(index=period, columns=by, values=measure).fillna(0)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Dataset statistics accumulated while releases are streamed.
+
+StatsAccumulator collects, in the same pass that converts the XML dump and
+loads the json dump, everything analyze.releases_stats computes by scanning a
+loaded DataFrame:
+- vocabularies of genres, styles, formats and countries with release counts
+- totals of releases and tracks, and of unofficial, compilation and mixed
+  releases and tracks
+- number of releases annotated by duration and their total duration
+- a HyperLogLog sketch of the number of distinct artists (ArtistSketch,
+  about 1% relative error with the default 2^14 registers)
+
+Statistics are saved to a json sidecar next to the dump (config.dump_stats),
+so that releases_stats(stats_file=dump_stats) returns them instantly without
+touching the data. Accumulators of parts of a dump can be merged.
+'''
+
+import json
+import zlib
+import base64
+import numpy as np
+
+
+COUNTED = ['genres', 'styles', 'formats', 'countries']
+TOTALS = ['releases', 'tracks', 'with_duration', 'duration',
+          'unofficial_releases', 'unofficial_tracks',
+          'compilation_releases', 'compilation_tracks',
+          'mixed_releases', 'mixed_tracks']
+
+
+def artist_key(artist):
+    # artist ids are numbers, other ids are hashed above the range of ids
+    try:
+        return int(artist)
+    except (TypeError, ValueError):
+        return (zlib.crc32(artist.encode('utf-8')) & 0xffffffff) | (1 << 40)
+
+
+def mix64(x):
+    """splitmix64 finalizer of uint64 values"""
+    x = x + np.uint64(0x9e3779b97f4a7c15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def bit_length(x):
+    """Number of significant bits of uint64 values"""
+    length = np.zeros(len(x), dtype=np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        high = (x >> np.uint64(shift)) > 0
+        length[high] += shift
+        x = np.where(high, x >> np.uint64(shift), x)
+    return length + (x > 0)
+
+
+class ArtistSketch(object):
+    """
+    HyperLogLog sketch of the number of distinct artists
+    - precision: log2 of the number of registers (relative error is about
+      1.04 / sqrt(2^precision))
+    """
+
+    BATCH = 100000
+
+    def __init__(self, precision=14, registers=None):
+        self.precision = precision
+        if registers is None:
+            registers = np.zeros(1 << precision, dtype=np.uint8)
+        self.registers = registers
+        self.pending = []
+
+    def add(self, artists):
+        self.pending.extend(artist_key(a) for a in artists)
+        if len(self.pending) >= self.BATCH:
+            self.flush()
+
+    def flush(self):
+        """Hash pending artists into the registers"""
+        if not self.pending:
+            return
+        hashes = mix64(np.array(self.pending, dtype=np.uint64))
+        self.pending = []
+        bits = 64 - self.precision
+        index = (hashes >> np.uint64(bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << bits) - 1)
+        # position of the first 1 bit of the remaining bits
+        rank = (bits - bit_length(rest) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        other.flush()
+        self.flush()
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        """Estimated number of distinct artists"""
+        self.flush()
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.power(2., -self.registers.astype(np.float64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small numbers
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+class StatsAccumulator(object):
+    """
+    Statistics of a stream of releases (see the module description)
+    - counts: dict of vocabulary (COUNTED) -> dict of value -> number of releases
+    - totals: dict of TOTALS, durations in seconds
+    - artists: ArtistSketch of distinct artists
+    """
+
+    def __init__(self, counts=None, totals=None, artists=None):
+        self.counts = counts or dict((c, {}) for c in COUNTED)
+        self.totals = totals or dict((t, 0) for t in TOTALS)
+        self.artists = artists or ArtistSketch()
+
+    def count(self, vocabulary, values):
+        counts = self.counts[vocabulary]
+        for v in set(values):
+            counts[v] = counts.get(v, 0) + 1
+
+    def add(self, release):
+        """
+        Add a release, a dict with 'genres', 'styles', 'formats' and 'artists'
+        (ids) lists, 'country', 'tracks_number', 'tracks_duration' (seconds,
+        None if not all tracks have a duration) and 'compilation', 'mixed'
+        and 'unofficial' flags
+        """
+        totals = self.totals
+        tracks = release.get('tracks_number') or 0
+        totals['releases'] += 1
+        totals['tracks'] += tracks
+        if release.get('tracks_duration') is not None:
+            totals['with_duration'] += 1
+            totals['duration'] += release['tracks_duration']
+        for flag in ['unofficial', 'compilation', 'mixed']:
+            if release.get(flag):
+                totals[flag + '_releases'] += 1
+                totals[flag + '_tracks'] += tracks
+
+        self.count('genres', release.get('genres') or [])
+        self.count('styles', release.get('styles') or [])
+        self.count('formats', release.get('formats') or [])
+        if release.get('country'):
+            self.count('countries', [release['country']])
+        self.artists.add(release.get('artists') or [])
+
+    def merge(self, other):
+        """Add statistics of another accumulator"""
+        for vocabulary in COUNTED:
+            counts = self.counts[vocabulary]
+            for v, c in other.counts[vocabulary].items():
+                counts[v] = counts.get(v, 0) + c
+        for t in TOTALS:
+            self.totals[t] += other.totals[t]
+        self.artists.merge(other.artists)
+
+    def summary(self):
+        """Statistics in the format of analyze.releases_stats"""
+        totals = self.totals
+        stats = {}
+
+        stats['all_genres'] = sorted(self.counts['genres'])
+        stats['all_styles'] = sorted(self.counts['styles'])
+        stats['all_formats'] = sorted(self.counts['formats'])
+        stats['all_countries'] = sorted(self.counts['countries'])
+
+        stats['total_genres'] = len(stats['all_genres'])
+        stats['total_styles'] = len(stats['all_styles'])
+        stats['total_formats'] = len(stats['all_formats'])
+        stats['total_countries'] = len(stats['all_countries'])
+
+        stats['total_releases'] = totals['releases']
+        stats['total_tracks'] = totals['tracks']
+        stats['total_artists'] = self.artists.count()
+
+        stats['releases_annotated_by_duration (%)'] = 100. * totals['with_duration'] / max(totals['releases'], 1)
+        stats['total_duration_days'] = totals['duration'] / 60. / 60. / 24.
+        stats['total_duration_years'] = 0.00273973 * stats['total_duration_days']
+
+        stats['total_releases_unofficial'] = totals['unofficial_releases']
+        stats['total_tracks_unofficial'] = totals['unofficial_tracks']
+
+        stats['total_releases_compilation'] = totals['compilation_releases']
+        stats['total_tracks_compilatioñn'] = totals['compilation_tracks']
+
+        stats['total_releases_mixed'] = totals['mixed_releases']
+        stats['total_tracks_mixed'] = totals['mixed_tracks']
+
+        return stats
+
+    def save(self, filename):
+        """Save statistics to a json sidecar"""
+        self.artists.flush()
+        values = {
+            'totals': self.totals,
+            'counts': dict((v, sorted([k, c] for k, c in self.counts[v].items())) for v in COUNTED),
+            'artists': {'precision': self.artists.precision,
+                        'registers': base64.b64encode(self.artists.registers.tobytes()).decode('ascii')},
+        }
+        with open(filename, 'w') as f:
+            json.dump(values, f)
+
+    @classmethod
+    def load(cls, filename):
+        """Load statistics saved with save()"""
+        with open(filename, 'r') as f:
+            values = json.load(f)
+        # styles are (genre, style) tuples, json only has lists
+        counts = dict((v, dict((tuple(k) if isinstance(k, list) else k, c) for k, c in values['counts'][v]))
+                      for v in COUNTED)
+        registers = np.frombuffer(base64.b64decode(values['artists']['registers']), dtype=np.uint8).copy()
+        return cls(counts, values['totals'], ArtistSketch(values['artists']['precision'], registers))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Style embeddings for similarity and nearest-neighbour search.
+
+Every style (or genre) is described by feature blocks computed in one pass
+over releases with sparse release x category matrices:
+- co-occurrence: share of releases of the style also annotated with every
+  other style
+- durations: quantiles of track durations (standardized across styles)
+- formats: share of releases of the style in every format
+- countries: share of releases of the style from the 'countries' most
+  frequent countries (other countries are grouped)
+
+Each block is L2-normalized and weighted, the blocks are concatenated and
+projected to 'dimensions' components with a truncated SVD, and the rows are
+L2-normalized into a float32 matrix. Cosine similarity is then a dot product,
+and the top-k neighbours of a style are found with a single matrix-vector
+product and a partial sort.
+
+Raw duration quantiles are kept to plot styles by median duration and IQR
+without scanning releases (see analyze.plot_track_durations_2d).
+'''
+
+import json
+import numpy as np
+
+from columnar import ColumnStore
+from bootstrap import category_pairs, release_durations, sorted_quantiles
+from tracks import csr_take
+
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+BLOCKS = ['cooccurrence', 'durations', 'formats', 'countries']
+
+
+def incidence(rows, codes, releases, number):
+    """Sparse releases x categories matrix of (release, category) pairs"""
+    from scipy import sparse
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, codes)),
+                             shape=(releases, number))
+
+
+def normalize_rows(matrix):
+    norms = np.sqrt((matrix * matrix).sum(axis=1))
+    return matrix / np.where(norms > 0, norms, 1)[:, None]
+
+
+def country_pairs(data, countries):
+    """(release, country index) pairs for the most frequent countries, others grouped last"""
+    if isinstance(data, ColumnStore):
+        codes = np.asarray(data.categorical('country'), dtype=np.int64)
+        vocab = data.vocab('country')
+    else:
+        import pandas
+        codes, vocab = pandas.factorize(data['country'])
+        codes = codes.astype(np.int64)
+        vocab = list(vocab)
+    known = codes >= 0
+    frequency = np.bincount(codes[known], minlength=len(vocab))
+    top = np.argsort(-frequency, kind='mergesort')[:countries]
+    mapping = np.full(len(vocab), len(top), dtype=np.int64)
+    mapping[top] = np.arange(len(top))
+    rows = np.flatnonzero(known)
+    return rows, mapping[codes[rows]], [vocab[c] for c in top] + ['Other']
+
+
+def duration_profiles(data, type, categories):
+    """Quantiles of track durations per category (categories x QUANTILES, NaN if none)"""
+    rows, codes, categories = category_pairs(data, type, categories)
+    d_offsets, durations = release_durations(data)
+    pair_offsets, elements = csr_take(d_offsets, rows)
+    cells = np.repeat(codes, np.diff(pair_offsets))
+    values = durations[elements]
+    valid = ~np.isnan(values)
+    cells, values = cells[valid], values[valid]
+    order = np.lexsort((values, cells))
+    offsets = np.zeros(len(categories) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(cells, minlength=len(categories)))
+    profiles = np.array([sorted_quantiles(offsets, values[order], q) for q in QUANTILES]).T
+    return profiles, np.diff(offsets)
+
+
+class StyleEmbedding(object):
+    """
+    Embedding of styles (or genres), see the module description
+    - names: styles ((genre, style) tuples) or genres
+    - vectors: float32 matrix of L2-normalized embeddings
+    - durations: duration quantiles per style (QUANTILES)
+    - releases, tracks: number of releases and of tracks with durations per style
+    """
+
+    def __init__(self, names, vectors, durations, releases, tracks):
+        self.names = names
+        self.vectors = vectors
+        self.durations = durations
+        self.releases = releases
+        self.tracks = tracks
+        self.codes = dict((n, i) for i, n in enumerate(names))
+
+    @classmethod
+    def build(cls, data, type='style', names=None, countries=50, dimensions=64, weights=None,
+              min_releases=1):
+        """
+        Build embeddings from releases (a DataFrame or a ColumnStore)
+        - type: "style" or "genre"
+        - names: only embed these styles (genres), all by default
+        - countries: number of most frequent countries in the country mix
+        - dimensions: number of SVD components kept
+        - weights: dict of weights of feature blocks (BLOCKS, 1 by default)
+        - min_releases: skip styles with fewer releases
+        """
+        rows, codes, names = category_pairs(data, type, names)
+        releases = np.bincount(codes, minlength=len(names))
+        keep = np.flatnonzero(releases >= max(min_releases, 1))
+        if len(keep) < len(names):
+            names = [names[i] for i in keep]
+            rows, codes, names = category_pairs(data, type, names)
+            releases = np.bincount(codes, minlength=len(names))
+        styles = incidence(rows, codes, len(data), len(names))
+        counts = np.maximum(releases, 1).astype(np.float64)[:, None]
+
+        blocks = {}
+        cooccurrence = np.asarray((styles.T * styles).todense()) / counts
+        np.fill_diagonal(cooccurrence, 0)
+        blocks['cooccurrence'] = cooccurrence
+
+        f_rows, f_codes, formats = category_pairs(data, 'format')
+        formats = incidence(f_rows, f_codes, len(data), len(formats))
+        blocks['formats'] = np.asarray((styles.T * formats).todense()) / counts
+
+        c_rows, c_codes, vocab = country_pairs(data, countries)
+        countries = incidence(c_rows, c_codes, len(data), len(vocab))
+        blocks['countries'] = np.asarray((styles.T * countries).todense()) / counts
+
+        durations, tracks = duration_profiles(data, type, names)
+        known = ~np.isnan(durations[:, 0])
+        standardized = np.zeros_like(durations)
+        if known.any():
+            mean = durations[known].mean(axis=0)
+            std = durations[known].std(axis=0)
+            standardized[known] = (durations[known] - mean) / np.where(std > 0, std, 1)
+        blocks['durations'] = standardized
+
+        features = np.hstack([(weights or {}).get(b, 1.) * normalize_rows(blocks[b]) for b in BLOCKS])
+        # truncated SVD keeps the directions with the most variance across styles
+        u, s, _ = np.linalg.svd(features, full_matrices=False)
+        vectors = normalize_rows(u[:, :dimensions] * s[:dimensions]).astype(np.float32)
+        return cls(names, vectors, durations, releases, tracks)
+
+    def save(self, filename):
+        """Save embeddings to a .npz file"""
+        np.savez(filename, vectors=self.vectors, durations=self.durations,
+                 releases=self.releases, tracks=self.tracks,
+                 names=np.array([json.dumps(self.names)]))
+
+    @classmethod
+    def load(cls, filename):
+        """Load embeddings saved with save()"""
+        f = np.load(filename)
+        names = [tuple(n) if isinstance(n, list) else n for n in json.loads(str(f['names'][0]))]
+        return cls(names, f['vectors'], f['durations'], f['releases'], f['tracks'])
+
+    def __contains__(self, name):
+        return name in self.codes
+
+    def vector(self, name):
+        return self.vectors[self.codes[name]]
+
+    def similarity(self, a, b):
+        """Cosine similarity of two styles"""
+        return float(self.vector(a).dot(self.vector(b)))
+
+    def neighbours(self, name, top=10):
+        """Return (style, cosine similarity) for the 'top' most similar styles"""
+        code = self.codes[name]
+        scores = self.vectors.dot(self.vectors[code])
+        scores[code] = -np.inf
+        top = min(top, len(scores) - 1)
+        if top <= 0:
+            return []
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best], kind='mergesort')]
+        return [(self.names[i], float(scores[i])) for i in best]
+
+    def duration_stats(self):
+        """
+        Median and IQR of track durations per style, as in the output of
+        analyze.track_duration_per_genre (without the durations)
+        """
+        stats = {}
+        q = dict((v, i) for i, v in enumerate(QUANTILES))
+        for name, profile, count in zip(self.names, self.durations, self.tracks):
+            if np.isnan(profile[0]):
+                continue
+            stats[name] = {'median': profile[q[0.5]], 'iqr': profile[q[0.75]] - profile[q[0.25]],
+                           '5%': profile[q[0.05]], '95%': profile[q[0.95]],
+                           '95vs5': profile[q[0.95]] - profile[q[0.05]],
+                           'p25': profile[q[0.25]], 'p75': profile[q[0.75]], 'tracks': count}
+        return stats
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Incremental update of the processed release dataset from a new dump.
+
+Most releases are unchanged between monthly Discogs dumps. Instead of
+loading the whole new json dump, every json line is hashed (without
+decoding it) and compared with the hashes of the previous dump by release
+id. Both id/hash columns are sorted, and a merge join finds added, changed
+and deleted releases. Only added and changed releases are loaded with
+load_releases. The delta is then applied to the stored dataset: deleted and
+changed releases are dropped and the reloaded ones are merged in.
+
+Aggregates stored in an AggregateCache declare the releases they depend on
+(genre, style, format, country and year range). Only aggregates that depend
+on releases in the delta are invalidated.
+
+Usage:
+    python incremental.py --json NEW_JSON --hashes OLD_HASHES --dataset OLD_DATASET
+                          --output NEW_DATASET --output-hashes NEW_HASHES
+                          [--results-cache DIR]
+
+The XML to json conversion (preprocess_releases_xml_to_json.py) still runs
+on the whole new dump. When the configured dataset (dump_pandas or
+dump_columns) is updated, the outputs built along with it that no longer
+match its rows (dataset statistics, track table, title index, artist index)
+are removed, so that they are not used with the updated dataset; rebuild
+them with the pipeline (python pipeline.py --force load).
+'''
+
+import os
+import re
+import json
+import pickle
+import shutil
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+import pandas
+
+from config import *
+from preprocess_releases_json_to_hdf_pandas import load_releases
+import metrics
+
+
+RELEASE_ID = re.compile(br'"@id": "(\d+)"')
+
+
+def release_id(line):
+    # releases are written as plain dicts, so '@id' can be anywhere in the
+    # line: avoid decoding it unless nested values also have an '@id' key
+    matches = RELEASE_ID.findall(line)
+    if len(matches) == 1:
+        return int(matches[0])
+    return int(json.loads(line.decode('utf-8'))['@id'])
+
+
+def hash_dump(json_dump):
+    """
+    Hash every release of a json dump. Returns arrays of release ids, 64-bit
+    content hashes and line numbers, sorted by release id.
+    """
+    ids = []
+    digests = []
+    with open(json_dump, 'rb') as f:
+        for line in f:
+            ids.append(release_id(line))
+            digests.append(hashlib.md5(line.rstrip(b'\n')).digest()[:8])
+
+    ids = np.array(ids, dtype=np.int64)
+    hashes = np.frombuffer(b''.join(digests), dtype='<u8') if digests else np.zeros(0, dtype='<u8')
+    lines = np.arange(len(ids), dtype=np.int64)
+    order = np.argsort(ids, kind='mergesort')
+    return ids[order], hashes[order], lines[order]
+
+
+def save_hashes(filename, ids, hashes, lines):
+    np.savez(filename, ids=ids, hashes=hashes, lines=lines)
+
+
+def load_hashes(filename):
+    f = np.load(filename)
+    return f['ids'], f['hashes'], f['lines']
+
+
+def diff_dumps(old_ids, old_hashes, new_ids, new_hashes):
+    """
+    Merge join two dumps sorted by release id. Returns boolean masks over the
+    new dump (added, changed) and the ids of deleted releases.
+    """
+    # position of each new id among old ids
+    positions = np.searchsorted(old_ids, new_ids)
+    found = positions < len(old_ids)
+    found[found] = old_ids[positions[found]] == new_ids[found]
+
+    added = ~found
+    changed = np.zeros(len(new_ids), dtype=bool)
+    changed[found] = old_hashes[positions[found]] != new_hashes[found]
+
+    kept = np.zeros(len(old_ids), dtype=bool)
+    kept[positions[found]] = True
+    return added, changed, old_ids[~kept]
+
+
+def extract_lines(json_dump, lines, output_json):
+    """Copy the specified lines of a json dump to another file"""
+    selected = np.zeros(lines.max() + 1 if len(lines) else 0, dtype=bool)
+    selected[lines] = True
+    with open(json_dump, 'rb') as f, open(output_json, 'wb') as out:
+        for i, line in enumerate(f):
+            if i >= len(selected):
+                break
+            if selected[i]:
+                out.write(line)
+
+
+def numeric_ids(data):
+    return data['@id'].values.astype(np.int64)
+
+
+def apply_delta(data, removed_ids, releases):
+    """
+    Drop releases with 'removed_ids' from data and merge in 'releases'
+    (a DataFrame), keeping releases sorted by id
+    """
+    keep = ~np.isin(numeric_ids(data), removed_ids)
+    updated = pandas.concat([data[keep], releases], ignore_index=True)
+    order = np.argsort(numeric_ids(updated), kind='mergesort')
+    return updated.iloc[order].reset_index(drop=True)
+
+
+def update_dataset(data, old_hashes, json_dump, ignore_genres=IGNORE_GENRES):
+    """
+    Update a processed release DataFrame to a new json dump
+    - data: release DataFrame processed from the previous dump
+    - old_hashes: (ids, hashes, lines) of the previous dump (see hash_dump)
+    - json_dump: new json dump
+    Returns the updated DataFrame, the hashes of the new dump and the delta:
+    releases that were removed or reloaded (a DataFrame, to invalidate
+    aggregates) and counts of added, changed and deleted releases.
+    """
+    old_ids, old_hash_values, _ = old_hashes
+    with metrics.stage('hash_dump'):
+        new_ids, new_hash_values, new_lines = hash_dump(json_dump)
+    with metrics.stage('diff_dumps', items=len(new_ids)):
+        added, changed, deleted = diff_dumps(old_ids, old_hash_values, new_ids, new_hash_values)
+    counts = {'added': int(added.sum()), 'changed': int(changed.sum()),
+              'deleted': len(deleted), 'unchanged': int(len(new_ids) - added.sum() - changed.sum())}
+    print("%(added)d added, %(changed)d changed, %(deleted)d deleted, %(unchanged)d unchanged releases" % counts)
+
+    reload = added | changed
+    releases = None
+    if reload.any():
+        fd, delta_json = tempfile.mkstemp(suffix='.json.dump')
+        os.close(fd)
+        try:
+            extract_lines(json_dump, np.sort(new_lines[reload]), delta_json)
+            releases = load_releases(input_dump=delta_json, ignore_genres=ignore_genres)
+        finally:
+            os.remove(delta_json)
+    if releases is None:
+        releases = data.iloc[:0]
+
+    removed_ids = np.concatenate([deleted, new_ids[changed]])
+    removed = data[np.isin(numeric_ids(data), removed_ids)]
+    with metrics.stage('apply_delta', items=len(removed) + len(releases)):
+        updated = apply_delta(data, removed_ids, releases)
+
+    delta = pandas.concat([removed, releases], ignore_index=True)
+    return updated, (new_ids, new_hash_values, new_lines), delta, counts
+
+
+# Cached aggregates
+
+def scope_mask(releases, scope):
+    """Boolean mask of releases within the scope of an aggregate"""
+    mask = np.ones(len(releases), dtype=bool)
+    if scope.get('genre'):
+        mask &= releases['genres'].apply(lambda x: scope['genre'] in x).values
+    if scope.get('style'):
+        style = tuple(scope['style'])
+        mask &= releases['styles'].apply(lambda x: style in [tuple(s) for s in x]).values
+    if scope.get('format'):
+        mask &= releases['formats'].apply(lambda x: scope['format'] in x).values
+    if scope.get('country'):
+        mask &= (releases['country'] == scope['country']).values
+    if scope.get('start_year') is not None:
+        mask &= (releases['released'] >= scope['start_year']).values
+    if scope.get('end_year') is not None:
+        mask &= (releases['released'] <= scope['end_year']).values
+    return mask
+
+
+class AggregateCache(object):
+    """
+    Pickled aggregates in a directory, each stored with the scope of releases
+    it depends on (genre, style, format, country, start_year, end_year; an
+    empty scope depends on all releases)
+    """
+
+    INDEX = 'index.json'
+
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.scopes = {}
+        if os.path.isfile(os.path.join(path, self.INDEX)):
+            with open(os.path.join(path, self.INDEX), 'r') as f:
+                self.scopes = json.load(f)
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.pickle')
+
+    def _save_index(self):
+        with open(os.path.join(self.path, self.INDEX), 'w') as f:
+            json.dump(self.scopes, f, indent=2, sort_keys=True)
+
+    def __contains__(self, name):
+        return name in self.scopes
+
+    def get(self, name):
+        with open(self._file(name), 'rb') as f:
+            return pickle.load(f)
+
+    def put(self, name, value, **scope):
+        with open(self._file(name), 'wb') as f:
+            pickle.dump(value, f, protocol=2)
+        self.scopes[name] = scope
+        self._save_index()
+
+    def cached(self, name, func, *args, **kwargs):
+        """
+        Return the aggregate 'name', computing it as func(*args, **kwargs)
+        if it is not cached. Pass its scope as a 'scope' keyword argument.
+        """
+        scope = kwargs.pop('scope', {})
+        if name in self:
+            return self.get(name)
+        value = func(*args, **kwargs)
+        self.put(name, value, **scope)
+        return value
+
+    def invalidate(self, releases):
+        """
+        Remove aggregates depending on any of 'releases' (the delta of an
+        update). Returns the names of removed aggregates.
+        """
+        removed = [name for name, scope in self.scopes.items()
+                   if len(releases) and scope_mask(releases, scope).any()]
+        for name in removed:
+            if os.path.isfile(self._file(name)):
+                os.remove(self._file(name))
+            del self.scopes[name]
+        self._save_index()
+        return removed
+
+
+def stale_outputs(dataset):
+    """
+    Outputs of the preprocessing (see config.py) that no longer match the
+    dataset 'dataset' once it is updated. Returns an empty list for datasets
+    other than dump_pandas and dump_columns.
+    """
+    stale = [dump_stats, dump_tracks, dump_titles, dump_artist_index]
+    dataset = os.path.abspath(dataset)
+    if dataset == os.path.abspath(dump_pandas):
+        # the columnar dump is converted from the hdf dump
+        return stale + [dump_columns]
+    if dataset == os.path.abspath(dump_columns):
+        return stale
+    return []
+
+
+def remove_outputs(paths):
+    """Remove output files or directories, returns the removed ones"""
+    removed = []
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        else:
+            continue
+        removed.append(path)
+    return removed
+
+
+def read_dataset(filename):
+    if os.path.isdir(filename):
+        from columnar import ColumnStore
+        return ColumnStore(filename).to_dataframe()
+    return pandas.read_hdf(filename)
+
+
+def write_dataset(data, filename):
+    if os.path.splitext(filename)[1] in ('.hdf', '.h5'):
+        data.to_hdf(filename, 'w')
+    else:
+        from columnar import write_columns
+        write_columns(data, filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Update the processed release dataset to a new json dump")
+    parser.add_argument('--json', required=True, help="new json dump")
+    parser.add_argument('--hashes', required=True,
+                        help="release hashes of the previous dump (.npz saved with --output-hashes), "
+                             "or the previous json dump to hash")
+    parser.add_argument('--dataset', required=True, help="dataset processed from the previous dump (hdf or columnar)")
+    parser.add_argument('--output', required=True, help="updated dataset (hdf if .hdf/.h5, columnar otherwise)")
+    parser.add_argument('--output-hashes', required=True, help="release hashes of the new dump")
+    parser.add_argument('--results-cache', help="AggregateCache directory to invalidate")
+    args = parser.parse_args()
+    metrics.configure(metrics_log, metrics_prometheus)
+
+    if args.hashes.endswith('.npz'):
+        old_hashes = load_hashes(args.hashes)
+    else:
+        print("Hashing previous json dump %s" % args.hashes)
+        old_hashes = hash_dump(args.hashes)
+
+    data = read_dataset(args.dataset)
+    updated, new_hashes, delta, counts = update_dataset(data, old_hashes, args.json)
+
+    print("Saving updated dataset (%d releases) to %s" % (len(updated), args.output))
+    write_dataset(updated, args.output)
+    save_hashes(args.output_hashes, *new_hashes)
+
+    removed = remove_outputs(stale_outputs(args.output))
+    if removed:
+        print("Removed outputs that no longer match the updated dataset "
+              "(rebuild them with pipeline.py --force load): %s" % ', '.join(removed))
+
+    if args.results_cache:
+        removed = AggregateCache(args.results_cache).invalidate(delta)
+        print("Invalidated %d cached aggregates: %s" % (len(removed), ', '.join(sorted(removed))))
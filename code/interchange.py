@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Export and import of the release dataset as Parquet and Arrow IPC, so that
+other engines can read it and processes can share it without copies.
+
+Lists (genres, formats, artists, labels, track durations) are stored as
+native list types, styles as lists of (genre, style) structs, and country
+and status strings are dictionary-encoded. Releases are partitioned by
+release year in an integer 'year' column (-1 if unknown):
+- Parquet: a dataset directory with one partition directory per year
+  (year=1970/...), so that year ranges are read without touching other
+  partitions (predicate pushdown) and only requested columns are decoded
+- Arrow IPC: a single file with one record batch group per year, which is
+  memory-mapped on reading so that several processes share the same pages
+
+Requires pyarrow.
+'''
+
+import os
+import shutil
+import numpy as np
+import pandas
+
+from columnar import ColumnStore, CATEGORICAL_COLUMNS, is_null
+from sampling import chunk_bounds
+
+
+LIST_COLUMNS = {'genres': 'string', 'formats': 'string', 'artists': 'string',
+                'labels': 'string', 'tracks_duration_list': 'float32'}
+PARTITION = 'year'
+
+
+def style_type():
+    import pyarrow as pa
+    return pa.list_(pa.struct([('genre', pa.string()), ('style', pa.string())]))
+
+
+def list_values(values):
+    return [list(v) if isinstance(v, (list, tuple, np.ndarray)) else None for v in values]
+
+
+def release_years(data):
+    released = data['released'].values.astype(np.float64)
+    return np.where(np.isnan(released), -1, np.nan_to_num(released)).astype(np.int16)
+
+
+def categorical_vocabs(data):
+    """
+    Vocabularies of dictionary-encoded columns for the whole dataset, so that
+    all record batches share the same dictionaries
+    """
+    if isinstance(data, ColumnStore):
+        return dict((name, data.vocab(name)) for name in CATEGORICAL_COLUMNS if name in data)
+    return dict((name, sorted(v for v in data[name].unique() if not is_null(v)))
+                for name in CATEGORICAL_COLUMNS if name in data)
+
+
+def to_arrow(data, vocabs=None):
+    """
+    Convert a release DataFrame to an Arrow table with a 'year' column
+    - vocabs: dictionaries for categorical columns (see categorical_vocabs)
+    """
+    import pyarrow as pa
+
+    if vocabs is None:
+        vocabs = categorical_vocabs(data)
+
+    arrays, names = [], []
+    for name in data.columns:
+        values = data[name]
+        if name == 'styles':
+            array = pa.array([[{'genre': g, 'style': s} for g, s in v] if isinstance(v, (list, tuple)) else None
+                              for v in values], type=style_type())
+        elif name in LIST_COLUMNS:
+            array = pa.array(list_values(values), type=pa.list_(getattr(pa, LIST_COLUMNS[name])()))
+        elif name in CATEGORICAL_COLUMNS:
+            indices = pandas.Index(vocabs[name]).get_indexer(values).astype(np.int32)
+            array = pa.DictionaryArray.from_arrays(pa.array(indices, mask=indices < 0),
+                                                   pa.array(vocabs[name], type=pa.string()))
+        else:
+            array = pa.Array.from_pandas(values)
+        arrays.append(array)
+        names.append(name)
+
+    arrays.append(pa.array(release_years(data)))
+    names.append(PARTITION)
+    return pa.Table.from_arrays(arrays, names)
+
+
+def from_arrow(table):
+    """Convert an Arrow table back to a release DataFrame"""
+    data = table.to_pandas()
+    if PARTITION in data:
+        del data[PARTITION]
+    for name in data.columns:
+        if name == 'styles':
+            data[name] = [[(s['genre'], s['style']) for s in v] if v is not None else None
+                          for v in data[name]]
+        elif name in LIST_COLUMNS:
+            data[name] = list_values(data[name])
+        elif name in CATEGORICAL_COLUMNS:
+            data[name] = data[name].astype(object)
+    return data
+
+
+def dataframe_chunks(data, chunksize):
+    # bound memory when converting a large columnar dump
+    for start, stop in chunk_bounds(len(data), chunksize):
+        if isinstance(data, ColumnStore):
+            yield data.to_dataframe(rows=np.arange(start, stop))
+        else:
+            yield data.iloc[start:stop]
+
+
+def year_filters(start_year=None, end_year=None):
+    filters = []
+    if start_year is not None:
+        filters.append((PARTITION, '>=', start_year))
+    if end_year is not None:
+        filters.append((PARTITION, '<=', end_year))
+    return filters or None
+
+
+def remove_dataset(path):
+    # write_to_dataset adds files to existing partitions, only remove
+    # directories that hold nothing but a partitioned dataset
+    if not os.path.exists(path):
+        return
+    for name in os.listdir(path) if os.path.isdir(path) else [path]:
+        if not name.startswith(PARTITION + '=') and not name.startswith('_'):
+            raise ValueError("%s is not a Parquet dataset partitioned by %s, not replacing it" % (path, PARTITION))
+    shutil.rmtree(path)
+
+
+def write_parquet(data, path, chunksize=1000000):
+    """
+    Write releases (a DataFrame or a ColumnStore) to a Parquet dataset
+    directory partitioned by year, replacing an existing dataset
+    """
+    import pyarrow.parquet as pq
+    remove_dataset(path)
+    vocabs = categorical_vocabs(data)
+    for chunk in dataframe_chunks(data, chunksize):
+        pq.write_to_dataset(to_arrow(chunk, vocabs), path, partition_cols=[PARTITION])
+
+
+def read_parquet(path, columns=None, start_year=None, end_year=None):
+    """
+    Read releases from a Parquet dataset
+    - columns: only read these columns
+    - start_year, end_year: only read partitions of releases from these years
+      (releases with unknown year are skipped when a range is given)
+    """
+    import pyarrow.parquet as pq
+    dataset = pq.ParquetDataset(path, filters=year_filters(start_year, end_year))
+    return from_arrow(dataset.read(columns=columns))
+
+
+def write_arrow(data, filename, chunksize=1000000):
+    """
+    Write releases (a DataFrame or a ColumnStore) to an Arrow IPC file with
+    record batches grouped by year
+    """
+    import pyarrow as pa
+    vocabs = categorical_vocabs(data)
+    writer = None
+    try:
+        for chunk in dataframe_chunks(data, chunksize):
+            table = to_arrow(chunk, vocabs)
+            years = release_years(chunk)
+            for year in np.unique(years):
+                batch = table.take(pa.array(np.flatnonzero(years == year)))
+                if writer is None:
+                    writer = pa.ipc.new_file(filename, batch.schema)
+                writer.write_table(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def read_arrow(filename, columns=None, start_year=None, end_year=None, dataframe=True):
+    """
+    Read releases from an Arrow IPC file. The file is memory-mapped, and
+    record batches from other years are skipped without being read.
+    - columns: only keep these columns
+    - start_year, end_year: only read releases from these years
+    - dataframe: convert to a release DataFrame, otherwise return the Arrow
+      table, whose buffers point into the mapped file (no copy)
+    """
+    import pyarrow as pa
+    reader = pa.ipc.open_file(pa.memory_map(filename, 'r'))
+    year_column = reader.schema.get_field_index(PARTITION)
+
+    batches = []
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        if not batch.num_rows:
+            continue
+        # all releases of a batch are from the same year
+        year = batch.column(year_column)[0].as_py()
+        if start_year is not None and year < start_year:
+            continue
+        if end_year is not None and (year > end_year or year < 0):
+            continue
+        batches.append(batch)
+
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+    if columns is not None:
+        table = pa.Table.from_arrays([table.column(c) for c in columns], columns)
+    return from_arrow(table) if dataframe else table
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Label-level analysis without per-label scans.
+
+Labels are dictionary-encoded into integer codes stored in CSR form (offsets
+per release into an array of label codes, see columnar.py). Counts, yearly
+trends and coverage for all labels are computed with vectorized bincounts
+over these codes, and an inverted index gives the releases of a label.
+'''
+
+import numpy as np
+import pandas
+
+from columnar import ColumnStore, encode_multivalued, invert_csr
+
+
+def label_codes(data):
+    """
+    Return label codes of releases as (offsets, codes, vocabulary)
+    for a release DataFrame or a ColumnStore
+    """
+    if isinstance(data, ColumnStore):
+        offsets, codes = data.multivalued('labels')
+        return np.asarray(offsets), np.asarray(codes), data.vocab('labels')
+    return encode_multivalued(data['labels'].values)
+
+
+def release_rows(offsets):
+    # release row for every label code
+    return np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+
+
+class LabelIndex(object):
+    """Index of releases by label (label -> release rows)"""
+
+    def __init__(self, data):
+        offsets, codes, self.labels = label_codes(data)
+        self.codes = dict((l, i) for i, l in enumerate(self.labels))
+        self.offsets, self.rows_by_label = invert_csr(codes, release_rows(offsets), len(self.labels))
+
+    def rows(self, label):
+        """Return rows of all releases from the specified label"""
+        code = self.codes.get(label)
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        return self.rows_by_label[self.offsets[code]:self.offsets[code+1]]
+
+    def releases_number(self):
+        """Return the number of releases per label as a Series sorted by count"""
+        counts = pandas.Series(np.diff(self.offsets), index=self.labels)
+        return counts.sort_values(ascending=False)
+
+
+def label_counts(data):
+    """Count releases per label (a Series sorted by count)"""
+    _, codes, labels = label_codes(data)
+    counts = pandas.Series(np.bincount(codes, minlength=len(labels)), index=labels)
+    return counts.sort_values(ascending=False)
+
+
+def label_releases_per_year(data, start_year, end_year, labels=None, top=20, type='releases'):
+    """
+    Count releases (or tracks) per year for labels in a single pass
+    - labels: list of labels to count (the 'top' labels by number of releases by default)
+    - type: "releases" or "tracks"
+    Returns a DataFrame with 'years', 'all' and a column per label
+    (the format of compare_genres output)
+    """
+    offsets, codes, vocab = label_codes(data)
+    rows = release_rows(offsets)
+    if isinstance(data, ColumnStore):
+        released = np.asarray(data.numeric('released'))
+        tracks = np.asarray(data.numeric('tracks_number'))
+    else:
+        released = data['released'].values.astype(np.float64)
+        tracks = data['tracks_number'].values
+
+    if labels is None:
+        counts = np.bincount(codes, minlength=len(vocab))
+        selected = np.argsort(-counts, kind='mergesort')[:top]
+    else:
+        lookup = dict((l, i) for i, l in enumerate(vocab))
+        selected = np.array([lookup.get(l, -1) for l in labels], dtype=np.int64)
+
+    years = end_year - start_year + 1
+    in_range = (released >= start_year) & (released <= end_year)
+    year_index = np.where(in_range, np.nan_to_num(released) - start_year, -1).astype(np.int64)
+    weights = tracks if type == 'tracks' else np.ones(len(released))
+
+    # map label codes to columns of the result, -1 for unselected labels
+    # (the extra last entry absorbs requested labels absent from data)
+    column = np.full(len(vocab) + 1, -1, dtype=np.int64)
+    column[selected] = np.arange(len(selected))
+    column[-1] = -1
+    label_column = column[codes]
+    valid = (label_column >= 0) & (year_index[rows] >= 0)
+    cells = label_column[valid] * years + year_index[rows][valid]
+    matrix = np.bincount(cells, weights=weights[rows][valid],
+                         minlength=len(selected) * years).reshape(len(selected), years)
+
+    stats = {'years': range(start_year, end_year + 1)}
+    stats['all'] = np.bincount(year_index[in_range], weights=weights[in_range], minlength=years).astype(np.int64)
+    for i, l in enumerate(labels if labels is not None else [vocab[c] for c in selected]):
+        stats[l] = matrix[i].astype(np.int64)
+    return pandas.DataFrame(stats)
+
+
+def label_coverage(data, total_tracks=None, total_artists=None):
+    """
+    Compute coverage of labels (percentages of releases, tracks and artists)
+    in the format of releases_coverage output, using sparse matrix products
+    instead of per-label selections
+    """
+    from scipy import sparse
+
+    offsets, codes, labels = label_codes(data)
+    rows = release_rows(offsets)
+    length = len(offsets) - 1
+    if isinstance(data, ColumnStore):
+        tracks = np.asarray(data.numeric('tracks_number'), dtype=np.float64)
+        artist_offsets, artist_codes = data.multivalued('artists')
+        artist_offsets, artist_codes = np.asarray(artist_offsets), np.asarray(artist_codes)
+        artists_number = len(data.vocab('artists'))
+    else:
+        tracks = data['tracks_number'].values.astype(np.float64)
+        artist_offsets, artist_codes, artists = encode_multivalued(data['artists'].values)
+        artists_number = len(artists)
+
+    if total_tracks is None:
+        total_tracks = tracks.sum()
+    if total_artists is None:
+        total_artists = artists_number
+
+    # label x release and release x artist incidence matrices
+    label_release = sparse.csr_matrix((np.ones(len(codes)), (codes, rows)), shape=(len(labels), length))
+    release_artist = sparse.csr_matrix((np.ones(len(artist_codes)), (release_rows(artist_offsets), artist_codes)),
+                                       shape=(length, artists_number))
+    label_artist = label_release.dot(release_artist)
+
+    releases = np.bincount(codes, minlength=len(labels))
+    coverage = pandas.DataFrame([100. * releases / max(length, 1),
+                                 100. * label_release.dot(tracks) / total_tracks,
+                                 100. * np.diff(label_artist.indptr) / total_artists],
+                                columns=labels, index=['releases (%)', 'tracks (%)', 'artists (%)'])
+    return coverage.sort_values(by='releases (%)', axis=1, ascending=False)
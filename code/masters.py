@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Deduplication of releases by master release.
+
+Reissues, remasters and regional pressings of the same work share a master
+release id. Releases are grouped by master in a single sort-and-segment pass
+(a sort by master id and year, then segments where the master id changes).
+Releases without a master (master_id 0) each form their own group.
+
+A collapsed DataFrame has one row per work: the earliest release of the
+master, with the union of genres and styles over all its releases and the
+number of releases in 'master_releases'. Collapsed views are cached per
+dataset, so that analysis functions called with by_master=True group
+releases only once. The cache only keeps weak references to the datasets:
+a collapsed view is dropped with its dataset. Views are rebuilt when the
+length or the columns of a dataset change, or when its master ids or years
+are assigned again; call clear_cache() after changing values of a dataset
+in place (e.g., data.loc[rows, 'released'] = ...).
+'''
+
+import weakref
+import numpy as np
+
+from columnar import ColumnStore
+
+
+# id(data) -> (weak reference to data, version of data, collapsed data)
+_cache = {}
+
+
+def extract_master_id(master_id):
+    # plain id in older dumps, {'@is_main_release': ..., '#text': id} in newer ones
+    if isinstance(master_id, dict):
+        master_id = master_id.get('#text')
+    try:
+        return int(master_id)
+    except (TypeError, ValueError):
+        return 0
+
+
+class MasterGrouping(object):
+    """
+    Grouping of release rows by master release
+    - order: release rows sorted by master, earliest release of a master first
+    - starts: start of each group in 'order'
+    - sizes: number of releases in each group
+    - first: earliest release row of each group
+    - group: group number of each release row
+    """
+
+    def __init__(self, master_ids, released):
+        master_ids = np.asarray(master_ids, dtype=np.int64)
+        released = np.asarray(released, dtype=np.float64)
+        n = len(master_ids)
+
+        # releases without a master get a unique negative key
+        keys = np.where(master_ids > 0, master_ids, -np.arange(1, n + 1))
+        # unknown years sort after known ones within a master
+        years = np.where(np.isnan(released), np.inf, released)
+        self.order = np.lexsort((years, keys))
+
+        keys = keys[self.order]
+        boundaries = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        self.starts = np.r_[0, boundaries].astype(np.int64) if n else np.zeros(0, dtype=np.int64)
+        self.sizes = np.diff(np.r_[self.starts, n])
+        self.first = self.order[self.starts]
+        self.group = np.empty(n, dtype=np.int64)
+        self.group[self.order] = np.repeat(np.arange(len(self.starts)), self.sizes)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def union(self, values):
+        """
+        Return the union of list values (e.g., genres) over releases of each
+        group, keeping the order of the earliest release first
+        """
+        result = [list(values[row]) for row in self.first]
+        for g in np.flatnonzero(self.sizes > 1):
+            union = result[g]
+            for row in self.order[self.starts[g] + 1:self.starts[g] + self.sizes[g]]:
+                for v in values[row]:
+                    if v not in union:
+                        union.append(v)
+        return result
+
+
+def collapse_masters(data):
+    """
+    Collapse releases (a DataFrame or a ColumnStore) to one row per master
+    release, keeping the earliest year and the union of genres and styles
+    """
+    if isinstance(data, ColumnStore):
+        data = data.to_dataframe()
+    if 'master_id' not in data:
+        raise ValueError("No 'master_id' column in data, reload the json dump with load_releases")
+
+    grouping = MasterGrouping(data['master_id'].values, data['released'].values)
+    collapsed = data.iloc[grouping.first].copy()
+    for column in ['genres', 'styles']:
+        if column in collapsed:
+            collapsed[column] = grouping.union(data[column].values)
+    collapsed['master_releases'] = grouping.sizes
+    return collapsed
+
+
+def data_version(data):
+    # cheap check of changes of the columns used for grouping: a column that
+    # is assigned again gets a new buffer, values changed in place do not
+    if isinstance(data, ColumnStore):
+        return len(data)
+    version = [len(data), tuple(data.columns)]
+    for column in ['master_id', 'released']:
+        if column in data:
+            version.append(data[column].values.__array_interface__['data'][0])
+    return tuple(version)
+
+
+def by_master(data):
+    """Return the collapsed view of data, grouping releases on first use only"""
+    key = id(data)
+    version = data_version(data)
+    cached = _cache.get(key)
+    if cached is not None and cached[0]() is data and cached[1] == version:
+        return cached[2]
+    collapsed = collapse_masters(data)
+    _cache[key] = (weakref.ref(data, lambda ref: _forget(key, ref)), version, collapsed)
+    return collapsed
+
+
+def _forget(key, ref):
+    # drop the collapsed view of a dataset that no longer exists
+    cached = _cache.get(key)
+    if cached is not None and cached[0] is ref:
+        del _cache[key]
+
+
+def clear_cache():
+    """Drop all collapsed views"""
+    _cache.clear()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Lightweight performance metrics for the preprocessing scripts and analyze.py.
+
+Timings, processed items and error counts are accumulated in memory per stage
+(or per function) at the cost of a couple of clock reads per call, and are
+emitted on demand, periodically or at exit as:
+- json lines (one record per stage, appended to a log file)
+- a Prometheus textfile (overwritten with the current totals)
+
+Configure outputs with configure(), e.g., with metrics_log / metrics_prometheus
+of config.py in the entry points of scripts. Metrics can be updated from
+several threads.
+'''
+
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import functools
+import threading
+try:
+    # monotonic clock, not affected by system clock updates
+    from time import monotonic as clock
+except ImportError:
+    from timeit import default_timer as clock
+
+
+# stage name -> accumulated values
+_stages = {}
+_outputs = {'jsonl': None, 'prometheus': None}
+_start = time.time()
+_lock = threading.Lock()
+# depth of timed calls in each thread, nested timed calls are not counted
+_calls = threading.local()
+
+
+def configure(jsonl=None, prometheus=None):
+    """
+    Set outputs for metrics: 'jsonl' log file and/or Prometheus 'prometheus'
+    textfile. Metrics are emitted at exit once an output is configured.
+    """
+    _outputs['jsonl'] = jsonl
+    _outputs['prometheus'] = prometheus
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 1024. / 1024. if sys.platform == 'darwin' else rss / 1024.
+
+
+def _stage(name):
+    if name not in _stages:
+        _stages[name] = {'calls': 0, 'seconds': 0., 'max_seconds': 0.,
+                         'items': 0, 'errors': 0}
+    return _stages[name]
+
+
+def add_time(name, seconds, items=0):
+    """Add 'seconds' spent and 'items' processed to a stage"""
+    with _lock:
+        s = _stage(name)
+        s['calls'] += 1
+        s['seconds'] += seconds
+        s['items'] += items
+        if seconds > s['max_seconds']:
+            s['max_seconds'] = seconds
+
+
+def add_error(name, n=1):
+    """Count errors for a stage"""
+    with _lock:
+        _stage(name)['errors'] += n
+
+
+def seconds(name):
+    """Return total seconds accumulated by a stage"""
+    with _lock:
+        return _stage(name)['seconds']
+
+
+def add_items(name, n=1):
+    """Count processed items for a stage without timing it"""
+    with _lock:
+        _stage(name)['items'] += n
+
+
+class stage(object):
+    """
+    Time a block of code as a stage:
+
+        with stage('hdf_write', items=len(data)):
+            data.to_hdf(...)
+    """
+
+    def __init__(self, name, items=0):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add_time(self.name, clock() - self.start, self.items)
+        if exc_type is not None:
+            add_error(self.name)
+        return False
+
+
+def data_length(args):
+    # number of releases in the first argument (a DataFrame or a ColumnStore)
+    if args and hasattr(args[0], '__len__') and not isinstance(args[0], (str, dict, list)):
+        return len(args[0])
+    return 0
+
+
+def timed(func, name=None):
+    """
+    Wrap a function to time each of its calls as a stage. The length of the
+    first argument (the release data) is counted as processed items. Calls
+    made from another timed function are part of that function's time and
+    are not counted again.
+    """
+    name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_calls, 'depth', 0)
+        if depth:
+            return func(*args, **kwargs)
+        _calls.depth = 1
+        start = clock()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            add_error(name)
+            raise
+        finally:
+            _calls.depth = 0
+            add_time(name, clock() - start, data_length(args))
+    return wrapper
+
+
+def instrument(namespace, prefix, names):
+    """
+    Time the listed functions of a module namespace (e.g., globals()),
+    reporting them as '<prefix>.<function name>'. Only list functions that
+    do enough work per call: helpers called per release (e.g., in
+    DataFrame.apply) would pay for the wrapper on every row.
+    """
+    for fname in names:
+        namespace[fname] = timed(namespace[fname], '%s.%s' % (prefix, fname))
+
+
+def snapshot():
+    """Return a list of records with accumulated metrics for all stages"""
+    now = time.time()
+    peak = peak_rss_mb()
+    with _lock:
+        stages = dict((name, dict(s)) for name, s in _stages.items())
+    records = []
+    for name in sorted(stages):
+        s = stages[name]
+        records.append({
+            'time': now,
+            'pid': os.getpid(),
+            'stage': name,
+            'calls': s['calls'],
+            'seconds': s['seconds'],
+            'max_seconds': s['max_seconds'],
+            'items': s['items'],
+            'items_per_sec': s['items'] / s['seconds'] if s['seconds'] else None,
+            'errors': s['errors'],
+            'peak_rss_mb': peak,
+            'uptime': now - _start,
+        })
+    return records
+
+
+def emit(jsonl=None, prometheus=None):
+    """Write current metrics to the configured (or specified) outputs"""
+    jsonl = jsonl or _outputs['jsonl']
+    prometheus = prometheus or _outputs['prometheus']
+    records = snapshot()
+
+    if jsonl:
+        if os.path.dirname(jsonl) and not os.path.isdir(os.path.dirname(jsonl)):
+            os.makedirs(os.path.dirname(jsonl))
+        with open(jsonl, 'a') as f:
+            for r in records:
+                f.write(json.dumps(r) + '\n')
+
+    if prometheus:
+        write_prometheus(prometheus, records)
+
+
+def write_prometheus(filename, records=None):
+    """Write metrics in the Prometheus textfile exposition format"""
+    if records is None:
+        records = snapshot()
+
+    lines = ['# TYPE discogs_peak_rss_megabytes gauge',
+             'discogs_peak_rss_megabytes %f' % peak_rss_mb()]
+    for metric, key, kind in [('discogs_stage_seconds_total', 'seconds', 'counter'),
+                              ('discogs_stage_calls_total', 'calls', 'counter'),
+                              ('discogs_stage_items_total', 'items', 'counter'),
+                              ('discogs_stage_errors_total', 'errors', 'counter'),
+                              ('discogs_stage_items_per_second', 'items_per_sec', 'gauge')]:
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for r in records:
+            if r[key] is not None:
+                lines.append('%s{stage="%s"} %f' % (metric, r['stage'], r[key]))
+
+    # write atomically so that collectors never read a partial file
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp, filename)
+
+
+def _emit_at_exit():
+    if _stages and (_outputs['jsonl'] or _outputs['prometheus']):
+        emit()
+
+
+atexit.register(_emit_at_exit)
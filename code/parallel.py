@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Run per-category analyses (per genre, style or country) on a process pool.
+
+The release DataFrame is published once as a memory-mapped columnar layout
+(see columnar.py). Worker processes map the same files instead of receiving a
+pickled copy of the data, and only send back small per-category results.
+
+The layout of a DataFrame is written to a temporary directory on its first
+parallel analysis and reused by the next ones, until the DataFrame is
+collected, its length or columns change, or the process exits. Pass a
+ColumnStore (see analyze.load_release_dump) to skip writing it at all.
+'''
+
+import atexit
+import shutil
+import weakref
+import tempfile
+import multiprocessing
+import numpy as np
+
+from columnar import ColumnStore, write_columns
+
+
+# The store mapped by a worker process
+_store = None
+_year_cache = {}
+# id(data) -> (weak reference to data, length and columns of data, path)
+_published = {}
+
+
+def _init_worker(path):
+    global _store
+    _store = ColumnStore(path)
+    _year_cache.clear()
+
+
+def publish_columns(data):
+    """
+    Publish a release DataFrame for worker processes (see the module
+    description). Returns the path to the columnar layout.
+    """
+    if isinstance(data, ColumnStore):
+        return data.path
+    key = id(data)
+    version = (len(data), tuple(data.columns))
+    published = _published.get(key)
+    if published is not None and published[0]() is data and published[1] == version:
+        return published[2]
+    if published is not None:
+        _unpublish(key)
+    path = tempfile.mkdtemp(prefix='discogs_columns_')
+    write_columns(data, path)
+    _published[key] = (weakref.ref(data, lambda ref: _unpublish(key, ref)), version, path)
+    return path
+
+
+def _unpublish(key, ref=None):
+    # remove the layout of a DataFrame that changed or no longer exists
+    published = _published.get(key)
+    if published is not None and (ref is None or published[0] is ref):
+        del _published[key]
+        shutil.rmtree(published[2], ignore_errors=True)
+
+
+def clear_published():
+    """Remove the layouts of all published DataFrames"""
+    for key in list(_published):
+        _unpublish(key)
+
+
+atexit.register(clear_published)
+
+
+def map_categories(func, data, tasks, processes=None):
+    """
+    Apply 'func' to every task on a pool of 'processes' workers
+    (all CPUs by default) sharing the columns of 'data'
+    """
+    path = publish_columns(data)
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(path,))
+    try:
+        results = pool.map(func, tasks)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+# Selection helpers operating on the mapped columns
+
+def year_index(store, start_year, end_year):
+    """Return release year offsets from 'start_year' (-1 if out of range)"""
+    key = (start_year, end_year)
+    if key not in _year_cache:
+        released = store.numeric('released')
+        index = np.full(len(store), -1, dtype=np.int64)
+        valid = (released >= start_year) & (released <= end_year)
+        index[valid] = released[valid].astype(np.int64) - start_year
+        _year_cache[key] = index
+    return _year_cache[key]
+
+
+def select_mask(store, genre=None, style=None, format=None, country=None):
+    """Boolean mask equivalent to analyze.select without year and tracks"""
+    mask = np.ones(len(store), dtype=bool)
+    if style:
+        mask &= store.contains('styles', style)
+    if genre:
+        mask &= store.contains('genres', genre)
+    if format:
+        mask &= store.contains('formats', format)
+    if country:
+        mask &= store.equals('country', country)
+    return mask
+
+
+def count_per_year(store, mask, metric, start_year, end_year):
+    """Count releases, tracks or distinct artists per year for masked releases"""
+    years = year_index(store, start_year, end_year)
+    length = end_year - start_year + 1
+    mask = mask & (years >= 0)
+
+    if metric == 'releases':
+        counts = np.bincount(years[mask], minlength=length)
+    elif metric == 'tracks':
+        counts = np.bincount(years[mask], minlength=length,
+                             weights=store.numeric('tracks_number')[mask]).astype(np.int64)
+    elif metric == 'artists':
+        _, codes = store.multivalued('artists')
+        rows = store.row_ids('artists')
+        selected = mask[rows]
+        pairs = years[rows[selected]] * len(store.vocab('artists')) + codes[selected]
+        counts = np.bincount(np.unique(pairs) // len(store.vocab('artists')), minlength=length)
+    else:
+        raise ValueError("Wrong metric: %s" % metric)
+    return counts.tolist()
+
+
+def select_func_mask(store, genre, type):
+    """Boolean mask equivalent to select_genre/select_style/select_only_*"""
+    if type == "genre":
+        return store.contains('genres', genre)
+    elif type == "genre_only":
+        return store.contains('genres', genre, only=True)
+    elif type == "style":
+        return store.contains('styles', genre)
+    elif type == "style_only":
+        return store.contains('styles', genre, only=True)
+    raise ValueError("Wrong type: %s" % type)
+
+
+def masked_durations(store, mask):
+    """Return all track durations (in minutes) of masked releases"""
+    offsets, values = store.ragged('tracks_duration_list')
+    rows = np.repeat(mask, np.diff(offsets))
+    return np.asarray(values[rows], dtype=np.float64)
+
+
+# Worker functions (module-level so that they can be sent to the pool)
+
+def _per_year_task(task):
+    query, metric, start_year, end_year = task
+    mask = select_mask(_store, **query)
+    return count_per_year(_store, mask, metric, start_year, end_year)
+
+
+def _duration_task(task):
+    genre, type = task
+    durations = masked_durations(_store, select_func_mask(_store, genre, type))
+    if not len(durations):
+        return genre, None
+    p5, p25, p50, p75, p95 = np.percentile(durations, [5, 25, 50, 75, 95])
+    return genre, {
+        'durations': durations,
+        'median': p50,
+        '95%': p95,
+        '5%': p5,
+        '95vs5': p95 - p5,
+        'iqr': p75 - p25,
+        'p25': p25,
+        'p75': p75,
+        'tracks': len(durations),
+    }
+
+
+def _cooccurrence_task(task):
+    genre, column, vocab_codes = task
+    mask = _store.contains(column, genre)
+    _, codes = _store.multivalued(column)
+    counts = np.bincount(codes[mask[_store.row_ids(column)]],
+                         minlength=len(_store.vocab(column)))
+    return 100. * counts[vocab_codes] / mask.sum()
+
+
+# Parallel versions of per-category loops in analyze.py
+
+def per_year_counts(data, queries, metric='releases', start_year=None, end_year=None, processes=None):
+    """
+    Count releases, tracks or artists per year for a list of queries.
+    Each query is a dict of select() arguments (genre, style, format, country).
+    Returns a list of per-year counts, one per query.
+    """
+    tasks = [(q, metric, start_year, end_year) for q in queries]
+    return map_categories(_per_year_task, data, tasks, processes)
+
+
+def duration_stats(data, genres, type="genre", processes=None):
+    """
+    Compute track duration statistics per genre (style) in parallel.
+    Returns the same dict as analyze.track_duration_per_genre
+    """
+    results = map_categories(_duration_task, data, [(g, type) for g in genres], processes)
+    return dict((g, s) for g, s in results if s is not None)
+
+
+def cooccurrence_rows(data, genres, type="genre", processes=None):
+    """
+    Compute co-occurrence percentages between all non-empty genres (styles).
+    Returns the list of non-empty genres and a row of percentages for each.
+    """
+    column = 'genres' if type == "genre" else 'styles'
+    store = ColumnStore(publish_columns(data))
+    offsets, codes = store.multivalued(column)
+    counts = np.bincount(codes, minlength=len(store.vocab(column)))
+    genres = [g for g in genres
+              if store.code(column, g) is not None and counts[store.code(column, g)]]
+    vocab_codes = np.array([store.code(column, g) for g in genres], dtype=np.int64)
+    rows = map_categories(_cooccurrence_task, data, [(g, column, vocab_codes) for g in genres], processes)
+    return genres, rows
@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Dependency-aware runner for the preprocessing, analyses and figures of the
+report.
+
+Stages (download, convert, load, columnar dump, artist index, every analysis
+of report.py and every figure) form a DAG. Every stage has a fingerprint
+hashing:
+- the values of the config.py settings it depends on (e.g., IGNORE_GENRES,
+  START_YEAR and END_YEAR)
+- its input files (e.g., the taxonomy YAML); files larger than HASH_LIMIT are
+  fingerprinted by size and modification time instead of content
+- the source of the modules it runs (code version)
+- its function, arguments, and the fingerprints of the stages it depends on
+A stage runs again only if its fingerprint differs from the one recorded
+after its last successful run (in config.pipeline_state), and then all
+stages depending on it run again too. A config change therefore rebuilds
+exactly the stages it affects. A stage with missing outputs runs again only
+if a stage depending on it runs, or if no stage depends on it: a deleted
+figure is drawn again, but a deleted XML dump is not downloaded again while
+the json dump converted from it is up to date.
+
+Outputs of a stage are removed before it runs, except for outputs the
+pipeline did not produce: a stage without a recorded fingerprint whose
+outputs exist (e.g., a dump downloaded or converted before the pipeline was
+used) is adopted as up to date, and a stage with some of them is not run
+unless it is forced. Optional outputs (e.g., sidecars that older versions of
+the scripts did not write) may be missing from adopted stages. The download
+replaces the dump only once the new one is complete.
+
+Stages whose dependencies are done run concurrently in a pool of processes.
+Stages that need the release data (analyses) get it as first argument: it is
+loaded once in the parent process before they are started and shared with
+the workers (fork).
+
+Usage:
+    python pipeline.py [STAGE ...] [--dry-run] [--force STAGE [STAGE ...]]
+                       [--touch STAGE [STAGE ...]] [--processes N]
+STAGE are shell-style patterns of stage names (e.g., 'figure:*'), stages
+they depend on are included. All stages are run by default. Use --touch to
+record existing outputs as up to date, e.g., after a dependency changed.
+'''
+
+import os
+import json
+import time
+import pickle
+import shutil
+import fnmatch
+import hashlib
+import argparse
+import multiprocessing
+
+try:
+    from Queue import Queue
+except ImportError:
+    # Python 3
+    from queue import Queue
+
+from config import *
+import config
+import report
+
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+HASH_LIMIT = 64 * 1024 * 1024
+
+
+def file_digest(path, hash_limit=HASH_LIMIT):
+    """Hash of a file, or of all files of a directory (None if missing)"""
+    if os.path.isdir(path):
+        digest = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                digest.update(os.path.relpath(filename, path).encode('utf-8'))
+                digest.update(file_digest(filename, hash_limit).encode('utf-8'))
+        return digest.hexdigest()
+    if not os.path.exists(path):
+        return None
+    size = os.path.getsize(path)
+    if size > hash_limit:
+        return 'size:%d,mtime:%d' % (size, os.path.getmtime(path))
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def remove_output(path, keep=False):
+    # remove an output before its stage runs, creating its directory
+    if os.path.isdir(path) and not keep:
+        shutil.rmtree(path)
+    elif os.path.exists(path) and not keep:
+        os.remove(path)
+    elif os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+
+class Stage(object):
+    """
+    A stage of the pipeline, running function(*args)
+    - name: unique name of the stage
+    - after: names of the stages it depends on
+    - inputs: files (or directories) it reads, other than outputs of the
+      stages it depends on
+    - outputs: files (or directories) it writes, removed before it runs
+    - config: names of config.py settings it depends on
+    - code: modules (in this directory) whose source it depends on
+    - data: pass the release data as first argument
+    - atomic: the function replaces its outputs only when it succeeds, they
+      are kept until then
+    - optional: outputs that may be missing when the stage is adopted or
+      touched (see the module description)
+    """
+
+    def __init__(self, name, function, args=(), after=(), inputs=(), outputs=(), config=(), code=(),
+                 data=False, atomic=False, optional=()):
+        self.name = name
+        self.function = function
+        self.args = tuple(args)
+        self.after = list(after)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.config = list(config)
+        self.code = list(code)
+        self.data = data
+        self.atomic = atomic
+        self.optional = list(optional)
+
+    def required_outputs(self):
+        """Outputs that have to exist for the stage to be adopted or touched"""
+        return [o for o in self.outputs if o not in self.optional]
+
+    def fingerprint(self, upstream):
+        """Hash of all the outputs depend on, given fingerprints of upstream stages"""
+        values = {
+            'function': self.function.__name__,
+            'args': repr(self.args),
+            'config': dict((c, repr(getattr(config, c))) for c in self.config),
+            'inputs': dict((path, file_digest(path)) for path in self.inputs),
+            'code': dict((m, file_digest(os.path.join(CODE_DIR, m + '.py'))) for m in self.code),
+            'after': dict((s, upstream[s]) for s in self.after),
+        }
+        return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def __repr__(self):
+        return 'Stage(%s)' % self.name
+
+
+_data = None
+
+
+def _init_worker(dump):
+    # forked workers already have the data if a stage needs it
+    global _data
+    if _data is None and dump is not None:
+        import analyze
+        _data = analyze.load_release_dump(dump)
+
+
+def _run_stage(stage):
+    start = time.time()
+    try:
+        args = ((_data,) if stage.data else ()) + stage.args
+        stage.function(*args)
+        return stage.name, None, time.time() - start
+    except Exception as e:
+        return stage.name, '%s: %s' % (type(e).__name__, e), time.time() - start
+
+
+class Pipeline(object):
+    """
+    DAG of stages, run when their fingerprints change (see the module
+    description)
+    - stages: list of Stage
+    - state: json file of fingerprints of up to date stages
+    - dump: release dump loaded for stages that need the release data
+    """
+
+    def __init__(self, stages, state=pipeline_state, dump=dump_pandas):
+        self.stages = dict((s.name, s) for s in stages)
+        self.names = [s.name for s in stages]
+        for s in stages:
+            for name in s.after:
+                if name not in self.stages:
+                    raise ValueError("Unknown stage %s (dependency of %s)" % (name, s.name))
+        self.state_file = state
+        self.dump = dump
+        self.state = {}
+        if os.path.isfile(state):
+            with open(state, 'r') as f:
+                self.state = json.load(f)
+
+    def save_state(self):
+        remove_output(self.state_file + '.tmp')
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.rename(self.state_file + '.tmp', self.state_file)
+
+    def select(self, patterns=None):
+        """Names of stages matching shell-style patterns (all by default)"""
+        if not patterns:
+            return list(self.names)
+        names = []
+        for pattern in patterns:
+            matched = [n for n in self.names if fnmatch.fnmatchcase(n, pattern)]
+            if not matched:
+                raise ValueError("No stage matches %s" % pattern)
+            names += [n for n in matched if n not in names]
+        return names
+
+    def order(self, names):
+        """Stages 'names' and the stages they depend on, in topological order"""
+        ordered = []
+        visiting = set()
+        done = set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError("Dependency cycle through stage %s" % name)
+            visiting.add(name)
+            for dependency in self.stages[name].after:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+            ordered.append(self.stages[name])
+
+        for name in names:
+            visit(name)
+        return ordered
+
+    def plan(self, targets=None, force=(), dependencies=True):
+        """
+        Return the stages to run for 'targets' (patterns) in topological
+        order, the stages whose existing outputs are adopted as up to date
+        (see the module description), and fingerprints of all stages they
+        depend on
+        - force: patterns of stages to run even if up to date
+        - dependencies: also plan the stages that targets depend on,
+          otherwise their existing outputs are used as they are
+        """
+        forced = set(self.select(force)) if force else set()
+        selected = set(self.select(targets))
+        fingerprints = {}
+        status = {}
+        planned = []
+        for stage in self.order(self.select(targets)):
+            fingerprints[stage.name] = stage.fingerprint(fingerprints)
+            if not dependencies and stage.name not in selected:
+                continue
+            planned.append(stage)
+            existing = [o for o in stage.outputs if os.path.exists(o)]
+            if stage.name in forced or any(status.get(s) == 'stale' for s in stage.after):
+                status[stage.name] = 'stale'
+            elif stage.name not in self.state:
+                if stage.outputs and all(o in existing for o in stage.required_outputs()):
+                    status[stage.name] = 'adopted'
+                elif stage.outputs and not existing:
+                    status[stage.name] = 'missing'
+                else:
+                    status[stage.name] = 'stale'
+            elif self.state[stage.name] != fingerprints[stage.name]:
+                status[stage.name] = 'stale'
+            elif len(existing) < len(stage.outputs):
+                status[stage.name] = 'missing'
+            else:
+                status[stage.name] = 'done'
+
+        # stages with missing outputs run if a stage depending on them runs or
+        # if none depends on them, and stages depending on stages that run too
+        dependents = dict((s.name, [d.name for d in planned if s.name in d.after]) for s in planned)
+        changed = True
+        while changed:
+            changed = False
+            for stage in planned:
+                if status[stage.name] == 'stale':
+                    continue
+                needed = status[stage.name] == 'missing' and \
+                    (not dependents[stage.name] or any(status[d] == 'stale' for d in dependents[stage.name]))
+                if needed or any(status.get(s) == 'stale' for s in stage.after):
+                    status[stage.name] = 'stale'
+                    changed = True
+
+        stale = [s for s in planned if status[s.name] == 'stale']
+        adopted = [s for s in planned if status[s.name] == 'adopted']
+        return stale, adopted, fingerprints
+
+    def foreign_outputs(self, stage):
+        """Existing outputs of a stage that the pipeline did not produce"""
+        if stage.name in self.state or stage.atomic:
+            return []
+        return [o for o in stage.outputs if os.path.exists(o)]
+
+    def touch(self, targets):
+        """Record stages matching 'targets' as up to date if their outputs exist"""
+        stages = self.order(self.select(targets))
+        fingerprints = {}
+        for stage in stages:
+            fingerprints[stage.name] = stage.fingerprint(fingerprints)
+        for name in self.select(targets):
+            missing = [o for o in self.stages[name].required_outputs() if not os.path.exists(o)]
+            if missing:
+                print("Cannot touch %s, missing outputs: %s" % (name, ', '.join(missing)))
+                continue
+            self.state[name] = fingerprints[name]
+            print("Marked %s as up to date" % name)
+        self.save_state()
+
+    def run(self, targets=None, force=(), dry_run=False, processes=None, dependencies=True):
+        """
+        Run the stages for 'targets' (patterns, all stages by default) that
+        are not up to date, independent stages in parallel
+        - force: patterns of stages to run even if up to date
+        - dry_run: only print the stages to run
+        - processes: number of processes (number of CPUs by default)
+        - dependencies: also run the stages that targets depend on if they
+          are not up to date
+        Returns the names of stages that were run and of stages that failed
+        (or were skipped because a dependency failed).
+        """
+        global _data
+        stages, adopted, fingerprints = self.plan(targets, force, dependencies)
+        forced = set(self.select(force)) if force else set()
+        if dry_run:
+            for stage in adopted:
+                print("Would adopt existing outputs of %s" % stage.name)
+            for stage in stages:
+                print("Would run %s" % stage.name)
+            return [], []
+        for stage in adopted:
+            print("Adopted existing outputs of %s as up to date" % stage.name)
+            missing = [o for o in stage.optional if not os.path.exists(o)]
+            if missing:
+                print("Optional outputs of %s are missing (%s), use --force %s to build them"
+                      % (stage.name, ', '.join(missing), stage.name))
+            self.state[stage.name] = fingerprints[stage.name]
+        if adopted:
+            self.save_state()
+        if not stages:
+            print("All stages are up to date")
+            return [], []
+
+        pending = list(stages)
+        scheduled = set(s.name for s in stages)
+        completed = []
+        failed = []
+        running = set()
+        finished = Queue()
+        pool = None
+        try:
+            while pending or running:
+                for stage in list(pending):
+                    if any(s in failed for s in stage.after):
+                        print("Skipping %s, a dependency failed" % stage.name)
+                        pending.remove(stage)
+                        failed.append(stage.name)
+                        continue
+                    if any(s in scheduled and s not in completed for s in stage.after):
+                        continue
+                    foreign = self.foreign_outputs(stage)
+                    if foreign and stage.name not in forced:
+                        print("Not running %s, it would replace outputs the pipeline did not produce (%s), "
+                              "use --force %s or --touch %s" % (stage.name, ', '.join(foreign),
+                                                                stage.name, stage.name))
+                        pending.remove(stage)
+                        failed.append(stage.name)
+                        continue
+                    if stage.data and _data is None:
+                        # workers are forked once the data is loaded
+                        if running:
+                            continue
+                        if pool is not None:
+                            pool.close()
+                            pool.join()
+                            pool = None
+                        print("Loading release dump from %s" % self.dump)
+                        import analyze
+                        _data = analyze.load_release_dump(self.dump)
+                    if pool is None:
+                        pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                                    initargs=(self.dump if _data is not None else None,))
+                    print("Running %s" % stage.name)
+                    for output in stage.outputs:
+                        remove_output(output, keep=stage.atomic)
+                    # outputs of the stage are now the pipeline's, up to date once it succeeds
+                    self.state[stage.name] = None
+                    self.save_state()
+                    pending.remove(stage)
+                    running.add(stage.name)
+                    pool.apply_async(_run_stage, (stage,), callback=finished.put)
+                if not running:
+                    break
+
+                name, error, seconds = finished.get()
+                running.discard(name)
+                if error:
+                    print("ERROR in stage %s: %s" % (name, error))
+                    failed.append(name)
+                else:
+                    print("Finished %s in %.1fs" % (name, seconds))
+                    completed.append(name)
+                    self.state[name] = fingerprints[name]
+                self.save_state()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _data = None
+        return completed, failed
+
+
+# Stages of the report
+
+def download(url, output_gz):
+    from preprocess_releases_xml_to_json import download_dump
+    download_dump(url, output_gz)
+
+
+def convert(input_gz, output_json, output_stats, output_quarantine):
+    import preprocess_releases_xml_to_json
+    preprocess_releases_xml_to_json.convert(input_gz, output_json, output_stats, output_quarantine)
+
+
+def load(input_json, output_hdf, output_tracks, output_titles, output_artist_names, output_stats):
+    from preprocess_releases_json_to_hdf_pandas import build_pandas_dump
+    build_pandas_dump(input_json, output_hdf, output_tracks, output_titles, output_artist_names, output_stats)
+
+
+def columns(input_hdf, output_columns):
+    from preprocess_releases_json_to_hdf_pandas import build_columnar_dump
+    build_columnar_dump(input_hdf, output_columns)
+
+
+def artist_index(input_columns, input_artist_names, output_index):
+    from preprocess_releases_json_to_hdf_pandas import build_artist_index
+    build_artist_index(input_columns, input_artist_names, output_index)
+
+
+def analysis(data, name, output):
+    stats = report.compute_analysis(name, data)
+    with open(output, 'wb') as f:
+        pickle.dump(stats, f, protocol=2)
+
+
+def figure(filename, stats_file, output):
+    with open(stats_file, 'rb') as f:
+        stats = pickle.load(f)
+    render(stats, filename, output)
+
+
+def data_figure(data, filename, output):
+    render(data, filename, output)
+
+
+def render(stats, filename, output):
+    import matplotlib
+    matplotlib.use('Agg')
+    plot, args = [(p, a) for f, _, p, a in report.report_figures() if f == filename][0]
+    report.render_figure(output, plot, args, stats)
+
+
+PREPROCESS_CODE = ['preprocess_releases_json_to_hdf_pandas', 'tracks', 'titles', 'artists', 'masters', 'datastats']
+ANALYSIS_CODE = ['analyze', 'report', 'parallel', 'masters', 'columnar', 'labels', 'tracks']
+FIGURE_CONFIG = ['START_YEAR', 'END_YEAR', 'PLOT_TITLES', 'PLOT_LARGE']
+
+
+def report_pipeline(output_dir=report.OUTPUT_DIR, results_dir=results_report, state=pipeline_state):
+    """
+    The pipeline of the report: preprocessing stages ('download', 'convert',
+    'load', 'columns', 'artist_index'), one 'analysis:<name>' stage per
+    analysis of report.py (pickled to 'results_dir') and one
+    'figure:<filename>' stage per figure (saved to 'output_dir')
+    """
+    stages = [
+        # the dump is only downloaded again if its url changes
+        Stage('download', download, (dump_url, dump_gz), outputs=[dump_gz], config=['dump_url'],
+              atomic=True),
+        Stage('convert', convert, (dump_gz, dump_json, dump_json_stats, dump_quarantine), after=['download'],
+              outputs=[dump_json, dump_json_stats, dump_quarantine, dump_quarantine + '.counts'],
+              optional=[dump_json_stats, dump_quarantine, dump_quarantine + '.counts'],
+              code=['preprocess_releases_xml_to_json', 'datastats', 'quarantine']),
+        # the json dump is also an input, as quarantined releases can be reprocessed into it
+        Stage('load', load, (dump_json, dump_pandas, dump_tracks, dump_titles, dump_artist_names, dump_stats),
+              after=['convert'], inputs=[taxonomy, dump_json],
+              outputs=[dump_pandas, dump_tracks, dump_titles, dump_artist_names, dump_stats],
+              optional=[dump_tracks, dump_titles, dump_artist_names, dump_stats],
+              config=['IGNORE_GENRES'], code=PREPROCESS_CODE),
+        Stage('columns', columns, (dump_pandas, dump_columns), after=['load'], outputs=[dump_columns],
+              code=PREPROCESS_CODE + ['columnar']),
+        Stage('artist_index', artist_index, (dump_columns, dump_artist_names, dump_artist_index),
+              after=['columns'], outputs=[dump_artist_index], code=PREPROCESS_CODE + ['columnar']),
+    ]
+    for name in sorted(report.ANALYSES):
+        stages.append(Stage('analysis:' + name, analysis, (name, os.path.join(results_dir, name + '.pickle')),
+                            after=['load'], outputs=[os.path.join(results_dir, name + '.pickle')],
+                            config=['IGNORE_GENRES', 'START_YEAR', 'END_YEAR'], code=ANALYSIS_CODE,
+                            data=True))
+    for filename, name, plot, args in report.report_figures():
+        output = os.path.join(output_dir, filename)
+        if name is None:
+            stages.append(Stage('figure:' + filename, data_figure, (filename, output), after=['load'],
+                                outputs=[output], config=FIGURE_CONFIG + ['IGNORE_GENRES'],
+                                code=ANALYSIS_CODE, data=True))
+        else:
+            stats_file = os.path.join(results_dir, name + '.pickle')
+            stages.append(Stage('figure:' + filename, figure, (filename, stats_file, output),
+                                after=['analysis:' + name], outputs=[output], config=FIGURE_CONFIG,
+                                code=['analyze', 'report']))
+    return Pipeline(stages, state)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the stages of the report that are not up to date")
+    parser.add_argument('stages', nargs='*', help="patterns of stages to run (all by default)")
+    parser.add_argument('--dry-run', action='store_true', help="only print the stages to run")
+    parser.add_argument('--force', nargs='+', default=(), help="patterns of stages to run even if up to date")
+    parser.add_argument('--touch', nargs='+', help="record existing outputs of these stages as up to date")
+    parser.add_argument('--processes', type=int, help="number of processes (number of CPUs by default)")
+    parser.add_argument('--list', action='store_true', help="list stages")
+    args = parser.parse_args()
+
+    import metrics
+    metrics.configure(metrics_log, metrics_prometheus)
+
+    pipeline = report_pipeline()
+    if args.list:
+        for name in pipeline.names:
+            print("%s <- %s" % (name, ', '.join(pipeline.stages[name].after)))
+    elif args.touch:
+        pipeline.touch(args.touch)
+    else:
+        completed, failed = pipeline.run(args.stages, args.force, args.dry_run, args.processes)
+        if failed:
+            print("%d stages failed: %s" % (len(failed), ', '.join(failed)))
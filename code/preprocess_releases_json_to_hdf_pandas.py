@@ -5,9 +5,17 @@
 Load json text dump with releases information into a pandas DataFrame
 '''
 from config import *
+from columnar import write_columns, ColumnStore
+from artists import ArtistIndex, save_artist_names, load_artist_names
+from masters import extract_master_id
+from tracks import TrackTableBuilder
+from titles import TitleIndexBuilder
+from datastats import StatsAccumulator
+import metrics
 import pandas
 import os.path
 import json
+from timeit import default_timer as clock
 
 
 # Helper functions for loading/preprocessing data
@@ -47,11 +55,16 @@ def extract_unofficial(formats):
     return 'Unofficial Release' in str(formats)
 
 
-def extract_artists(artists):
+def extract_artists(artists, names=None):
+    # keep only ids, optionally collecting artist names into 'names' dict
+    if names is not None:
+        for a in artists:
+            names[a['id']] = a['name']
     return [a['id'] for a in artists]
 
 
-def load_releases(size=None, part=100, ignore_genres=None):
+def load_releases(size=None, part=100, ignore_genres=None, input_dump=None, artist_names=None, tracks=None, titles=None,
+                  stats=None):
     """
     Load 'size' first releases from the json dump (load all releases if None).
     Use the 'part' parameter to specify a percentage of releases to load. For
@@ -59,23 +72,39 @@ def load_releases(size=None, part=100, ignore_genres=None):
     in the dump.
 
     By default, all releases will be loaded (size=None and part=100).
+    Use 'input_dump' to load a json dump other than the one in config.py.
+    Pass a dict as 'artist_names' to collect names of artists (artist id ->
+    name), which are otherwise discarded.
+    Pass a TrackTableBuilder as 'tracks' to collect all tracks of loaded
+    releases, including releases with partially annotated durations.
+    Pass a TitleIndexBuilder as 'titles' to index release and track titles.
+    Pass a StatsAccumulator as 'stats' to accumulate statistics of loaded
+    releases (see datastats.py).
     """
+    if input_dump is None:
+        input_dump = dump_json
+
     data = []
-    with open(dump_json, 'r') as f:
+    decode_seconds = 0.
+    transform_seconds = 0.
+    with open(input_dump, 'r') as f:
         i = 0
         for jsonline in f:
 
             # load only a percentage of the dataset selecting every Nth release
             if not i % (100/part):
 
+                start = clock()
                 release = json.loads(jsonline)
+                decoded = clock()
+                decode_seconds += decoded - start
 
                 # remove some columns that we won't use to save memory
                 del release['data_quality']
-                del release['title']
-                del release['labels']
-                if 'master_id' in release:
-                    del release['master_id']
+                title = release.pop('title')
+
+                # keep master release id as an integer (0 if there is no master)
+                release['master_id'] = extract_master_id(release.get('master_id'))
 
                 # if all tracks are annotated by duration ('tracks_duration' is present) then extract them
                 if release['tracks_duration'] is not None:
@@ -83,8 +112,8 @@ def load_releases(size=None, part=100, ignore_genres=None):
                         release.setdefault('tracks_duration_list', [])
                         release['tracks_duration_list'].append(t['duration']/60.)
 
-                # we don't need anything else from tracklist
-                del release['tracklist']
+                # we don't need anything else from tracklist in the release table
+                tracklist = release.pop('tracklist')
 
                 # convert "released" field to float (can't use integer because we need NaN support)
                 if 'released' in release:
@@ -101,20 +130,36 @@ def load_releases(size=None, part=100, ignore_genres=None):
                 release['formats'] = extract_formats(release['formats'])
 
                 # cleanup "artist" field
-                release['artists'] = extract_artists(release['artists'])
+                release['artists'] = extract_artists(release['artists'], artist_names)
+
+                if tracks is not None:
+                    tracks.add(tracklist, release['artists'])
+                if titles is not None:
+                    titles.add(title, tracklist)
+                if stats is not None and not (ignore_genres and
+                                              any(g in ignore_genres for g in release['genres'])):
+                    stats.add(release)
 
                 data.append(release)
+                transform_seconds += clock() - decoded
 
             i += 1
             if not i % 500000:
                 print("Processed %d releases" % i)
+                metrics.emit()
             if i == size:
                 break
+
+    metrics.add_time('json_decode', decode_seconds, len(data))
+    metrics.add_time('transform', transform_seconds, len(data))
     if data == []:
-        print("Error loading %s file" % dump_json)
+        print("Error loading %s file" % input_dump)
         return None
 
-    data = pandas.DataFrame(data)
+    with metrics.stage('dataframe_build', items=len(data)):
+        data = pandas.DataFrame(data)
+
+    data['master_id'] = data['master_id'].astype('int32')
 
     # convert tracks_duration from seconds to minutes
     data['tracks_duration'] = data['tracks_duration'] / 60.
@@ -126,13 +171,74 @@ def load_releases(size=None, part=100, ignore_genres=None):
         for g in ignore_genres:
             data = data[data['genres'].apply(lambda x: g not in x)]
 
+    # keep tracks and titles aligned with the remaining releases
+    if tracks is not None:
+        tracks.keep_releases(data.index.values)
+    if titles is not None:
+        titles.keep_releases(data.index.values)
+
     return data
 
 
-if os.path.isfile(dump_pandas):
-    print("Pandas dump file already found (%s)" % dump_pandas)
-else:
+def build_pandas_dump(input_json, output_hdf, output_tracks, output_titles, output_artist_names,
+                      output_stats=None):
+    """
+    Load the json dump and save the DataFrame, track table, title index,
+    artist names and dataset statistics (if 'output_stats' is given)
+    """
     print("Loading json dump into a pandas DataFrame")
-    data = load_releases(ignore_genres=IGNORE_GENRES, part=100)
-    print("Saving DataFrame to %s" % dump_pandas)
-    data.to_hdf(dump_pandas, 'w')
+    artist_names = {}
+    tracks = TrackTableBuilder()
+    titles = TitleIndexBuilder()
+    stats = StatsAccumulator() if output_stats else None
+    data = load_releases(ignore_genres=IGNORE_GENRES, part=100, input_dump=input_json,
+                         artist_names=artist_names, tracks=tracks, titles=titles, stats=stats)
+    if stats is not None:
+        print("Saving dataset statistics to %s" % output_stats)
+        stats.save(output_stats)
+    print("Saving track table to %s" % output_tracks)
+    with metrics.stage('tracks_write'):
+        tracks.table().save(output_tracks)
+    print("Saving title index to %s" % output_titles)
+    with metrics.stage('titles_write'):
+        titles.index().save(output_titles)
+    print("Saving artist names to %s" % output_artist_names)
+    save_artist_names(artist_names, output_artist_names)
+    print("Saving DataFrame to %s" % output_hdf)
+    with metrics.stage('hdf_write', items=len(data)):
+        data.to_hdf(output_hdf, 'w')
+
+
+def build_columnar_dump(input_hdf, output_columns):
+    """Save DataFrame columns for memory-mapped loading"""
+    print("Saving DataFrame columns for memory-mapped loading to %s" % output_columns)
+    with metrics.stage('hdf_read'):
+        data = pandas.read_hdf(input_hdf)
+    with metrics.stage('columns_write', items=len(data)):
+        write_columns(data, output_columns)
+
+
+def build_artist_index(input_columns, input_artist_names, output_index):
+    print("Building artist index %s" % output_index)
+    names = load_artist_names(input_artist_names) if os.path.isfile(input_artist_names) else None
+    with metrics.stage('artist_index'):
+        ArtistIndex.build(ColumnStore(input_columns), names).save(output_index)
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the hdf dump, columnar dump and artist index from the json dump")
+    parser.add_argument('--force', action='store_true', help="rebuild them even if they are up to date")
+    args = parser.parse_args()
+
+    if not os.path.isfile(dump_json):
+        print("No json dump %s, run preprocess_releases_xml_to_json.py first" % dump_json)
+        sys.exit(1)
+    metrics.configure(metrics_log, metrics_prometheus)
+
+    # rebuild the dumps that are not up to date from the existing json dump,
+    # without downloading or converting the XML dump (see pipeline.py)
+    from pipeline import report_pipeline
+    stages = ['load', 'columns', 'artist_index']
+    report_pipeline().run(stages, force=stages if args.force else (), dependencies=False)
@@ -11,14 +11,25 @@ from gzip import GzipFile
 import xmltodict
 import json
 import urllib
+import argparse
 import sys
 import os.path
+from timeit import default_timer as clock
 from hurry.filesize import size as filesize
 
 from config import *
+import metrics
+from datastats import StatsAccumulator
+from quarantine import Quarantine, read_quarantine
 
 processed = 0
 errors = 0
+release_stats = None
+quarantine = None
+
+# fields without which releases are quarantined, and their XML items
+REQUIRED_FIELDS = [('genres', 'genre'), ('artists', 'artist'), ('tracklist', 'track'),
+                   ('formats', 'format'), ('labels', 'label')]
 
 
 def download_progress(count, blockSize, totalSize):
@@ -27,142 +38,346 @@ def download_progress(count, blockSize, totalSize):
     sys.stdout.flush()
 
 
-def get_release(_, release):
+class TimedFile(object):
+    """File wrapper accounting time spent reading (decompressing) as a stage"""
 
-    global errors
-    global processed
+    def __init__(self, f, stage):
+        self.f = f
+        self.stage = stage
 
-    # remove unnecessary fields
-    if 'images' in release:
-        del release['images']
-    if 'notes' in release:
-        del release['notes']
-    if 'companies' in release:
-        del release['companies']
-    if 'identifiers' in release:
-        del release['identifiers']
-    if 'videos' in release:
-        del release['videos']
-    if 'extraartists' in release:
-        del release['extraartists']
+    def read(self, *args):
+        start = clock()
+        data = self.f.read(*args)
+        metrics.add_time(self.stage, clock() - start, len(data))
+        return data
 
-    # simplify some fields
+
+def parse_duration(duration):
+    """Duration in seconds of a 'm:s' or 'h:m:s' string (or with '.'), None if unexpected"""
     try:
-        release['genres'] = release['genres']['genre']
+        time = [int(x) for x in duration.split(':')]
+    except (AttributeError, ValueError):
+        try:
+            time = [int(x) for x in duration.split('.')]
+        except (AttributeError, ValueError):
+            return None
+    if len(time) == 2:
+        return time[0] * 60 + time[1]
+    elif len(time) == 3:
+        return (time[0] * 60 + time[1]) * 60 + time[2]
+    return None
+
+
+def reject_release(reason, release, detail=None):
+    global errors
+    errors += 1
+    metrics.add_error('get_release')
+    if quarantine is not None:
+        quarantine.reject(reason, release, release.get('@id'), detail)
 
-        if 'styles' in release:
-            release['styles'] = release['styles']['style']
-        else:
-            release['styles'] = []
 
-        release['artists'] = release['artists']['artist']
-        release['tracklist'] = release['tracklist']['track']
-        release['formats'] = release['formats']['format']
-        release['labels'] = release['labels']['label']
+def as_list(value):
+    return value if type(value) is list else [value]
 
-    except:
-        print("Error reading", json.dumps(release, indent=4))
-        errors += 1
-        return True
 
-    if type(release['genres']) is unicode:
-        release['genres'] = [release['genres']]
+def without(item, fields):
+    # copy of a dict of the XML dump without some fields
+    return dict((k, v) for k, v in item.items() if k not in fields)
 
-    if type(release['styles']) is unicode:
-        release['styles'] = [release['styles']]
 
-    if type(release['artists']) is not list:
-        release['artists'] = [release['artists']]
+ARTIST_FIELDS = ['anv', 'join', 'role', 'tracks']
+TRACK_FIELDS = ['extraartists', 'position']
 
-    if type(release['tracklist']) is not list:
-        release['tracklist'] = [release['tracklist']]
 
-    if type(release['formats']) is not list:
-        release['formats'] = [release['formats']]
+def simplify_release(release):
+    """
+    Simplify the fields of a release (with REQUIRED_FIELDS already extracted)
+    without modifying the values of the XML dump: lists, artists, tracks and
+    formats are new objects. Returns an unparseable duration of the release
+    (None if all durations are parsed).
+    """
+    styles = release.get('styles')
+    release['styles'] = styles['style'] if isinstance(styles, dict) and 'style' in styles else []
 
-    if type(release['labels']) is not list:
-        release['labels'] = [release['labels']]
+    if type(release['genres']) is unicode:
+        release['genres'] = [release['genres']]
 
-    release['labels'] = list(set([l['@name'] for l in release['labels']]))
+    if type(release['styles']) is unicode:
+        release['styles'] = [release['styles']]
 
-    for a in release['artists']:
-        del a['anv']
-        del a['join']
-        del a['role']
-        del a['tracks']
+    release['artists'] = [without(a, ARTIST_FIELDS) for a in as_list(release['artists'])]
+    release['formats'] = [without(f, ['@text']) for f in as_list(release['formats'])]
+    release['labels'] = list(set([l['@name'] for l in as_list(release['labels'])]))
 
+    bad_duration = None
     total_duration = 0
-    for t in release['tracklist']:
-        if 'extraartists' in t:
-            del t['extraartists']
-        del t['position']
-        # del t['title']
+    tracklist = []
+    for t in as_list(release['tracklist']):
+        t = without(t, TRACK_FIELDS)
+        # t['title'] is kept
 
         if 'artists' in t:
-            t['artists'] = t['artists']['artist']
-
-            if type(t['artists']) is not list:
-                t['artists'] = [t['artists']]
-
-            for ta in t['artists']:
-                del ta['anv']
-                del ta['join']
-                del ta['tracks']
-                del ta['role']
+            t['artists'] = [without(ta, ARTIST_FIELDS) for ta in as_list(t['artists']['artist'])]
 
         # convert duration to seconds
-        if t['duration'] is not None:
-            try:
-                time = [int(x) for x in t['duration'].split(':')]
-            except:
-                try:
-                    time = [int(x) for x in t['duration'].split('.')]
-                except:
-                    time = []
-
-            if len(time) > 3 or len(time) < 2:
-                print("ERROR: unexpected format for duration %s" % t['duration'])
-                t['duration'] = None
-
-            if len(time) == 2:
-                t['duration'] = time[0] * 60 + time[1]
-            elif len(time) == 3:
-                t['duration'] = (time[0] * 60 + time[1]) * 60 + time[2]
+        duration = t.get('duration')
+        if duration is not None:
+            t['duration'] = parse_duration(duration)
+            if t['duration'] is None:
+                bad_duration = duration
+        else:
+            t['duration'] = None
 
         if total_duration is not None and t['duration'] is not None:
             total_duration += t['duration']
         else:
             total_duration = None
+        tracklist.append(t)
 
-    release['tracks_number'] = len(release['tracklist'])
+    release['tracklist'] = tracklist
+    release['tracks_number'] = len(tracklist)
     release['tracks_duration'] = total_duration
+    return bad_duration
+
+
+def process_release(source):
+    """
+    Simplified copy of a release of the XML dump, 'source' is left unchanged
+    so that it can be quarantined as it is. Returns (release, reason, detail):
+    - release is None if it is rejected for 'reason' (missing_<field>, or
+      parse_error for malformed values)
+    - reason is 'bad_duration' for a release with unparseable track
+      durations, which are None in the release
+    """
+    release = dict(source)
+    for field, item in REQUIRED_FIELDS:
+        value = source.get(field)
+        if not isinstance(value, dict) or item not in value:
+            return None, 'missing_' + field, None
+        release[field] = value[item]
+    try:
+        bad_duration = simplify_release(release)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        return None, 'parse_error', '%s: %s' % (type(e).__name__, e)
+    if bad_duration is not None:
+        return release, 'bad_duration', bad_duration
+    return release, None, None
 
-    # clean format
-    for f in release['formats']:
-        if '@text' in f:
-            del f['@text']
 
+def get_release(_, release):
+
+    start = clock()
+
+    # remove unnecessary fields
+    if 'images' in release:
+        del release['images']
+    if 'notes' in release:
+        del release['notes']
+    if 'companies' in release:
+        del release['companies']
+    if 'identifiers' in release:
+        del release['identifiers']
+    if 'videos' in release:
+        del release['videos']
+    if 'extraartists' in release:
+        del release['extraartists']
+
+    # simplify some fields, quarantining releases that can't be simplified
+    simplified, reason, detail = process_release(release)
+    if simplified is None:
+        reject_release(reason, release, detail)
+        return True
+    if reason is not None:
+        # kept with unknown durations, and quarantined to be fixed later
+        metrics.add_error('duration')
+        if quarantine is not None:
+            quarantine.reject(reason, release, release.get('@id'), detail)
+
+    write_release(simplified, start)
+    return True
+
+
+def write_release(release, start):
+    global processed
+
+    if release_stats is not None:
+        add_release_stats(release)
+
+    transformed = clock()
     dump_json_f.write(json.dumps(release)+'\n')
+    metrics.add_time('get_release', transformed - start, 1)
+    metrics.add_time('write', clock() - transformed, 1)
 
     processed += 1
     if not processed % 10000:
         print("Processed %d releases" % processed)
-    return True
-
-
-if os.path.isfile(dump_gz):
-    print("Dump file already found (%s)" % dump_gz)
-else:
-    print("Downloading Discogs releases data dump archive (%s)" % dump_url)
-    urllib.URLopener().retrieve(url, dump_gz, reporthook=download_progress)
+        metrics.emit()
+
+
+def add_release_stats(release):
+    # statistics of releases of the dump, before they are filtered when loaded
+    formats = str(release['formats'])
+    release_stats.add({
+        'genres': release['genres'],
+        'styles': release['styles'],
+        'formats': [f['@name'] for f in release['formats']],
+        'country': release.get('country'),
+        'artists': [a['id'] for a in release['artists']],
+        'tracks_number': release['tracks_number'],
+        'tracks_duration': release['tracks_duration'],
+        'compilation': 'Compilation' in formats,
+        'mixed': "'Mixed'" in formats or "'Partially Mixed'" in formats,
+        'unofficial': 'Unofficial Release' in formats,
+    })
+
+
+def convert_dump(input_gz, output_json, output_stats=None, output_quarantine=None):
+    """
+    Parse the gzipped XML releases dump and store releases into a json dump,
+    statistics of the dump into 'output_stats' if given (see datastats.py)
+    and rejected releases into 'output_quarantine' if given (see quarantine.py)
+    """
+    global dump_json_f
+    global release_stats
+    global quarantine
+    dump_json_f = open(output_json, 'w')
+    release_stats = StatsAccumulator() if output_stats else None
+    quarantine = Quarantine(output_quarantine) if output_quarantine else None
+
+    # time spent in the XML parser is what remains after decompression,
+    # get_release transformations and writing
+    stages = ['decompress', 'get_release', 'write']
+    before = [metrics.seconds(s) for s in stages]
+    before_processed = processed
+    start = clock()
+    xmltodict.parse(TimedFile(GzipFile(input_gz), 'decompress'), item_depth=2, item_callback=get_release)
+    total = clock() - start
+    others = sum(metrics.seconds(s) for s in stages) - sum(before)
+    metrics.add_time('parse', total - others, processed - before_processed)
+    close_outputs(output_stats)
+
+
+def close_outputs(output_stats):
+    global release_stats
+    global quarantine
+    dump_json_f.close()
+    if release_stats is not None:
+        release_stats.save(output_stats)
+        release_stats = None
+    if quarantine is not None:
+        quarantine.close()
+        if quarantine.counts:
+            print(quarantine.summary())
+        quarantine = None
+
+
+def reprocess_quarantine(input_quarantine, output_json, output_stats=None):
+    """
+    Process again only the releases of a quarantine file (e.g., after a
+    parser fix):
+    - rejected releases that are accepted now are appended to the json dump
+    - releases of the dump with unparseable durations are replaced in the
+      dump if their durations are parsed now (the dump is rewritten)
+    Statistics 'output_stats' are updated (if they exist, recomputed if the
+    dump is rewritten), and the quarantine file is replaced by the records
+    that are still rejected.
+    """
+    global dump_json_f
+    global release_stats
+    global quarantine
+    quarantine = Quarantine(input_quarantine + '.tmp')
+
+    accepted = []
+    # id -> release replacing it in the dump (None to remove it)
+    replaced = {}
+    releases = 0
+    for reason, id, record in read_quarantine(input_quarantine):
+        releases += 1
+        release, new_reason, detail = process_release(record)
+        if reason == 'bad_duration':
+            # the release is in the dump, with unknown durations
+            if new_reason != 'bad_duration':
+                replaced[id] = release
+        elif release is not None:
+            accepted.append(release)
+        if new_reason is not None:
+            quarantine.reject(new_reason, record, id, detail)
+
+    added = len(accepted)
+    fixed = len([r for r in replaced.values() if r is not None])
+    rewrite = bool(replaced)
+    if rewrite:
+        print("Rewriting %s" % output_json)
+        dump_json_f = open(output_json + '.tmp', 'w')
+        release_stats = StatsAccumulator() if output_stats else None
+        with open(output_json, 'r') as f:
+            for line in f:
+                release = json.loads(line)
+                id = release.get('@id')
+                if id in replaced:
+                    release = replaced.pop(id)
+                    if release is None:
+                        continue
+                    line = json.dumps(release) + '\n'
+                dump_json_f.write(line)
+                if release_stats is not None:
+                    add_release_stats(release)
+        # releases missing from the dump are added
+        accepted += [r for r in replaced.values() if r is not None]
+    else:
+        dump_json_f = open(output_json, 'a')
+        if output_stats and os.path.isfile(output_stats):
+            release_stats = StatsAccumulator.load(output_stats)
+
+    for release in accepted:
+        write_release(release, clock())
+    close_outputs(output_stats)
+
+    if rewrite:
+        os.rename(output_json + '.tmp', output_json)
+    os.rename(input_quarantine + '.tmp', input_quarantine)
+    os.rename(input_quarantine + '.tmp.counts', input_quarantine + '.counts')
+    print("%d of %d quarantined releases reprocessed into %s: %d added, %d with durations fixed" %
+          (added + fixed, releases, output_json, added, fixed))
+
+
+def download_dump(url, output_gz):
+    """
+    Download the gzipped XML releases dump, an existing dump is only replaced
+    once the download is complete
+    """
+    print("Downloading Discogs releases data dump archive (%s)" % url)
+    partial = output_gz + '.part'
+    try:
+        with metrics.stage('download'):
+            urllib.URLopener().retrieve(url, partial, reporthook=download_progress)
+    except:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.rename(partial, output_gz)
     print("")
 
-if os.path.isfile(dump_json):
-    print("Json dump file already found (%s)" % dump_json)
-else:
-    print("Preprocessing data dump archive into json dump (%s)" % dump_json)
-    dump_json_f = open(dump_json, 'w')
-    xmltodict.parse(GzipFile(dump_gz), item_depth=2, item_callback=get_release)
 
+def convert(input_gz, output_json, output_stats=None, output_quarantine=None):
+    """Convert the releases dump to a json dump and report the number of releases"""
+    print("Preprocessing data dump archive into json dump (%s)" % output_json)
+    convert_dump(input_gz, output_json, output_stats, output_quarantine)
     print("%d releases loaded" % processed)
     print("%d releases skipped due to errors" % errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Download and convert the releases dump to a json dump")
+    parser.add_argument('--reprocess', action='store_true',
+                        help="only reprocess quarantined releases (%s) into the json dump" % dump_quarantine)
+    args = parser.parse_args()
+
+    metrics.configure(metrics_log, metrics_prometheus)
+
+    if args.reprocess:
+        reprocess_quarantine(dump_quarantine, dump_json, dump_json_stats)
+    else:
+        # download and convert the dump unless up to date (see pipeline.py)
+        from pipeline import report_pipeline
+        report_pipeline().run(['convert'])
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Quarantine (dead-letter) sink for records rejected while processing a dump.
+
+Rejected records are buffered and written in batches, each batch appended
+to the quarantine file as a gzip member of json lines with the reason code,
+the id and the record. Rejections are counted per reason code, and the
+counters are saved to a json sidecar (<quarantine file>.counts) when the sink
+is closed. Logging is sampled: only the first 'log_first' rejections of every
+reason are logged, then one in 'log_every'.
+
+Quarantined records are read back with read_quarantine, e.g., to reprocess
+only them after a parser fix (see preprocess_releases_xml_to_json.py).
+'''
+
+import gzip
+import json
+
+
+class Quarantine(object):
+    """
+    Sink for rejected records (see the module description)
+    - path: quarantine file (gzip-compressed json lines)
+    - batch: number of records buffered before they are written
+    - log_first, log_every: sampled logging of rejections per reason
+    - append: add to an existing quarantine file instead of replacing it
+    """
+
+    def __init__(self, path, batch=1000, log_first=5, log_every=10000, append=False):
+        self.path = path
+        self.batch = batch
+        self.log_first = log_first
+        self.log_every = log_every
+        self.counts = {}
+        self.pending = []
+        if not append:
+            gzip.open(path, 'wb').close()
+
+    def reject(self, reason, record, id=None, detail=None):
+        """Quarantine 'record' (json serializable) for 'reason' (a short code)"""
+        count = self.counts.get(reason, 0) + 1
+        self.counts[reason] = count
+        if count <= self.log_first or not count % self.log_every:
+            print("Quarantined %s for %s%s (%d so far)" %
+                  (id, reason, ': %s' % detail if detail is not None else '', count))
+        self.pending.append(json.dumps({'reason': reason, 'id': id, 'record': record}))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """Write buffered records as a new gzip member"""
+        if not self.pending:
+            return
+        f = gzip.open(self.path, 'ab')
+        try:
+            f.write(('\n'.join(self.pending) + '\n').encode('utf-8'))
+        finally:
+            f.close()
+        self.pending = []
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def summary(self):
+        return "%d records quarantined (%s)" % (self.total(), ', '.join(
+            '%s: %d' % (r, c) for r, c in sorted(self.counts.items())))
+
+    def close(self):
+        """Write buffered records and save counters"""
+        self.flush()
+        with open(self.path + '.counts', 'w') as f:
+            json.dump({'total': self.total(), 'counts': self.counts}, f, indent=2, sort_keys=True)
+
+
+def read_quarantine(path, reasons=None):
+    """Iterate over (reason, id, record) of a quarantine file, only for 'reasons' if given"""
+    f = gzip.open(path, 'rb')
+    try:
+        for line in f:
+            entry = json.loads(line.decode('utf-8'))
+            if reasons is None or entry['reason'] in reasons:
+                yield entry['reason'], entry['id'], entry['record']
+    finally:
+        f.close()
+
+
+def quarantine_counts(path):
+    """Counters of a closed quarantine file (reason -> number of records)"""
+    with open(path + '.counts', 'r') as f:
+        return json.load(f)['counts']
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Batch rendering of the report figures (examples/images) without a display.
+
+Figures are drawn from the statistics of a few analyses (ANALYSES), e.g.,
+all the style duration boxplots are drawn from one analysis of durations of
+all styles. Every analysis is computed once, in a pool of processes, and
+its figures are rendered on the Agg backend by the same process: each
+plt.show() call of a plotting function saves the current figure to the
+figure's file and closes it instead of showing it. The dataset is loaded
+once in the parent process and shared with the workers (fork).
+
+pipeline.py runs analyses and figures as separate cached stages.
+
+Usage:
+    python report.py [--dump DUMP] [--output ../examples/images] [--processes N]
+                     [--only NAME [NAME ...]]
+'''
+
+import os
+import argparse
+import warnings
+import multiprocessing
+
+from config import *
+
+
+OUTPUT_DIR = '../examples/images'
+
+GENRE_FILES = {
+    'Blues': 'blues', 'Classical': 'classical', 'Electronic': 'electronic',
+    'Folk, World, & Country': 'folkworldcountry', 'Funk / Soul': 'funksoul',
+    'Hip Hop': 'hiphop', 'Jazz': 'jazz', 'Latin': 'latin', 'Pop': 'pop',
+    'Reggae': 'reggae', 'Rock': 'rock',
+}
+
+ELECTRONIC_STYLE_FILES = {
+    'Ambient': 'ambient', 'Deep House': 'deephouse', 'Drum n Bass': 'drumnbass',
+    'Dubstep': 'dubstep', 'Experimental': 'experimental', 'Glitch': 'glitch',
+    'House': 'house', 'IDM': 'idm', 'Psy-Trance': 'psytrance', 'Synth-pop': 'synthpop',
+    'Techno': 'techno',
+}
+
+
+def genres_of(data):
+    import analyze
+    return [g for g in analyze.find_genres(data) if g not in IGNORE_GENRES]
+
+
+def styles_of(data):
+    import analyze
+    return analyze.find_styles(data)
+
+
+def genre_styles(keys, genre):
+    styles = [s for s in keys if type(s) is tuple and s[0] == genre]
+    if not styles:
+        raise ValueError("No styles of %s in data" % genre)
+    return styles
+
+
+# Analyses: statistics of the figures computed from the release data
+
+def analysis_coverage(data):
+    import analyze
+    return analyze.releases_coverage(data)
+
+
+def analysis_durations(data, type):
+    import analyze
+    genres = genres_of(data) if type.startswith('genre') else styles_of(data)
+    return analyze.track_duration_per_genre(data, genres, type)
+
+
+def analysis_durations_evolution(data):
+    import analyze
+    return analyze.track_durations_evolution(data, genres_of(data))
+
+
+def analysis_formats(data, type):
+    import analyze
+    return analyze.compare_formats(data, type=type)
+
+
+def analysis_genres(data, metric):
+    import analyze
+    return analyze.compare_genres(data, metric, genres=genres_of(data))
+
+
+def analysis_styles(data, metric):
+    import analyze
+    return analyze.compare_genres(data, metric, styles=styles_of(data))
+
+
+def analysis_cooccurrences(data, type):
+    import analyze
+    return analyze.genre_cooccurences_matrix(data, type=type,
+                                             rename=analyze.rename_style if type == 'style' else None)
+
+
+def analysis_style_cooccurrences(data, style):
+    import analyze
+    # shares of other styles among the releases of the style
+    return analyze.style_cooccurences_by_year(analyze.select_style(data, style), style)
+
+
+ANALYSES = {
+    'coverage': (analysis_coverage, ()),
+    'durations_genre': (analysis_durations, ('genre',)),
+    'durations_genre_only': (analysis_durations, ('genre_only',)),
+    'durations_style': (analysis_durations, ('style',)),
+    'durations_evolution': (analysis_durations_evolution, ()),
+    'formats_releases': (analysis_formats, ('releases',)),
+    'formats_tracks': (analysis_formats, ('tracks',)),
+    'genres_releases': (analysis_genres, ('releases',)),
+    'genres_tracks': (analysis_genres, ('tracks',)),
+    'genres_artists': (analysis_genres, ('artists',)),
+    'styles_tracks': (analysis_styles, ('tracks',)),
+    'cooccurrences_genre': (analysis_cooccurrences, ('genre',)),
+    'cooccurrences_style': (analysis_cooccurrences, ('style',)),
+    'cooccurrences_house': (analysis_style_cooccurrences, (('Electronic', 'House'),)),
+}
+
+
+def compute_analysis(name, data):
+    function, args = ANALYSES[name]
+    return function(data, *args)
+
+
+# Figures: plots of the statistics of an analysis (or of the release data)
+
+def plot_coverage(stats):
+    import analyze
+    analyze.show_releases_coverage(stats['coverage_genres'], type='genre')
+
+
+def plot_countries(data):
+    import analyze
+    analyze.coverage_countries_evolution(data)
+
+
+def plot_durations(stats, type, genre=None):
+    import analyze
+    if genre is not None:
+        stats = dict((s, stats[s]) for s in genre_styles(stats, genre))
+    analyze.plot_track_durations(stats, type, shorten_stylenames=genre is not None)
+
+
+def plot_durations_evolution(stats, genre):
+    import analyze
+    analyze.plot_track_durations_evolution(stats, [genre])
+
+
+def plot_formats(stats, type, absolute):
+    import analyze
+    analyze.plot_compare_formats(stats, type, absolute=absolute)
+
+
+def plot_evolution(stats, metric, absolute, genre=None, styles=None):
+    import analyze
+    if genre is not None:
+        styles = genre_styles(stats.columns, genre)
+    if styles is None:
+        keys = [k for k in stats.columns if k not in ['years', 'all']]
+    else:
+        keys = styles
+    analyze.plot_compare_genres(stats, metric, keys, absolute=absolute, shorten=styles is not None)
+
+
+def plot_cooccurrences(matrix):
+    import analyze
+    analyze.plot_genre_cooccurences_matrix(matrix)
+
+
+def plot_style_cooccurrences(stats):
+    import analyze
+    analyze.plot_style_cooccurences_by_year(stats)
+
+
+def report_figures():
+    """
+    Return the list of (filename, analysis, plot function, arguments) of
+    the figures of the report. The plot function is called with the
+    statistics of the analysis (with the release data if analysis is None)
+    and the arguments.
+    """
+    figures = [
+        ('genre_coverage.png', 'coverage', plot_coverage, ()),
+        ('country_year_example.png', None, plot_countries, ()),
+        ('durations_genres_all.png', 'durations_genre', plot_durations, ('genre',)),
+        ('durations_genres_only.png', 'durations_genre_only', plot_durations, ('genre_only',)),
+        ('durations_styles_allstyles.png', 'durations_style', plot_durations, ('style',)),
+        ('genre_cooccurrence.png', 'cooccurrences_genre', plot_cooccurrences, ()),
+        ('style_cooccurrence.png', 'cooccurrences_style', plot_cooccurrences, ()),
+        ('style_cooccurrence_evolution_house.png', 'cooccurrences_house', plot_style_cooccurrences, ()),
+    ]
+    for type in ['releases', 'tracks']:
+        figures.append(('formats_overall_%s_number.png' % type, 'formats_' + type, plot_formats, (type, True)))
+        figures.append(('formats_overall_%s_percentage.png' % type, 'formats_' + type, plot_formats,
+                        (type, False)))
+    for metric in ['releases', 'tracks', 'artists']:
+        figures.append(('%s_number.png' % metric, 'genres_' + metric, plot_evolution, (metric, True)))
+        figures.append(('%s_percentage.png' % metric, 'genres_' + metric, plot_evolution, (metric, False)))
+    for genre, name in sorted(GENRE_FILES.items()):
+        figures.append(('duration_styles_%s.png' % name, 'durations_style', plot_durations, ('style', genre)))
+        figures.append(('duration_evolution_%s.png' % name, 'durations_evolution', plot_durations_evolution,
+                        (genre,)))
+        figures.append(('tracks_percentage_%s.png' % name, 'styles_tracks', plot_evolution,
+                        ('tracks', False, genre)))
+    for style, name in sorted(ELECTRONIC_STYLE_FILES.items()):
+        figures.append(('tracks_percentage_electronic_%s.png' % name, 'styles_tracks', plot_evolution,
+                        ('tracks', False, None, [('Electronic', style)])))
+    return figures
+
+
+# Rendering
+
+_data = None
+
+
+def _init_worker(dump):
+    # forked workers already have the data, others load it
+    global _data
+    import matplotlib
+    matplotlib.use('Agg')
+    if _data is None:
+        import analyze
+        _data = analyze.load_release_dump(dump)
+
+
+def render_figure(filename, plot, args, stats):
+    """
+    Draw a figure with plot(stats, *args), saving figures shown by
+    plt.show() to 'filename' (additional figures get numbered files).
+    Returns the list of saved files.
+    """
+    import analyze
+    plt = analyze.pyplot()
+    base, extension = os.path.splitext(filename)
+    saved = []
+
+    def save_figure(*args, **kwargs):
+        name = filename if not saved else '%s_%03d%s' % (base, len(saved) + 1, extension)
+        plt.gcf().savefig(name, bbox_inches='tight')
+        plt.close('all')
+        saved.append(name)
+
+    show = plt.show
+    plt.show = save_figure
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            plot(stats, *args)
+        if plt.get_fignums():
+            save_figure()
+    finally:
+        plt.close('all')
+        plt.show = show
+    return saved
+
+
+def _render(job):
+    """Compute an analysis and render its figures"""
+    analysis, figures = job
+    try:
+        stats = _data if analysis is None else compute_analysis(analysis, _data)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        return [(filename, [], error) for filename, _, _ in figures]
+    results = []
+    for filename, plot, args in figures:
+        try:
+            results.append((filename, render_figure(filename, plot, args, stats), None))
+        except Exception as e:
+            results.append((filename, [], '%s: %s' % (type(e).__name__, e)))
+    return results
+
+
+def render_figures(data=None, dump=dump_pandas, output_dir=OUTPUT_DIR, figures=None, processes=None):
+    """
+    Render report figures to files across a pool of processes
+    - data: release DataFrame (loaded from 'dump' if not given)
+    - output_dir: directory for the images
+    - figures: list of figures as returned by report_figures() (all by default)
+    - processes: number of processes (number of CPUs by default)
+    Returns the list of (filename, saved files, error) for all figures.
+    """
+    global _data
+    import analyze
+    if data is None:
+        print("Loading release dump from %s" % dump)
+        data = analyze.load_release_dump(dump)
+    if figures is None:
+        figures = report_figures()
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    # one job per analysis, figures without analysis are jobs of their own
+    jobs = []
+    by_analysis = {}
+    for filename, analysis, plot, args in figures:
+        figure = (os.path.join(output_dir, filename), plot, args)
+        if analysis is None:
+            jobs.append((None, [figure]))
+        elif analysis in by_analysis:
+            by_analysis[analysis][1].append(figure)
+        else:
+            by_analysis[analysis] = (analysis, [figure])
+            jobs.append(by_analysis[analysis])
+
+    _data = data
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(dump,))
+    try:
+        results = []
+        for job_results in pool.imap_unordered(_render, jobs):
+            for filename, saved, error in job_results:
+                if error:
+                    print("ERROR rendering %s: %s" % (filename, error))
+                else:
+                    print("Saved %s" % ', '.join(saved))
+            results += job_results
+    finally:
+        pool.close()
+        pool.join()
+        _data = None
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render all report figures to files")
+    parser.add_argument('--dump', default=dump_pandas, help="release dump (HDF file)")
+    parser.add_argument('--output', default=OUTPUT_DIR, help="directory for the images")
+    parser.add_argument('--processes', type=int, help="number of processes (number of CPUs by default)")
+    parser.add_argument('--only', nargs='+', help="only render these images (file names)")
+    args = parser.parse_args()
+    import metrics
+    metrics.configure(metrics_log, metrics_prometheus)
+
+    figures = report_figures()
+    if args.only:
+        figures = [f for f in figures if f[0] in args.only]
+    render_figures(dump=args.dump, output_dir=args.output, figures=figures, processes=args.processes)
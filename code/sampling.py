@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Streaming uniform and stratified sampling of release dumps.
+
+Releases are read chunk by chunk from a columnar dump (see columnar.py).
+Every release gets a random key drawn from a seeded generator, and for each
+stratum the releases with the smallest keys are kept (bottom-k sampling,
+equivalent to reservoir sampling). Only row numbers and keys of the current
+sample are kept in memory; a second pass writes the sampled releases chunk
+by chunk.
+'''
+
+import os.path
+import numpy as np
+import pandas
+
+from columnar import ColumnStore, ColumnWriter
+
+
+STRATIFY = [None, 'year', 'country', 'genre']
+
+
+def chunk_bounds(length, chunksize):
+    for start in range(0, length, chunksize):
+        yield start, min(start + chunksize, length)
+
+
+def stratum_labels(source, start, stop, stratify):
+    """
+    Return an integer stratum label for releases from 'start' to 'stop'
+    of a columnar dump
+    - stratify=None: a single stratum
+    - stratify='year': release year (-1 if unknown)
+    - stratify='country': country code (-1 if unknown)
+    - stratify='genre': code of the first listed genre (-1 if none)
+    """
+    if stratify is None:
+        return np.zeros(stop - start, dtype=np.int64)
+    elif stratify == 'year':
+        years = np.asarray(source.numeric('released')[start:stop])
+        return np.where(np.isnan(years), -1, np.nan_to_num(years)).astype(np.int64)
+    elif stratify == 'country':
+        return np.asarray(source.categorical('country')[start:stop], dtype=np.int64)
+    elif stratify == 'genre':
+        offsets, codes = source.multivalued('genres')
+        first = np.asarray(offsets[start:stop])
+        has_genre = np.asarray(offsets[start+1:stop+1]) > first
+        labels = np.full(stop - start, -1, dtype=np.int64)
+        labels[has_genre] = codes[first[has_genre]]
+        return labels
+    raise ValueError("Wrong stratify value: %s" % stratify)
+
+
+def dataframe_labels(data, stratify):
+    """
+    Return stratum labels for all releases of a DataFrame (see stratum_labels)
+    and the list of stratum values corresponding to labels
+    """
+    if stratify is None:
+        return np.zeros(len(data), dtype=np.int64), None
+    elif stratify == 'year':
+        return data['released'].fillna(-1).values.astype(np.int64), None
+    elif stratify == 'country':
+        labels, values = pandas.factorize(data['country'])
+    elif stratify == 'genre':
+        labels, values = pandas.factorize(data['genres'].apply(lambda x: x[0] if len(x) else None))
+    else:
+        raise ValueError("Wrong stratify value: %s" % stratify)
+    return labels.astype(np.int64), list(values)
+
+
+def label_of(source, stratify, value, values=None):
+    """Return the stratum label for a stratum value (year, country or genre name)"""
+    if stratify is None or stratify == 'year':
+        return int(value)
+    if values is not None:
+        return values.index(value) if value in values else -2
+    code = source.code('country' if stratify == 'country' else 'genres', value)
+    return -2 if code is None else code
+
+
+def sample_rows(source, fraction=None, size=None, stratify=None, quotas=None,
+                seed=None, chunksize=100000):
+    """
+    Select release rows streaming over the dump chunk by chunk.
+    - fraction: sample this fraction of releases from every stratum
+    - size: sample this total number of releases (split proportionally among strata)
+    - stratify: None, 'year', 'country' or 'genre' (see stratum_labels)
+    - quotas: dict of stratum value -> number of releases to sample,
+              overriding proportional quotas (e.g., {'US': 1000, 'UK': 500})
+    - seed: random seed, the sample is deterministic for a given seed
+    Returns sorted row numbers.
+    """
+    if stratify not in STRATIFY:
+        raise ValueError("Wrong stratify value: %s" % stratify)
+
+    if isinstance(source, ColumnStore):
+        values = None
+        get_labels = lambda start, stop: stratum_labels(source, start, stop, stratify)
+    else:
+        # a DataFrame is already in memory, label all releases at once
+        all_labels, values = dataframe_labels(source, stratify)
+        get_labels = lambda start, stop: all_labels[start:stop]
+
+    # per-stratum quotas
+    quota = {}
+    if fraction is not None or size is not None:
+        counts = {}
+        for start, stop in chunk_bounds(len(source), chunksize):
+            labels, n = np.unique(get_labels(start, stop), return_counts=True)
+            for l, c in zip(labels.tolist(), n.tolist()):
+                counts[l] = counts.get(l, 0) + c
+        if fraction is None:
+            fraction = float(size) / max(len(source), 1)
+        for l, c in counts.items():
+            quota[l] = int(round(fraction * c))
+    if quotas:
+        for value, k in quotas.items():
+            quota[label_of(source, stratify, value, values)] = k
+
+    labels_known = np.array(sorted(quota), dtype=np.int64)
+    quota_known = np.array([quota[l] for l in labels_known], dtype=np.int64)
+
+    random = np.random.RandomState(seed)
+    kept_labels = np.zeros(0, dtype=np.int64)
+    kept_keys = np.zeros(0)
+    kept_rows = np.zeros(0, dtype=np.int64)
+
+    for start, stop in chunk_bounds(len(source), chunksize):
+        labels = np.concatenate([kept_labels, get_labels(start, stop)])
+        keys = np.concatenate([kept_keys, random.random_sample(stop - start)])
+        rows = np.concatenate([kept_rows, np.arange(start, stop, dtype=np.int64)])
+
+        # rank releases by key within each stratum and keep the smallest keys
+        order = np.lexsort((keys, labels))
+        labels, keys, rows = labels[order], keys[order], rows[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(labels)) + 1]
+        rank = np.arange(len(labels)) - np.repeat(starts, np.diff(np.r_[starts, len(labels)]))
+
+        index = np.searchsorted(labels_known, labels)
+        index[index == len(labels_known)] = 0
+        limit = np.where(labels_known[index] == labels, quota_known[index], 0) \
+            if len(labels_known) else np.zeros(len(labels), dtype=np.int64)
+        keep = rank < limit
+        kept_labels, kept_keys, kept_rows = labels[keep], keys[keep], rows[keep]
+
+    return np.sort(kept_rows)
+
+
+def write_rows(source, rows, sampled_dump, chunksize=100000):
+    """
+    Write selected release rows to 'sampled_dump'.
+    Writes a columnar dump chunk by chunk unless the filename has a .hdf or
+    .h5 extension: hdf dumps can't be appended to, so the whole sample is
+    decoded in memory and written at once.
+    """
+    if os.path.splitext(sampled_dump)[1] in ('.hdf', '.h5'):
+        if isinstance(source, ColumnStore):
+            data = source.to_dataframe(rows=rows)
+        else:
+            data = source.iloc[rows]
+        data.to_hdf(sampled_dump, 'w')
+        return
+
+    writer = ColumnWriter(sampled_dump)
+    for start, stop in chunk_bounds(len(source), chunksize):
+        selected = rows[(rows >= start) & (rows < stop)]
+        if not len(selected):
+            continue
+        if isinstance(source, ColumnStore):
+            writer.append(source.to_dataframe(rows=selected))
+        else:
+            writer.append(source.iloc[selected])
+    writer.close()
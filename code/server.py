@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Local analytics query service over the release dataset.
+
+The server loads a release dump once and answers analyze.py queries over
+HTTP on localhost (or on a Unix socket), so that notebooks and report jobs
+do not each re-load the dataset. Requests are served concurrently by a fixed
+pool of threads, and results are kept in an LRU cache keyed by the query.
+
+Queries are paths named after operations with parameters given either in the
+query string (values are parsed as json when possible) or as a json body:
+
+    curl 'localhost:8642/select?genre=Rock&year=2000'
+    curl 'localhost:8642/compare_genres' -d '{"genres": ["Rock", "Jazz"]}'
+    curl --unix-socket /tmp/discogs.sock 'localhost/releases_stats'
+
+Styles are given as [genre, style] pairs. GET / lists operations and their
+parameters; other parameters are rejected.
+
+Usage:
+    python server.py [--dump DUMP] [--port 8642 | --socket PATH] [--threads 8] [--cache 256]
+'''
+
+import os
+import json
+import numbers
+import argparse
+import threading
+from collections import OrderedDict
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import UnixStreamServer
+    from urlparse import urlparse, parse_qs
+    from Queue import Queue
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+    from queue import Queue
+
+import numpy as np
+import pandas
+
+from config import *
+import analyze
+import metrics
+from columnar import ColumnStore
+
+
+LOCAL_HOSTS = ['127.0.0.1', 'localhost']
+
+# parameters taking lists of values
+LIST_PARAMS = ['genres', 'styles', 'formats', 'countries']
+
+
+# Operations
+
+def run_select(data, limit=100, **params):
+    releases = analyze.select(data, **params)
+    return {'releases': len(releases), 'ids': list(releases['@id'][:limit])}
+
+
+def run_duration_stats(data, genres, type='genre', durations=False, **params):
+    # lists of all durations are large, only return them on demand
+    stats = analyze.track_duration_per_genre(data, genres, type, **params)
+    if not durations:
+        for g in stats:
+            del stats[g]['durations']
+    return stats
+
+
+OPERATIONS = {
+    'select': run_select,
+    'releases_stats': analyze.releases_stats,
+    'releases_coverage': analyze.releases_coverage,
+    'compare_genres': analyze.compare_genres,
+    'compare_formats': analyze.compare_formats,
+    'track_duration_per_genre': run_duration_stats,
+    'genre_cooccurences_matrix': analyze.genre_cooccurences_matrix,
+}
+
+
+# Parameters and results
+
+class QueryError(Exception):
+    """Invalid query parameters (answered with 400)"""
+
+
+def is_text(value):
+    return isinstance(value, (str, type(u'')))
+
+
+def text(value):
+    if not is_text(value):
+        raise QueryError("expected a string, got %s" % json.dumps(value))
+    return value
+
+
+def integer(value):
+    if isinstance(value, bool) or not isinstance(value, numbers.Integral):
+        raise QueryError("expected an integer, got %s" % json.dumps(value))
+    return value
+
+
+def flag(value):
+    if not isinstance(value, bool):
+        raise QueryError("expected true or false, got %s" % json.dumps(value))
+    return value
+
+
+def style(value):
+    # styles are (genre, style) tuples, json only has lists
+    if not (isinstance(value, list) and len(value) == 2 and all(is_text(v) for v in value)):
+        raise QueryError("expected a [genre, style] pair, got %s" % json.dumps(value))
+    return tuple(value)
+
+
+def category(value):
+    # a genre or a style
+    return style(value) if isinstance(value, list) else text(value)
+
+
+def list_of(kind):
+    def check(value):
+        if not isinstance(value, list):
+            raise QueryError("expected a list, got %s" % json.dumps(value))
+        return [kind(v) for v in value]
+    return check
+
+
+def one_of(*choices):
+    def check(value):
+        if value not in choices:
+            raise QueryError("expected one of %s, got %s" % (', '.join(choices), json.dumps(value)))
+        return value
+    return check
+
+
+# operation -> accepted parameters and their types
+PARAMS = {
+    'select': {'genre': text, 'style': style, 'format': text, 'year': integer,
+               'country': text, 'tracks': integer, 'limit': integer},
+    'releases_stats': {},
+    'releases_coverage': {'by_master': flag},
+    'compare_genres': {'metric': one_of('releases', 'tracks', 'artists'),
+                       'genres': list_of(text), 'styles': list_of(style),
+                       'country': text, 'format': text, 'start_year': integer,
+                       'end_year': integer, 'by_master': flag},
+    'compare_formats': {'formats': list_of(text), 'genre': text, 'style': style,
+                        'type': one_of('releases', 'tracks'), 'start_year': integer,
+                        'end_year': integer, 'by_master': flag},
+    'track_duration_per_genre': {'genres': list_of(category),
+                                 'type': one_of('genre', 'style', 'genre_only', 'style_only'),
+                                 'durations': flag},
+    'genre_cooccurences_matrix': {'genres': list_of(category), 'type': one_of('genre', 'style')},
+}
+# operation -> parameters without a default value
+REQUIRED = {'track_duration_per_genre': ['genres']}
+
+
+def decode_query(query):
+    """
+    Decode query string parameters, parsing values as json when possible.
+    List parameters (e.g., genres) can be repeated or given as a json list.
+    """
+    params = {}
+    for name, values in parse_qs(query).items():
+        values = [parse_value(v) for v in values]
+        if name in LIST_PARAMS and not (len(values) == 1 and isinstance(values[0], list)):
+            params[name] = values
+        else:
+            params[name] = values[-1]
+    return params
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def check_params(operation, params):
+    """
+    Check query parameters against the parameters accepted by an operation
+    (see PARAMS), raising QueryError for unknown, missing or invalid ones.
+    Returns the parameters converted for analyze.py (e.g., style tuples).
+    """
+    accepted = PARAMS[operation]
+    checked = {}
+    for name, value in params.items():
+        if name not in accepted:
+            raise QueryError("unknown parameter %s for %s, accepted: %s"
+                             % (name, operation, ', '.join(sorted(accepted))))
+        try:
+            # keyword names must be str in Python 2
+            checked[str(name)] = accepted[name](value)
+        except QueryError as e:
+            raise QueryError("%s: %s" % (name, e))
+    for name in REQUIRED.get(operation, []):
+        if name not in checked:
+            raise QueryError("missing parameter %s for %s" % (name, operation))
+    return checked
+
+
+def jsonable(value):
+    """Convert results (DataFrames, numpy values, sets, tuples) to json types"""
+    if isinstance(value, pandas.DataFrame):
+        return {'columns': jsonable(list(value.columns)),
+                'index': jsonable(list(value.index)),
+                'data': jsonable(value.values.tolist())}
+    if isinstance(value, pandas.Series):
+        return jsonable(value.to_dict())
+    if isinstance(value, dict):
+        return dict((jsonable_key(k), jsonable(v)) for k, v in value.items())
+    if isinstance(value, (set, frozenset)):
+        return jsonable(sorted(value))
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def jsonable_key(key):
+    if isinstance(key, tuple):
+        return analyze.rename_style(key)
+    if isinstance(key, np.generic):
+        key = key.item()
+    return key if isinstance(key, (str, type(u''))) else str(key)
+
+
+class ResultCache(object):
+    """Thread-safe LRU cache of serialized results"""
+
+    def __init__(self, size):
+        self.size = size
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.results.pop(key, None)
+            if body is not None:
+                self.results[key] = body
+            return body
+
+    def put(self, key, body):
+        with self.lock:
+            self.results.pop(key, None)
+            self.results[key] = body
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+
+# Server
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    def address_string(self):
+        # no client address on Unix sockets
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.query(url.path.strip('/'), decode_query(url.query))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+        except ValueError:
+            return self.respond(400, {'error': 'invalid json body'})
+        if not isinstance(body, dict):
+            return self.respond(400, {'error': 'json body must be an object'})
+        params = decode_query(url.query)
+        params.update(body)
+        self.query(url.path.strip('/'), params)
+
+    def query(self, name, params):
+        if not name:
+            return self.respond(200, {'releases': len(self.server.data),
+                                      'operations': dict((op, sorted(PARAMS[op])) for op in OPERATIONS)})
+        if name not in OPERATIONS:
+            return self.respond(404, {'error': 'unknown operation %s' % name})
+        try:
+            params = check_params(name, params)
+        except QueryError as e:
+            return self.respond(400, {'error': str(e)})
+
+        key = json.dumps([name, params], sort_keys=True)
+        body = self.server.cache.get(key)
+        if body is not None:
+            metrics.add_items('server.cache_hits')
+        else:
+            try:
+                with metrics.stage('server.' + name):
+                    result = OPERATIONS[name](self.server.data, **params)
+                body = json.dumps(jsonable(result)).encode('utf-8')
+            except Exception as e:
+                error = '%s: %s' % (type(e).__name__, e)
+                self.log_error("%s failed: %s", name, error)
+                return self.respond(500, {'error': error})
+            self.server.cache.put(key, body)
+        self.send_body(200, body)
+
+    def respond(self, code, result):
+        self.send_body(code, json.dumps(result).encode('utf-8'))
+
+    def send_body(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PoolMixIn(object):
+    """Handle requests with a fixed pool of worker threads"""
+
+    threads = server_threads
+
+    def start_workers(self):
+        self.requests = Queue()
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self.process_requests)
+            worker.daemon = True
+            worker.start()
+
+    def process_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+
+class LocalHTTPServer(PoolMixIn, HTTPServer):
+    pass
+
+
+class UnixHTTPServer(PoolMixIn, UnixStreamServer):
+    pass
+
+
+def make_server(data, host='127.0.0.1', port=server_port, socket=None,
+                threads=server_threads, cache_size=server_cache_size):
+    """
+    Create a query server for release data (a DataFrame, load columnar dumps
+    with load_release_dump without mapped=True)
+    - host, port: address to listen on (localhost only)
+    - socket: listen on this Unix socket path instead
+    - threads: number of threads serving requests
+    - cache_size: number of results to keep in cache
+    Call serve_forever() on the result to start serving.
+    """
+    if isinstance(data, ColumnStore):
+        raise ValueError("The query server needs a DataFrame, not a ColumnStore")
+    if socket:
+        if os.path.exists(socket):
+            os.remove(socket)
+        server = UnixHTTPServer(socket, QueryHandler)
+    else:
+        if host not in LOCAL_HOSTS:
+            raise ValueError("The query server only listens on localhost, not %s" % host)
+        server = LocalHTTPServer((host, port), QueryHandler)
+    server.data = data
+    server.cache = ResultCache(cache_size)
+    server.threads = threads
+    server.start_workers()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve analysis queries over the release dataset on localhost")
+    parser.add_argument('--dump', default=dump_pandas,
+                        help="release dump (HDF file or columnar dump directory)")
+    parser.add_argument('--port', type=int, default=server_port, help="port on localhost")
+    parser.add_argument('--socket', help="listen on a Unix socket instead of a port")
+    parser.add_argument('--threads', type=int, default=server_threads, help="number of serving threads")
+    parser.add_argument('--cache', type=int, default=server_cache_size, help="number of cached results")
+    args = parser.parse_args()
+    metrics.configure(metrics_log, metrics_prometheus)
+
+    print("Loading %s" % args.dump)
+    data = analyze.load_release_dump(args.dump)
+    server = make_server(data, port=args.port, socket=args.socket,
+                         threads=args.threads, cache_size=args.cache)
+    print("Serving %d releases on %s" % (len(data), args.socket or 'localhost:%d' % args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
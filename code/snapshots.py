@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Multi-snapshot store to study how annotations change across Discogs dumps.
+
+Snapshots (release DataFrames loaded from different dumps) share:
+- a release row ordering: release ids in order of first appearance, so that
+  the same release has the same row in every snapshot
+- vocabularies of genres, styles, formats and countries (integer codes)
+
+The first snapshot is the base. Every other snapshot is stored as a delta
+against the base: a bit mask of present releases, and for every column only
+the rows whose values differ from the base with their new values. Annotations
+change slowly, so that N snapshots cost about one dataset plus the changes.
+
+Tracked columns: release year and country (one value per release, -1 if
+unknown), genres, styles and formats (CSR lists of codes, sorted within
+each release). Comparisons between snapshots are vectorized over rows.
+'''
+
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+import pandas
+
+from columnar import ColumnStore, decode_vocab, encode_value, is_null
+from tracks import csr_take
+
+
+SCALAR_COLUMNS = ['released', 'country']
+MULTIVALUED_COLUMNS = ['genres', 'styles', 'formats']
+META_FILE = 'snapshots.json'
+
+# number of materialized snapshots kept in memory (two for comparisons)
+CACHE_SIZE = 2
+
+
+def sort_within_rows(offsets, codes):
+    """Sort codes of each CSR row"""
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return codes[np.lexsort((codes, rows))]
+
+
+def pad_offsets(offsets, length):
+    # rows beyond the end of a CSR layout are empty
+    return np.r_[offsets, np.full(length + 1 - len(offsets), offsets[-1], dtype=np.int64)]
+
+
+def pad_values(values, length):
+    return np.r_[values, np.full(length - len(values), -1, dtype=values.dtype)]
+
+
+def rows_equal(offsets_a, codes_a, offsets_b, codes_b):
+    """Compare two CSR layouts (sorted within rows) row by row"""
+    counts_a, counts_b = np.diff(offsets_a), np.diff(offsets_b)
+    equal = counts_a == counts_b
+    rows = np.flatnonzero(equal & (counts_a > 0))
+    _, elements_a = csr_take(offsets_a, rows)
+    _, elements_b = csr_take(offsets_b, rows)
+    mismatch = codes_a[elements_a] != codes_b[elements_b]
+    row_of = np.repeat(np.arange(len(rows)), counts_a[rows])
+    equal[rows[np.bincount(row_of[mismatch], minlength=len(rows)) > 0]] = False
+    return equal
+
+
+def replace_rows(offsets, codes, rows, new_offsets, new_codes):
+    """Replace CSR rows 'rows' by rows of another CSR layout"""
+    counts = np.diff(offsets)
+    starts = offsets[:-1].copy()
+    counts[rows] = np.diff(new_offsets)
+    starts[rows] = len(codes) + new_offsets[:-1]
+    result = np.zeros(len(counts) + 1, dtype=np.int64)
+    result[1:] = np.cumsum(counts)
+    elements = np.repeat(starts - result[:-1], counts) + np.arange(result[-1])
+    return result, np.r_[codes, new_codes].astype(np.int32)[elements]
+
+
+class Snapshot(object):
+    """
+    Full columns of a snapshot over all rows of the store
+    - present: boolean mask of releases present in the snapshot
+    - scalars: column -> array of codes (-1 if unknown)
+    - multivalued: column -> (offsets, codes)
+    """
+
+    def __init__(self, present, scalars, multivalued):
+        self.present = present
+        self.scalars = scalars
+        self.multivalued = multivalued
+
+    def __len__(self):
+        return len(self.present)
+
+    @classmethod
+    def empty(cls, length):
+        return cls(np.zeros(length, dtype=bool),
+                   dict((name, np.full(length, -1, dtype=np.int32)) for name in SCALAR_COLUMNS),
+                   dict((name, (np.zeros(length + 1, dtype=np.int64), np.zeros(0, dtype=np.int32)))
+                        for name in MULTIVALUED_COLUMNS))
+
+    def padded(self, length):
+        """Extend the snapshot to 'length' rows (new rows are absent)"""
+        if length == len(self):
+            return self
+        return Snapshot(np.r_[self.present, np.zeros(length - len(self), dtype=bool)],
+                        dict((name, pad_values(v, length)) for name, v in self.scalars.items()),
+                        dict((name, (pad_offsets(o, length), c)) for name, (o, c) in self.multivalued.items()))
+
+    def delta(self, base):
+        """Rows and values that differ from a base snapshot of the same length"""
+        delta = {'present': np.packbits(self.present)}
+        for name in SCALAR_COLUMNS:
+            rows = np.flatnonzero(self.scalars[name] != base.scalars[name])
+            delta[name + '.rows'] = rows.astype(np.int32)
+            delta[name + '.values'] = self.scalars[name][rows]
+        for name in MULTIVALUED_COLUMNS:
+            offsets, codes = self.multivalued[name]
+            rows = np.flatnonzero(~rows_equal(offsets, codes, *base.multivalued[name]))
+            delta_offsets, elements = csr_take(offsets, rows)
+            delta[name + '.rows'] = rows.astype(np.int32)
+            delta[name + '.offsets'] = delta_offsets
+            delta[name + '.codes'] = codes[elements]
+        return delta
+
+    def apply(self, delta):
+        """Return the snapshot obtained applying a delta to this (base) snapshot"""
+        present = np.unpackbits(delta['present'])[:len(self)].astype(bool)
+        scalars = {}
+        for name in SCALAR_COLUMNS:
+            values = self.scalars[name].copy()
+            values[delta[name + '.rows']] = delta[name + '.values']
+            scalars[name] = values
+        multivalued = {}
+        for name in MULTIVALUED_COLUMNS:
+            offsets, codes = self.multivalued[name]
+            multivalued[name] = replace_rows(offsets, codes, delta[name + '.rows'],
+                                             delta[name + '.offsets'], delta[name + '.codes'])
+        return Snapshot(present, scalars, multivalued)
+
+
+class SnapshotStore(object):
+    """
+    Store of release snapshots from several dumps (see the module description)
+    - path: store directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshots = []
+        self.lengths = []
+        self.vocabs = dict((name, []) for name in ['country'] + MULTIVALUED_COLUMNS)
+        self.ids = np.zeros(0, dtype=np.int64)
+        if os.path.isfile(os.path.join(path, META_FILE)):
+            with open(os.path.join(path, META_FILE), 'r') as f:
+                meta = json.load(f)
+            self.snapshots = meta['snapshots']
+            self.lengths = meta['lengths']
+            self.vocabs = dict((name, decode_vocab(v)) for name, v in meta['vocabs'].items())
+            self.ids = np.load(os.path.join(path, 'ids.npy'))
+        self.codes = dict((name, dict((v, i) for i, v in enumerate(vocab)))
+                          for name, vocab in self.vocabs.items())
+        self._base = None
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _file(self, snapshot, name):
+        return os.path.join(self.path, snapshot, name + '.npy')
+
+    def _save_meta(self):
+        np.save(os.path.join(self.path, 'ids.npy'), self.ids)
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump({'snapshots': self.snapshots, 'lengths': self.lengths, 'vocabs': self.vocabs}, f)
+
+    def _code(self, name, value):
+        codes = self.codes[name]
+        if value not in codes:
+            codes[value] = len(codes)
+            self.vocabs[name].append(value)
+        return codes[value]
+
+    def rows(self, ids):
+        """Return store rows of release ids (-1 if unknown)"""
+        order = np.argsort(self.ids, kind='mergesort')
+        positions = np.searchsorted(self.ids[order], ids)
+        positions = np.minimum(positions, max(len(order) - 1, 0))
+        if not len(order):
+            return np.full(len(ids), -1, dtype=np.int64)
+        rows = order[positions]
+        return np.where(self.ids[rows] == ids, rows, -1)
+
+    def encode(self, data):
+        """Encode a release DataFrame (or ColumnStore) as a full Snapshot"""
+        if isinstance(data, ColumnStore):
+            data = data.to_dataframe(columns=['@id'] + SCALAR_COLUMNS + MULTIVALUED_COLUMNS)
+        ids = data['@id'].values.astype(np.int64)
+        if len(np.unique(ids)) != len(ids):
+            raise ValueError("Duplicate release ids in snapshot")
+
+        # append releases seen for the first time
+        rows = self.rows(ids)
+        new = rows < 0
+        rows[new] = len(self.ids) + np.arange(new.sum())
+        self.ids = np.r_[self.ids, ids[new]]
+        length = len(self.ids)
+
+        snapshot = Snapshot.empty(length)
+        snapshot.present[rows] = True
+        released = data['released'].values.astype(np.float64)
+        snapshot.scalars['released'][rows] = np.where(np.isnan(released), -1, np.nan_to_num(released))
+        snapshot.scalars['country'][rows] = [-1 if is_null(c) else self._code('country', c)
+                                             for c in data['country']]
+
+        order = np.argsort(rows, kind='mergesort')
+        for name in MULTIVALUED_COLUMNS:
+            counts = np.zeros(length, dtype=np.int64)
+            codes = []
+            for i, values in enumerate(data[name].values):
+                values = values if isinstance(values, (list, tuple)) else []
+                counts[rows[i]] = len(values)
+                codes.append([self._code(name, encode_value(v)) for v in values])
+            offsets = np.zeros(length + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(counts)
+            codes = np.array([c for i in order for c in codes[i]], dtype=np.int32)
+            snapshot.multivalued[name] = (offsets, sort_within_rows(offsets, codes))
+        return snapshot
+
+    def add(self, name, data):
+        """
+        Add a snapshot from a release DataFrame (or ColumnStore). The first
+        added snapshot is the base, others are stored as deltas against it.
+        """
+        if name in self.snapshots:
+            raise ValueError("Snapshot %s already exists" % name)
+        snapshot = self.encode(data)
+        base = self.base().padded(len(snapshot)) if self.snapshots else Snapshot.empty(len(snapshot))
+
+        if not os.path.isdir(os.path.join(self.path, name)):
+            os.makedirs(os.path.join(self.path, name))
+        for key, values in snapshot.delta(base).items():
+            np.save(self._file(name, key), values)
+
+        self.snapshots.append(name)
+        self.lengths.append(len(snapshot))
+        self._save_meta()
+        if len(self.snapshots) == 1:
+            self._base = snapshot
+        else:
+            self._cached(name, snapshot)
+
+    def _delta(self, name):
+        keys = ['present'] + [n + s for n in SCALAR_COLUMNS for s in ['.rows', '.values']]
+        keys += [n + s for n in MULTIVALUED_COLUMNS for s in ['.rows', '.offsets', '.codes']]
+        return dict((key, np.load(self._file(name, key))) for key in keys)
+
+    def base(self):
+        """Return the base snapshot"""
+        if self._base is None:
+            self._base = Snapshot.empty(self.lengths[0]).apply(self._delta(self.snapshots[0]))
+        return self._base
+
+    def snapshot(self, name):
+        """Return a snapshot over all rows of the store"""
+        if name == self.snapshots[0]:
+            return self.base().padded(len(self))
+        if name not in self._cache:
+            base = self.base().padded(self.lengths[self.snapshots.index(name)])
+            self._cached(name, base.apply(self._delta(name)))
+        return self._cache[name].padded(len(self))
+
+    def _cached(self, name, snapshot):
+        self._cache.pop(name, None)
+        self._cache[name] = snapshot
+        while len(self._cache) > CACHE_SIZE:
+            del self._cache[next(iter(self._cache))]
+
+    def decode(self, name, code):
+        if code < 0:
+            return None
+        return self.vocabs[name][code]
+
+    def changed(self, a, b, column):
+        """Boolean mask of releases present in snapshots a and b with a different 'column'"""
+        sa, sb = self.snapshot(a), self.snapshot(b)
+        both = sa.present & sb.present
+        if column in SCALAR_COLUMNS:
+            return both & (sa.scalars[column] != sb.scalars[column])
+        return both & ~rows_equal(*(sa.multivalued[column] + sb.multivalued[column]))
+
+    def changes(self, a, b, column):
+        """
+        Return per-release changes of 'column' from snapshot a to b: a
+        DataFrame with release ids and values before and after
+        """
+        rows = np.flatnonzero(self.changed(a, b, column))
+        result = {'@id': self.ids[rows]}
+        for key, name in [('before', a), ('after', b)]:
+            s = self.snapshot(name)
+            if column == 'released':
+                result[key] = s.scalars[column][rows]
+            elif column in SCALAR_COLUMNS:
+                result[key] = [self.decode(column, c) for c in s.scalars[column][rows]]
+            else:
+                offsets, codes = s.multivalued[column]
+                result[key] = [[self.vocabs[column][c] for c in codes[offsets[r]:offsets[r+1]]] for r in rows]
+        return pandas.DataFrame(result, columns=['@id', 'before', 'after'])
+
+    def value_counts(self, name, column):
+        # number of present releases per code
+        s = self.snapshot(name)
+        if column == 'released':
+            values = s.scalars[column][s.present]
+            return np.bincount(values[values >= 0])
+        if column in SCALAR_COLUMNS:
+            values = s.scalars[column][s.present]
+            return np.bincount(values[values >= 0], minlength=len(self.vocabs[column]))
+        offsets, codes = s.multivalued[column]
+        present = np.repeat(s.present, np.diff(offsets))
+        return np.bincount(codes[present], minlength=len(self.vocabs[column]))
+
+    def drift(self, column, snapshots=None):
+        """
+        Return a drift table: number of releases per value of 'column'
+        (genres, styles, formats, country or released years) in every snapshot
+        """
+        snapshots = snapshots or self.snapshots
+        counts = [self.value_counts(s, column) for s in snapshots]
+        width = max(len(c) for c in counts)
+        table = np.array([np.r_[c, np.zeros(width - len(c), dtype=c.dtype)] for c in counts]).T
+        if column == 'released':
+            index = np.arange(width)
+            keep = table.sum(axis=1) > 0
+            return pandas.DataFrame(table[keep], index=index[keep], columns=snapshots)
+        return pandas.DataFrame(table, index=self.vocabs[column][:width], columns=snapshots)
+
+    def transitions(self, a, b, column):
+        """
+        Count annotation transitions from snapshot a to b for releases present
+        in both:
+        - year and country: number of releases per (before, after) pair
+        - genres, styles and formats: number of releases where each value was
+          added or removed
+        """
+        sa, sb = self.snapshot(a), self.snapshot(b)
+        both = sa.present & sb.present
+        if column in SCALAR_COLUMNS:
+            changed = both & (sa.scalars[column] != sb.scalars[column])
+            pairs = pandas.DataFrame({'before': sa.scalars[column][changed], 'after': sb.scalars[column][changed]})
+            counts = pairs.groupby(['before', 'after']).size().sort_values(ascending=False)
+            counts = counts.reset_index(name='releases')
+            if column != 'released':
+                for key in ['before', 'after']:
+                    counts[key] = [self.decode(column, c) for c in counts[key]]
+            return counts
+
+        values = len(self.vocabs[column])
+        pairs = []
+        for s in [sa, sb]:
+            offsets, codes = s.multivalued[column]
+            rows = np.repeat(np.arange(len(s)), np.diff(offsets))
+            selected = both[rows]
+            pairs.append(np.unique(rows[selected] * values + codes[selected]))
+        added = np.bincount(np.setdiff1d(pairs[1], pairs[0]) % values, minlength=values)
+        removed = np.bincount(np.setdiff1d(pairs[0], pairs[1]) % values, minlength=values)
+        table = pandas.DataFrame({'added': added, 'removed': removed, 'net': added - removed},
+                                 index=self.vocabs[column], columns=['added', 'removed', 'net'])
+        return table[(table['added'] > 0) | (table['removed'] > 0)].sort_values('net')
+
+    def summary(self):
+        """
+        Compare consecutive snapshots: number of releases, new and deleted
+        releases, and releases with changed annotations per column
+        """
+        records = []
+        for i, name in enumerate(self.snapshots):
+            s = self.snapshot(name)
+            record = {'snapshot': name, 'releases': int(s.present.sum())}
+            if i:
+                previous = self.snapshots[i-1]
+                p = self.snapshot(previous)
+                record['new'] = int((s.present & ~p.present).sum())
+                record['deleted'] = int((p.present & ~s.present).sum())
+                for column in SCALAR_COLUMNS + MULTIVALUED_COLUMNS:
+                    record['changed_' + column] = int(self.changed(previous, name, column).sum())
+            records.append(record)
+        columns = ['snapshot', 'releases', 'new', 'deleted'] + ['changed_' + c for c in SCALAR_COLUMNS + MULTIVALUED_COLUMNS]
+        return pandas.DataFrame(records, columns=columns)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Generate synthetic Discogs release dumps (releases.xml.gz) of configurable
+size for testing and benchmarking without the real data dump.
+
+Releases follow the structure of the original XML dump and use the real
+genre tree from discogs_taxonomy.yaml. Genres, styles, formats, countries,
+years, artists and track durations are drawn from skewed distributions that
+roughly follow the ones observed in the Discogs database, including missing
+durations, malformed values and incomplete releases.
+'''
+
+import sys
+import gzip
+import math
+import random
+import bisect
+from xml.sax.saxutils import escape, quoteattr
+
+from config import GENRE_TREE
+
+
+# Approximate share of genres, formats and countries in the Discogs database
+GENRE_WEIGHTS = {
+    'Electronic': 28, 'Rock': 26, 'Pop': 14, 'Funk / Soul': 7, 'Jazz': 5,
+    'Hip Hop': 4, 'Classical': 4, 'Folk, World, & Country': 4, 'Latin': 2,
+    'Reggae': 2, 'Blues': 1.5, 'Stage & Screen': 1, 'Non-Music': 1,
+    "Children's": 0.5, 'Brass & Military': 0.3,
+}
+FORMAT_WEIGHTS = {
+    'Vinyl': 35, 'CD': 30, 'File': 12, 'Cassette': 8, 'CDr': 8, 'Box Set': 2,
+    'DVD': 2, 'All Media': 2, 'Shellac': 1, 'Flexi-disc': 0.5,
+}
+COUNTRY_WEIGHTS = {
+    'US': 25, 'UK': 13, 'Germany': 10, 'France': 6, 'Netherlands': 4,
+    'Japan': 4, 'Italy': 4, 'Canada': 3, 'Europe': 3, 'Spain': 2,
+    'Brazil': 2, 'Australia': 2, 'Russia': 2, 'Sweden': 2, 'Belgium': 2,
+    'Poland': 1, 'Greece': 1, 'Finland': 1, 'Mexico': 1, 'Argentina': 1,
+}
+# Median track duration (seconds) per genre, others use 240
+GENRE_DURATIONS = {
+    'Electronic': 330, 'Classical': 300, 'Jazz': 320, 'Hip Hop': 220,
+    'Rock': 230, 'Pop': 220, 'Non-Music': 180, "Children's": 150,
+}
+DATA_QUALITY = ['Correct', 'Needs Vote', 'Complete and Correct', 'Needs Minor Changes']
+
+
+class WeightedChoice(object):
+    """Draw items with given weights in O(log n)"""
+
+    def __init__(self, items, weights):
+        self.items = list(items)
+        self.cumulative = []
+        total = 0.
+        for w in weights:
+            total += w
+            self.cumulative.append(total)
+
+    def __call__(self, rng):
+        x = rng.random() * self.cumulative[-1]
+        return self.items[min(bisect.bisect_right(self.cumulative, x), len(self.items) - 1)]
+
+
+def zipf(items, s=1.1):
+    """Weighted choice with Zipf weights following the order of 'items'"""
+    return WeightedChoice(items, [1. / (r + 1) ** s for r in range(len(items))])
+
+
+def format_duration(seconds, rng):
+    # mostly m:ss, sometimes h:mm:ss or malformed values as found in the dump
+    x = rng.random()
+    if x < 0.005:
+        return 'unknown'
+    if x < 0.01:
+        return '%d.%02d' % (seconds // 60, seconds % 60)
+    if seconds >= 3600:
+        return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return '%d:%02d' % (seconds // 60, seconds % 60)
+
+
+def artist_xml(artist_id, indent):
+    return (indent + '<artist><id>%d</id><name>Artist %d</name><anv></anv>'
+            '<join></join><role></role><tracks></tracks></artist>\n' % (artist_id, artist_id))
+
+
+class ReleaseGenerator(object):
+    """Generate XML for synthetic releases"""
+
+    def __init__(self, releases, seed=0):
+        self.rng = random.Random(seed)
+        self.tree = GENRE_TREE
+
+        genres = [g for g in self.tree if g in GENRE_WEIGHTS]
+        self.genre = WeightedChoice(genres, [GENRE_WEIGHTS[g] for g in genres])
+
+        # style popularity within a genre follows a Zipf law over a random order
+        self.styles = {}
+        for g in genres:
+            styles = list(self.tree[g] or [])
+            self.rng.shuffle(styles)
+            self.styles[g] = zipf(styles) if styles else None
+
+        self.format = WeightedChoice(list(FORMAT_WEIGHTS), list(FORMAT_WEIGHTS.values()))
+        self.country = WeightedChoice(list(COUNTRY_WEIGHTS), list(COUNTRY_WEIGHTS.values()))
+        years = list(range(1950, 2018))
+        self.year = WeightedChoice(years, [math.exp((y - 1950) / 15.) for y in years])
+
+        self.artists = zipf(list(range(1, max(100, releases // 3) + 1)))
+        self.labels = zipf(list(range(1, max(20, releases // 10) + 1)))
+        self.masters = max(10, releases // 2)
+
+    def release(self, release_id):
+        rng = self.rng
+        genres = []
+        for _ in range(1 + (rng.random() < 0.25) + (rng.random() < 0.05)):
+            g = self.genre(rng)
+            if g not in genres:
+                genres.append(g)
+        styles = []
+        for g in genres:
+            for _ in range(rng.choice([0, 1, 1, 2])):
+                s = self.styles[g](rng) if self.styles[g] else None
+                if s and s not in styles:
+                    styles.append(s)
+
+        format = self.format(rng)
+        descriptions = []
+        if format == 'Vinyl':
+            descriptions.append(rng.choice(['LP', '7"', '12"']))
+        if rng.random() < 0.08:
+            descriptions.append('Compilation')
+        if rng.random() < (0.1 if 'Electronic' in genres else 0.01):
+            descriptions.append(rng.choice(['Mixed', 'Partially Mixed']))
+        if rng.random() < 0.01:
+            descriptions.append('Unofficial Release')
+
+        tracks_number = rng.choice([1, 2, 2, 3, 4]) if descriptions[:1] == ['7"'] \
+            else max(1, int(rng.gauss(10, 4)))
+        with_durations = rng.random() < 0.6
+        median = GENRE_DURATIONS.get(genres[0], 240)
+        compilation = 'Compilation' in descriptions
+
+        xml = ['<release id="%d" status="Accepted">\n' % release_id]
+        xml.append('  <images><image height="600" type="primary" uri="" uri150="" width="600"/></images>\n')
+        xml.append('  <artists>\n')
+        for _ in range(1 + (rng.random() < 0.1)):
+            xml.append(artist_xml(self.artists(rng), '    '))
+        xml.append('  </artists>\n')
+        xml.append('  <title>Release %d</title>\n' % release_id)
+        xml.append('  <labels>\n')
+        for _ in range(1 + (rng.random() < 0.1)):
+            label = self.labels(rng)
+            xml.append('    <label catno="CAT%d" id="%d" name=%s/>\n'
+                       % (release_id, label, quoteattr('Label %d' % label)))
+        xml.append('  </labels>\n')
+        xml.append('  <extraartists>\n')
+        xml.append('    <artist><id>%d</id><name>Producer</name><anv></anv><join></join>'
+                   '<role>Producer</role><tracks></tracks></artist>\n' % self.artists(rng))
+        xml.append('  </extraartists>\n')
+        xml.append('  <formats>\n')
+        xml.append('    <format name=%s qty="1" text="">\n' % quoteattr(format))
+        if descriptions:
+            xml.append('      <descriptions>%s</descriptions>\n'
+                       % ''.join('<description>%s</description>' % escape(d) for d in descriptions))
+        xml.append('    </format>\n')
+        xml.append('  </formats>\n')
+
+        # a small share of releases lack genres, as in the real dump
+        if rng.random() > 0.002:
+            xml.append('  <genres>%s</genres>\n' % ''.join('<genre>%s</genre>' % escape(g) for g in genres))
+        if styles:
+            xml.append('  <styles>%s</styles>\n' % ''.join('<style>%s</style>' % escape(s) for s in styles))
+        if rng.random() > 0.05:
+            xml.append('  <country>%s</country>\n' % escape(self.country(rng)))
+        if rng.random() > 0.08:
+            year = self.year(rng)
+            released = rng.choice(['%d' % year, '%d-00-00' % year,
+                                   '%d-%02d-%02d' % (year, rng.randint(1, 12), rng.randint(1, 28))])
+            xml.append('  <released>%s</released>\n' % released)
+        xml.append('  <notes>Notes</notes>\n')
+        xml.append('  <data_quality>%s</data_quality>\n' % rng.choice(DATA_QUALITY))
+        if rng.random() < 0.6:
+            xml.append('  <master_id>%d</master_id>\n' % rng.randint(1, self.masters))
+
+        xml.append('  <tracklist>\n')
+        for i in range(tracks_number):
+            xml.append('    <track>\n      <position>%d</position>\n' % (i + 1))
+            xml.append('      <title>Track %d</title>\n' % (i + 1))
+            if with_durations and rng.random() > 0.02:
+                seconds = int(rng.lognormvariate(math.log(median), 0.35))
+                xml.append('      <duration>%s</duration>\n' % format_duration(seconds, rng))
+            else:
+                xml.append('      <duration></duration>\n')
+            if compilation:
+                xml.append('      <artists>\n%s      </artists>\n' % artist_xml(self.artists(rng), '        '))
+            xml.append('    </track>\n')
+        xml.append('  </tracklist>\n')
+        xml.append('  <identifiers></identifiers>\n  <videos></videos>\n  <companies></companies>\n')
+        xml.append('</release>\n')
+        return ''.join(xml)
+
+
+def write_synthetic_dump(filename, releases, seed=0):
+    """
+    Write a gzipped XML dump with 'releases' synthetic releases.
+    The same seed always generates the same dump.
+    """
+    generator = ReleaseGenerator(releases, seed)
+    f = gzip.open(filename, 'wb')
+    f.write(b'<releases>\n')
+    for release_id in range(1, releases + 1):
+        f.write(generator.release(release_id).encode('utf-8'))
+    f.write(b'</releases>\n')
+    f.close()
+    return filename
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: synthetic.py <output.xml.gz> <number of releases> [seed]")
+        sys.exit(1)
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    write_synthetic_dump(sys.argv[1], int(sys.argv[2]), seed)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+'''
+Fixtures for tests on synthetic release dumps (see synthetic.py).
+Run from the code directory: python -m pytest tests
+'''
+
+import os
+import sys
+import pytest
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODE_DIR)
+
+
+@pytest.fixture(scope='session', autouse=True)
+def code_dir():
+    # paths in config.py (e.g., the taxonomy) are relative to the code directory
+    cwd = os.getcwd()
+    os.chdir(CODE_DIR)
+    yield CODE_DIR
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def release_json(tmpdir_factory, code_dir):
+    """json dump of 500 synthetic releases"""
+    from synthetic import write_synthetic_dump
+    from preprocess_releases_xml_to_json import convert_dump
+    path = tmpdir_factory.mktemp('dump')
+    write_synthetic_dump(str(path.join('releases.xml.gz')), 500, seed=1)
+    convert_dump(str(path.join('releases.xml.gz')), str(path.join('releases.json')))
+    return str(path.join('releases.json'))
+
+
+@pytest.fixture(scope='session')
+def releases(release_json):
+    """release DataFrame of the synthetic json dump"""
+    from preprocess_releases_json_to_hdf_pandas import load_releases
+    return load_releases(input_dump=release_json)
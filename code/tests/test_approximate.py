@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from approximate import StratifiedSamples, stratified_totals, relative_error
+
+
+def test_stratified_totals():
+    # two strata: 2 of 10 releases sampled, and all 3 releases sampled
+    strata = np.array([0, 0, 1, 1, 1])
+    sizes = np.array([2, 3])
+    population = np.array([10, 3])
+    values = np.ones(5)
+    groups = np.array([0, 1, 0, 0, 1])
+    estimates, variances = stratified_totals(strata, sizes, population, values, groups, 2)
+    assert list(estimates) == [5 + 2, 5 + 1]
+    # only the sampled stratum adds variance (one of its 2 releases per group)
+    assert variances[0] == pytest.approx(10 ** 2 * (1 - 2 / 10.) * 0.5 / 2)
+    assert variances[1] == pytest.approx(variances[0])
+
+
+def test_stratified_totals_full_sample():
+    strata = np.array([0, 0, 1])
+    estimates, variances = stratified_totals(strata, np.array([2, 1]), np.array([2, 1]),
+                                             np.array([1., 2., 3.]), np.array([0, 1, 1]), 2)
+    assert list(estimates) == [1, 5]
+    assert list(variances) == [0, 0]
+
+
+def test_relative_error():
+    assert relative_error(np.array([10., 20.]), np.array([1., 4.])) == pytest.approx(0.2)
+    assert relative_error(np.array([0.]), np.array([0.])) == 0
+    # a zero estimate with an upper bound is not accurate
+    assert relative_error(np.array([10., 0.]), np.array([1., 3.])) == float('inf')
+
+
+def test_samples(releases):
+    samples = StratifiedSamples.build(releases, fractions=[0.1], seed=0)
+    years, estimates, errors = samples.per_year(1990, 1999, [dict(genre='Rock')])
+    assert len(years) == 10
+    assert (estimates >= 0).all() and (errors >= 0).all()
+    # escalating to the full data gives exact counts
+    years, estimates, errors = samples.per_year(1990, 1999, [dict(genre='Rock')], max_error=0)
+    rock = releases[releases['genres'].apply(lambda x: 'Rock' in x)]
+    assert list(estimates[0]) == [(rock['released'] == y).sum() for y in years]
+    assert not errors.any()
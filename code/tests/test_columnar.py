@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from columnar import ColumnStore, ColumnWriter, write_columns, invert_csr
+
+
+def same_values(decoded, expected):
+    # lists of values or missing values (NaN)
+    if isinstance(expected, float) and expected != expected:
+        return isinstance(decoded, float) and decoded != decoded
+    return list(decoded) == list(expected)
+
+
+@pytest.fixture(scope='module')
+def store(releases, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('columns').join('releases'))
+    write_columns(releases, path)
+    return ColumnStore(path)
+
+
+def test_round_trip(store, releases):
+    data = store.to_dataframe()
+    assert len(data) == len(releases)
+    assert (data['@id'].values == releases['@id'].astype(np.int64).values).all()
+    for name in ['master_id', 'tracks_number', 'compilation', 'mixed', 'unofficial']:
+        assert (data[name].values == releases[name].values).all(), name
+    for name in ['released', 'tracks_duration']:
+        np.testing.assert_array_equal(data[name].values, releases[name].values)
+    for name in ['country', '@status', 'genres', 'styles', 'formats', 'artists', 'labels']:
+        assert all(same_values(d, e) for d, e in zip(data[name], releases[name])), name
+    for decoded, expected in zip(data['tracks_duration_list'], releases['tracks_duration_list']):
+        if isinstance(expected, list):
+            np.testing.assert_allclose(decoded, expected, rtol=1e-6)
+        else:
+            assert decoded != decoded
+
+
+def test_rows(store, releases):
+    rows = np.array([7, 3, 3, 0])
+    data = store.to_dataframe(['genres', 'released'], rows=rows)
+    assert list(data['genres']) == [releases['genres'].iloc[r] for r in rows]
+    mask = (releases['released'] >= 2000).values
+    assert len(store.to_dataframe(['styles'], rows=mask)) == mask.sum()
+    assert len(store.to_dataframe(['styles'], rows=np.zeros(0, dtype=np.int64))) == 0
+
+
+def test_chunks(store, releases, tmpdir):
+    # appending chunks gives the same store as writing the whole DataFrame
+    writer = ColumnWriter(str(tmpdir.join('chunks')))
+    for start in range(0, len(releases), 128):
+        writer.append(releases.iloc[start:start + 128])
+    writer.close()
+    chunked = ColumnStore(str(tmpdir.join('chunks')))
+    for name in ['genres', 'country', 'tracks_duration_list']:
+        assert all(same_values(c, s) for c, s in zip(chunked.column(name), store.column(name))), name
+
+
+def test_contains(store, releases):
+    rock = releases['genres'].apply(lambda x: 'Rock' in x).values
+    assert (store.contains('genres', 'Rock') == rock).all()
+    only = releases['genres'].apply(lambda x: x == ['Rock']).values
+    assert (store.contains('genres', 'Rock', only=True) == only).all()
+    assert not store.contains('genres', 'Polka').any()
+
+
+def test_invert_csr():
+    codes = np.array([2, 0, 2, 1, 0, 2])
+    rows = np.array([10, 11, 12, 13, 14, 15])
+    offsets, index_rows = invert_csr(codes, rows, 4)
+    assert list(offsets) == [0, 2, 3, 6, 6]
+    assert [list(index_rows[offsets[c]:offsets[c + 1]]) for c in range(4)] == \
+        [[11, 14], [13], [10, 12, 15], []]
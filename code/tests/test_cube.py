@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from cube import ReleaseCube
+
+
+@pytest.fixture(scope='module')
+def cube(releases):
+    return ReleaseCube.build(releases)
+
+
+def count(releases, genre=None, country=None, year=None, format=None):
+    mask = releases['@id'].notnull()
+    if genre:
+        mask &= releases['genres'].apply(lambda x: genre in x)
+    if country:
+        mask &= releases['country'] == country
+    if year:
+        mask &= releases['released'] == year
+    if format:
+        mask &= releases['formats'].apply(lambda x: format in x)
+    return releases[mask]
+
+
+def test_total(cube, releases):
+    assert cube.query('releases', by=[])['releases'][0] == len(releases)
+    assert cube.query('tracks', by=[])['tracks'][0] == releases['tracks_number'].sum()
+
+
+def test_slices(cube, releases):
+    result = cube.query('releases', by=['year'], genre='Rock', country='US')
+    for year, n in zip(result['year'], result['releases']):
+        if year >= 0:
+            assert n == len(count(releases, genre='Rock', country='US', year=year))
+    result = cube.query('releases', by=['format'], genre='Jazz')
+    for fmt, n in zip(result['format'], result['releases']):
+        assert n == len(count(releases, genre='Jazz', format=fmt))
+
+
+def test_artists(cube, releases):
+    result = cube.query('artists', by=[], genre='Electronic')
+    selected = count(releases, genre='Electronic')
+    assert result['artists'][0] == len(set(a for aa in selected['artists'] for a in aa))
+    with pytest.raises(ValueError):
+        cube.query('artists', by=['format'])
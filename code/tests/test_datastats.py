@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from datastats import ArtistSketch
+
+
+@pytest.mark.parametrize('n', [0, 100, 5000, 200000])
+def test_artist_count(n):
+    sketch = ArtistSketch()
+    sketch.add(range(n))
+    # duplicates and names are counted once
+    sketch.add(range(n // 2))
+    assert sketch.count() == pytest.approx(n, rel=0.03, abs=1)
+
+
+def test_artist_names():
+    sketch = ArtistSketch()
+    sketch.add(['Artist %d' % i for i in range(1000)] + ['Artist 1'])
+    assert sketch.count() == pytest.approx(1000, rel=0.03)
+
+
+def test_merge():
+    first, second = ArtistSketch(), ArtistSketch()
+    first.add(range(0, 6000))
+    second.add(range(4000, 10000))
+    first.merge(second)
+    assert first.count() == pytest.approx(10000, rel=0.03)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import json
+import numpy as np
+
+from incremental import diff_dumps, hash_dump, release_id
+
+
+def test_diff_dumps():
+    old_ids = np.array([1, 2, 4, 7], dtype=np.int64)
+    old_hashes = np.array([10, 20, 40, 70], dtype=np.uint64)
+    new_ids = np.array([2, 3, 4, 8], dtype=np.int64)
+    new_hashes = np.array([20, 30, 41, 80], dtype=np.uint64)
+    added, changed, deleted = diff_dumps(old_ids, old_hashes, new_ids, new_hashes)
+    assert list(new_ids[added]) == [3, 8]
+    assert list(new_ids[changed]) == [4]
+    assert list(deleted) == [1, 7]
+
+
+def test_diff_dumps_empty():
+    empty = np.zeros(0, dtype=np.int64)
+    ids = np.array([1, 2], dtype=np.int64)
+    added, changed, deleted = diff_dumps(empty, empty.astype(np.uint64), ids, np.array([1, 2], dtype=np.uint64))
+    assert added.all() and not changed.any() and not len(deleted)
+    added, changed, deleted = diff_dumps(ids, np.array([1, 2], dtype=np.uint64), empty, empty.astype(np.uint64))
+    assert list(deleted) == [1, 2]
+
+
+def test_release_id():
+    assert release_id(json.dumps({'title': 'x', '@id': '12'}).encode('utf-8')) == 12
+    # nested '@id' keys are not taken for the release id
+    line = json.dumps({'labels': [{'@id': '3'}], '@id': '12'}).encode('utf-8')
+    assert release_id(line) == 12
+
+
+def test_hash_dump(release_json, tmpdir):
+    ids, hashes, lines = hash_dump(release_json)
+    assert (np.diff(ids) > 0).all()
+    # changing one release changes only its hash
+    with open(release_json, 'r') as f:
+        releases = f.readlines()
+    release = json.loads(releases[5])
+    release['title'] = 'Changed'
+    releases[5] = json.dumps(release) + '\n'
+    changed_json = str(tmpdir.join('changed.json'))
+    with open(changed_json, 'w') as f:
+        f.writelines(releases[1:])
+    new_ids, new_hashes, _ = hash_dump(changed_json)
+    added, changed, deleted = diff_dumps(ids, hashes, new_ids, new_hashes)
+    assert not added.any()
+    assert list(new_ids[changed]) == [int(release['@id'])]
+    assert list(deleted) == [int(json.loads(releases[0])['@id'])]
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import pytest
+
+try:
+    from urllib2 import urlopen, Request, HTTPError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+import analyze
+import server
+
+
+@pytest.fixture(scope='module')
+def url(releases):
+    query_server = server.make_server(releases, port=0, threads=2)
+    thread = threading.Thread(target=query_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d/' % query_server.server_address[1]
+    query_server.shutdown()
+    query_server.server_close()
+
+
+def get(url, body=None):
+    request = Request(url, json.dumps(body).encode('utf-8') if body is not None else None)
+    try:
+        response = urlopen(request)
+        return response.getcode(), json.loads(response.read().decode('utf-8'))
+    except HTTPError as e:
+        return e.code, json.loads(e.read().decode('utf-8'))
+
+
+def test_operations(url, releases):
+    code, result = get(url)
+    assert code == 200
+    assert result['releases'] == len(releases)
+    assert 'genres' in result['operations']['compare_genres']
+
+
+def test_select(url, releases):
+    code, result = get(url + 'select?genre=Rock&limit=5')
+    assert code == 200
+    assert result['releases'] == len(analyze.select(releases, genre='Rock'))
+    assert len(result['ids']) == min(5, result['releases'])
+
+
+def test_styles(url, releases):
+    style = ('Electronic', 'House')
+    code, result = get(url + 'select', {'style': list(style)})
+    assert code == 200
+    assert result['releases'] == len(analyze.select(releases, style=style))
+
+
+def test_compare_genres(url, releases):
+    code, result = get(url + 'compare_genres', {'genres': ['Rock', 'Jazz'],
+                                                 'start_year': 1990, 'end_year': 1999})
+    assert code == 200
+    expected = analyze.compare_genres(releases, genres=['Rock', 'Jazz'],
+                                      start_year=1990, end_year=1999)
+    assert result['data'] == expected.values.tolist()
+
+
+@pytest.mark.parametrize('query, body', [
+    ('select?processes=64', None),
+    ('releases_stats', {'stats_file': '/etc/passwd'}),
+    ('select?year=recent', None),
+    ('compare_genres', {'metric': 'sales'}),
+    ('track_duration_per_genre', {}),
+])
+def test_invalid_params(url, query, body):
+    code, result = get(url + query, body)
+    assert code == 400
+    assert result['error']
+
+
+def test_unknown_operation(url):
+    assert get(url + 'load_release_dump')[0] == 404
+
+
+def test_operation_failure(url, monkeypatch):
+    # errors of analysis functions are server errors, not client errors
+    def fail(data, **params):
+        raise ValueError("bug")
+    monkeypatch.setitem(server.OPERATIONS, 'releases_coverage', fail)
+    code, result = get(url + 'releases_coverage')
+    assert code == 500
+    assert 'bug' in result['error']
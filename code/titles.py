@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Full-text inverted index over release and track titles.
+
+Titles are tokenized into words (Unicode-normalized and case-folded) and,
+optionally, into word n-grams. The index stores, for every term, a postings
+list of (release row, position, field) sorted by release row, where field is
+0 for the release title and 1 for track titles. Positions of consecutive
+titles of a release are separated by a gap so that phrases never match
+across titles.
+
+Terms are kept sorted, so that all terms with a prefix form a contiguous
+range of postings. Postings are stored as .npy files that are mapped on
+loading. The index is collected with TitleIndexBuilder while loading the
+json dump (see load_releases), aligned with rows of the release DataFrame.
+'''
+
+import os
+import re
+import json
+import bisect
+import unicodedata
+from array import array
+import numpy as np
+
+from columnar import to_numpy
+
+
+RELEASE_TITLE = 0
+TRACK_TITLE = 1
+FIELDS = {'release': RELEASE_TITLE, 'track': TRACK_TITLE}
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def casefold(text):
+    # str.casefold is not available in Python 2
+    if not isinstance(text, type(u'')):
+        text = text.decode('utf-8')
+    text = unicodedata.normalize('NFKC', text)
+    return text.casefold() if hasattr(text, 'casefold') else text.lower()
+
+
+def tokenize(text):
+    """Split a title into normalized, case-folded words"""
+    return WORD.findall(casefold(text or u''))
+
+
+def ngrams(tokens, n):
+    """Word n-grams of tokens (as space-separated terms)"""
+    return [u' '.join(tokens[i:i+n]) for i in range(len(tokens) - n + 1)]
+
+
+class TitleIndexBuilder(object):
+    """
+    Collect titles of releases while loading the json dump
+    - tracks: also index track titles
+    - ngrams: also index word n-grams up to this length (1 for words only)
+    """
+
+    def __init__(self, tracks=True, ngrams=1):
+        self.tracks = tracks
+        self.ngrams = ngrams
+        self.vocab = {}
+        self.terms = array('i')
+        self.rows = array('i')
+        self.positions = array('i')
+        self.fields = array('b')
+        self.releases = 0
+        self.keep = None
+
+    def add_title(self, title, field, position):
+        tokens = tokenize(title)
+        for n in range(1, self.ngrams + 1):
+            for i, term in enumerate(ngrams(tokens, n) if n > 1 else tokens):
+                self.terms.append(self.vocab.setdefault(term, len(self.vocab)))
+                self.rows.append(self.releases)
+                self.positions.append(position + i)
+                self.fields.append(field)
+        # gap between titles, so that phrases do not match across titles
+        return position + len(tokens) + 1
+
+    def add(self, title, tracklist=None):
+        """Add titles of the next release"""
+        position = self.add_title(title, RELEASE_TITLE, 0)
+        if self.tracks:
+            for t in tracklist or []:
+                position = self.add_title(t.get('title'), TRACK_TITLE, position)
+        self.releases += 1
+
+    def keep_releases(self, rows):
+        """Only keep titles of release rows 'rows' (e.g., after filtering releases)"""
+        self.keep = rows
+
+    def index(self):
+        """Return the collected TitleIndex"""
+        terms = sorted(self.vocab)
+        # codes in order of collection -> codes in sorted order
+        remap = np.zeros(len(terms), dtype=np.int64)
+        for i, term in enumerate(terms):
+            remap[self.vocab[term]] = i
+
+        codes = remap[to_numpy(self.terms, np.int32)]
+        rows = to_numpy(self.rows, np.int32).astype(np.int64)
+        positions = to_numpy(self.positions, np.int32)
+        fields = to_numpy(self.fields, np.int8)
+        releases = self.releases
+
+        if self.keep is not None:
+            new_rows = np.full(self.releases + 1, -1, dtype=np.int64)
+            new_rows[np.asarray(self.keep)] = np.arange(len(self.keep))
+            rows = new_rows[rows]
+            kept = rows >= 0
+            codes, rows, positions, fields = codes[kept], rows[kept], positions[kept], fields[kept]
+            releases = len(self.keep)
+
+        order = np.lexsort((positions, rows, codes))
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(codes, minlength=len(terms)))
+        return TitleIndex(terms, offsets, rows[order].astype(np.int32),
+                          positions[order], fields[order], releases, self.ngrams)
+
+
+class TitleIndex(object):
+    """
+    Inverted index of release and track titles (see the module description)
+    - terms: sorted list of terms
+    - offsets: postings of terms[i] are offsets[i]:offsets[i+1]
+    - rows, positions, fields: postings
+    - releases: number of indexed release rows
+    - ngrams: maximum length of indexed word n-grams
+    """
+
+    ARRAYS = ['offsets', 'rows', 'positions', 'fields']
+
+    def __init__(self, terms, offsets, rows, positions, fields, releases, ngrams=1):
+        self.terms = terms
+        self.offsets = offsets
+        self.rows = rows
+        self.positions = positions
+        self.fields = fields
+        self.releases = releases
+        self.ngrams = ngrams
+
+    def save(self, path):
+        """Save the index to a directory"""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'terms.json'), 'w') as f:
+            json.dump({'terms': self.terms, 'releases': self.releases, 'ngrams': self.ngrams}, f)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved with save(), mapping postings from disk"""
+        with open(os.path.join(path, 'terms.json'), 'r') as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in cls.ARRAYS]
+        return cls(meta['terms'], *(arrays + [meta['releases'], meta['ngrams']]))
+
+    def __len__(self):
+        return len(self.terms)
+
+    def code(self, term):
+        i = bisect.bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return None
+
+    def postings(self, start, end, field=None):
+        """Return (rows, positions) of postings of term codes start:end"""
+        start, end = self.offsets[start], self.offsets[end]
+        rows = np.asarray(self.rows[start:end], dtype=np.int64)
+        positions = np.asarray(self.positions[start:end], dtype=np.int64)
+        if field is not None:
+            selected = np.asarray(self.fields[start:end]) == FIELDS.get(field, field)
+            rows, positions = rows[selected], positions[selected]
+        return rows, positions
+
+    def term(self, word, field=None):
+        """Return release rows with titles containing a word"""
+        code = self.code(casefold(word))
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(self.postings(code, code + 1, field)[0])
+
+    def prefix(self, prefix, field=None):
+        """Return release rows with titles containing a word starting with a prefix"""
+        prefix = casefold(prefix)
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + u'\uffff')
+        return np.unique(self.postings(start, end, field)[0])
+
+    def phrase(self, text, field=None):
+        """Return release rows with titles containing the words of 'text' in sequence"""
+        tokens = tokenize(text)
+        if not tokens:
+            return np.zeros(0, dtype=np.int64)
+
+        # use the longest indexed n-grams to reduce the number of intersections
+        n = min(self.ngrams, len(tokens))
+        terms = ngrams(tokens, n) if n > 1 else tokens
+        # (release row, phrase start position) pairs matching all terms
+        matches = None
+        for i, term in enumerate(terms):
+            code = self.code(term)
+            if code is None:
+                return np.zeros(0, dtype=np.int64)
+            rows, positions = self.postings(code, code + 1, field)
+            keys = (rows << 32) + positions - i
+            matches = keys if matches is None else np.intersect1d(matches, keys)
+            if not len(matches):
+                break
+        return np.unique(matches >> 32)
+
+    def search(self, query, mode='phrase', field=None):
+        """
+        Return release rows matching a query
+        - mode: "term", "phrase" or "prefix"
+        - field: only search "release" or "track" titles
+        """
+        if mode == 'term':
+            return self.term(query, field)
+        elif mode == 'prefix':
+            return self.prefix(query, field)
+        return self.phrase(query, field)
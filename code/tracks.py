@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Track-level table linked to releases by row offsets.
+
+The release DataFrame only keeps durations of releases with all tracks
+annotated (tracks_duration_list). The track table keeps every track of every
+loaded release in columnar form:
+- offsets: tracks of release row r are tracks offsets[r]:offsets[r+1]
+- duration: duration in seconds (NaN if unknown)
+- artist_offsets, artist_codes: track artists (CSR), codes into 'artists' ids
+- title: track title code into 'titles' (-1 if titles were not kept)
+
+The track position within a release and the release row of each track are
+derived from offsets. Selections are boolean masks over tracks, and
+aggregations are bincounts and sorted segments over these masks.
+
+The table is collected with TrackTableBuilder while loading the json dump
+(see load_releases) and stored as .npy files that are mapped on loading.
+'''
+
+import os
+import json
+from array import array
+import numpy as np
+import pandas
+
+from columnar import to_numpy
+
+
+def csr_take(offsets, rows):
+    """
+    Select rows of a CSR layout. Returns new offsets and indices of the
+    selected elements.
+    """
+    offsets = np.asarray(offsets)
+    rows = np.asarray(rows, dtype=np.int64)
+    counts = offsets[rows + 1] - offsets[rows]
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(counts)
+    indices = np.repeat(offsets[rows] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return new_offsets, indices
+
+
+def group_quantiles(groups, values, ngroups, q):
+    """
+    Compute the 'q' quantile (linear interpolation) of 'values' for each
+    group in a single sort. Returns NaN for empty groups.
+    """
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=ngroups)
+    starts = np.cumsum(counts) - counts
+
+    result = np.full(ngroups, np.nan)
+    nonempty = counts > 0
+    position = starts[nonempty] + q * (counts[nonempty] - 1)
+    low = np.floor(position).astype(np.int64)
+    high = np.ceil(position).astype(np.int64)
+    result[nonempty] = values[low] + (values[high] - values[low]) * (position - low)
+    return result
+
+
+def release_positions(data, releases):
+    """
+    Return row positions in 'data' (the DataFrame the track table is aligned
+    with) of releases in 'releases' (e.g., the output of select)
+    """
+    return data.index.get_indexer(releases.index)
+
+
+class TrackTableBuilder(object):
+    """
+    Collect tracks of releases while loading the json dump
+    - titles: keep dictionary-encoded track titles
+    - inherit_artists: credit release artists on tracks without track artists
+    """
+
+    def __init__(self, titles=True, inherit_artists=True):
+        self.titles = titles
+        self.inherit_artists = inherit_artists
+        self.counts = array('i')
+        self.durations = array('f')
+        self.artist_counts = array('i')
+        self.artist_codes = array('i')
+        self.title_codes = array('i')
+        self.artist_vocab = {}
+        self.title_vocab = {}
+        self.rows = None
+
+    def add(self, tracklist, release_artists=None):
+        """Add tracks of the next release (release_artists: list of artist ids)"""
+        tracklist = tracklist or []
+        self.counts.append(len(tracklist))
+        for t in tracklist:
+            duration = t.get('duration')
+            self.durations.append(float(duration) if duration is not None else np.nan)
+
+            artists = [a['id'] for a in t.get('artists') or []]
+            if not artists and self.inherit_artists and release_artists:
+                artists = release_artists
+            self.artist_counts.append(len(artists))
+            for a in artists:
+                self.artist_codes.append(self.artist_vocab.setdefault(a, len(self.artist_vocab)))
+
+            if self.titles:
+                title = t.get('title') or ''
+                self.title_codes.append(self.title_vocab.setdefault(title, len(self.title_vocab)))
+
+    def keep_releases(self, rows):
+        """Only keep tracks of release rows 'rows' (e.g., after filtering releases)"""
+        self.rows = rows
+
+    def table(self):
+        """Return the collected TrackTable"""
+        offsets = np.zeros(len(self.counts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(to_numpy(self.counts, np.int32))
+        artist_offsets = np.zeros(len(self.artist_counts) + 1, dtype=np.int64)
+        artist_offsets[1:] = np.cumsum(to_numpy(self.artist_counts, np.int32))
+        if self.titles:
+            title = to_numpy(self.title_codes, np.int32)
+        else:
+            title = np.full(len(self.durations), -1, dtype=np.int32)
+
+        table = TrackTable(offsets, to_numpy(self.durations, np.float32),
+                           artist_offsets, to_numpy(self.artist_codes, np.int32), title,
+                           vocab_list(self.artist_vocab), vocab_list(self.title_vocab))
+        if self.rows is not None:
+            table = table.take(self.rows)
+        return table
+
+
+def vocab_list(vocab):
+    values = [None] * len(vocab)
+    for v, code in vocab.items():
+        values[code] = v
+    return values
+
+
+class TrackTable(object):
+    """
+    Tracks of releases (see the module description)
+    - artists: list of track artist ids
+    - titles: list of track titles
+    """
+
+    ARRAYS = ['offsets', 'duration', 'artist_offsets', 'artist_codes', 'title']
+
+    def __init__(self, offsets, duration, artist_offsets, artist_codes, title, artists, titles):
+        self.offsets = offsets
+        self.duration = duration
+        self.artist_offsets = artist_offsets
+        self.artist_codes = artist_codes
+        self.title = title
+        self.artists = artists
+        self.titles = titles
+        self.codes = dict((a, i) for i, a in enumerate(artists))
+        self._release = None
+
+    def save(self, path):
+        """Save the table to a directory"""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'tracks.json'), 'w') as f:
+            json.dump({'artists': self.artists, 'titles': self.titles}, f)
+
+    @classmethod
+    def load(cls, path):
+        """Load a table saved with save(), mapping arrays from disk"""
+        with open(os.path.join(path, 'tracks.json'), 'r') as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in cls.ARRAYS]
+        return cls(*(arrays + [meta['artists'], meta['titles']]))
+
+    def __len__(self):
+        return len(self.duration)
+
+    def releases_number(self):
+        return len(self.offsets) - 1
+
+    @property
+    def release(self):
+        """Release row of each track"""
+        if self._release is None:
+            counts = np.diff(self.offsets)
+            self._release = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        return self._release
+
+    @property
+    def position(self):
+        """Index of each track in its release tracklist"""
+        return np.arange(len(self), dtype=np.int64) - np.asarray(self.offsets)[self.release]
+
+    def take(self, rows):
+        """Return the table for release rows 'rows' only, in that order"""
+        offsets, tracks = csr_take(self.offsets, rows)
+        artist_offsets, artist_indices = csr_take(self.artist_offsets, tracks)
+        return TrackTable(offsets, np.asarray(self.duration)[tracks],
+                          artist_offsets, np.asarray(self.artist_codes)[artist_indices],
+                          np.asarray(self.title)[tracks], self.artists, self.titles)
+
+    def code(self, artistid):
+        # ids are strings in the dump, accept integers as well
+        code = self.codes.get(artistid)
+        if code is None:
+            code = self.codes.get(str(artistid))
+        return code
+
+    def artist_tracks(self):
+        # track number for every artist code
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.artist_offsets))
+
+    def select(self, releases=None, artist=None, annotated=False, min_duration=None, max_duration=None):
+        """
+        Return a boolean mask of tracks
+        - releases: a boolean mask or an array of release rows
+        - artist: only tracks credited to this artist id
+        - annotated: only tracks with a known duration
+        - min_duration, max_duration: duration range in seconds
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if releases is not None:
+            releases = np.asarray(releases)
+            if releases.dtype != bool:
+                rows = releases
+                releases = np.zeros(self.releases_number(), dtype=bool)
+                releases[rows] = True
+            mask &= releases[self.release]
+        if artist is not None:
+            by_artist = np.zeros(len(self), dtype=bool)
+            code = self.code(artist)
+            if code is not None:
+                by_artist[self.artist_tracks()[np.asarray(self.artist_codes) == code]] = True
+            mask &= by_artist
+        duration = np.asarray(self.duration)
+        if annotated:
+            mask &= ~np.isnan(duration)
+        if min_duration is not None:
+            mask &= duration >= min_duration
+        if max_duration is not None:
+            mask &= duration <= max_duration
+        return mask
+
+    def duration_stats(self, mask=None):
+        """
+        Compute statistics of track durations (in minutes) for selected tracks:
+        number of tracks, annotated tracks, mean, median and quartiles
+        """
+        duration = np.asarray(self.duration, dtype=np.float64)
+        if mask is not None:
+            duration = duration[mask]
+        annotated = duration[~np.isnan(duration)] / 60.
+        stats = {'tracks': len(duration), 'annotated': len(annotated)}
+        for name, q in [('q1', 25), ('median', 50), ('q3', 75)]:
+            stats[name] = np.percentile(annotated, q) if len(annotated) else np.nan
+        stats['mean'] = annotated.mean() if len(annotated) else np.nan
+        return pandas.Series(stats)
+
+    def per_release(self, mask=None):
+        """
+        Aggregate selected tracks per release row: number of tracks, annotated
+        tracks and total annotated duration in minutes
+        """
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+        duration = np.asarray(self.duration, dtype=np.float64)
+        annotated = mask & ~np.isnan(duration)
+        n = self.releases_number()
+        return pandas.DataFrame({
+            'tracks': np.bincount(self.release[mask], minlength=n),
+            'annotated': np.bincount(self.release[annotated], minlength=n),
+            'duration': np.bincount(self.release[annotated], weights=duration[annotated] / 60., minlength=n),
+        })
+
+    def per_year(self, released, start_year, end_year, mask=None):
+        """
+        Aggregate track durations (in minutes) per release year
+        - released: release year of each release row (e.g., data['released'])
+        Returns a DataFrame with number of tracks, annotated tracks, mean,
+        median and quartiles of durations per year
+        """
+        released = np.asarray(released, dtype=np.float64)[self.release]
+        duration = np.asarray(self.duration, dtype=np.float64) / 60.
+        years = end_year - start_year + 1
+        selected = (released >= start_year) & (released <= end_year)
+        if mask is not None:
+            selected &= mask
+        year = (released[selected] - start_year).astype(np.int64)
+        duration = duration[selected]
+        known = ~np.isnan(duration)
+
+        stats = {'years': range(start_year, end_year + 1)}
+        stats['tracks'] = np.bincount(year, minlength=years)
+        stats['annotated'] = np.bincount(year[known], minlength=years)
+        total = np.bincount(year[known], weights=duration[known], minlength=years)
+        stats['mean'] = np.where(stats['annotated'] > 0, total / np.maximum(stats['annotated'], 1), np.nan)
+        for name, q in [('q1', 0.25), ('median', 0.5), ('q3', 0.75)]:
+            stats[name] = group_quantiles(year[known], duration[known], years, q)
+        return pandas.DataFrame(stats)
+
+    def artist_stats(self, mask=None):
+        """
+        Compute per-artist track statistics for selected tracks in a single
+        pass: number of tracks, releases, annotated tracks and total
+        annotated duration in minutes. Returns a DataFrame indexed by artist id.
+        """
+        tracks = self.artist_tracks()
+        codes = np.asarray(self.artist_codes, dtype=np.int64)
+        if mask is not None:
+            selected = mask[tracks]
+            tracks, codes = tracks[selected], codes[selected]
+        duration = np.asarray(self.duration, dtype=np.float64)[tracks]
+        known = ~np.isnan(duration)
+        n = len(self.artists)
+
+        # unique (artist, release) pairs to count releases
+        releases = max(self.releases_number(), 1)
+        pairs = np.unique(codes * releases + self.release[tracks])
+
+        stats = pandas.DataFrame(index=self.artists)
+        stats['tracks'] = np.bincount(codes, minlength=n)
+        stats['releases'] = np.bincount(pairs // releases, minlength=n)
+        stats['annotated'] = np.bincount(codes[known], minlength=n)
+        stats['duration'] = np.bincount(codes[known], weights=duration[known] / 60., minlength=n)
+        return stats
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Detection of emerging and declining styles over the whole taxonomy.
+
+Release counts are computed per style and year in one pass, and every style
+of the genre tree (see config.GENRE_TREE) is analyzed at once on the matrix
+of yearly shares (percentage of releases of a year annotated with a style):
+- slope: least-squares trend of the share, in percentage points per year
+- changepoint: first year of the second segment of the best split of the
+  share curve into two segments of constant mean, and the shift of the mean
+- peak: year with the largest share, smoothed over a centered window, and
+  that smoothed share
+- growth: change of the mean share over the last 'window' years relative to
+  the previous 'window' years (also available for every year)
+
+Styles whose growth is above 'threshold' (e.g., +50%) are flagged as
+emerging, and styles whose share dropped by the same factor as declining.
+Results are rolled up to genres: genre shares are analyzed in the same way,
+together with the number of emerging and declining styles of every genre.
+
+Usage:
+    python trends.py [--dump DUMP] [--start-year 1970] [--end-year 2016]
+                     [--window 5] [--threshold 0.5] [--top 20]
+'''
+
+import argparse
+import numpy as np
+import pandas
+
+from config import *
+from bootstrap import yearly_counts
+from columnar import ColumnStore
+
+
+def share_matrix(counts, totals):
+    """
+    Percentage of releases per category and year (categories x years),
+    only keeping years with releases. Returns shares and the year mask.
+    """
+    present = totals > 0
+    shares = 100. * counts[:, present] / totals[present]
+    return shares, present
+
+
+def window_means(shares, low, high):
+    # mean of shares[:, low[i]:high[i]] for every year i
+    cumulative = np.zeros((shares.shape[0], shares.shape[1] + 1))
+    cumulative[:, 1:] = np.cumsum(shares, axis=1)
+    return (cumulative[:, high] - cumulative[:, low]) / np.maximum(high - low, 1)
+
+
+def linear_slopes(shares, years):
+    """Least-squares slopes of shares over years"""
+    x = years - years.mean()
+    denominator = (x * x).sum()
+    if not denominator:
+        return np.zeros(shares.shape[0])
+    return (shares - shares.mean(axis=1)[:, None]).dot(x) / denominator
+
+
+def changepoints(shares):
+    """
+    Best split of every share curve into two segments of constant mean.
+    Returns the index of the first year of the second segment and the
+    difference of means (second - first).
+    """
+    number = shares.shape[1]
+    if number < 2:
+        return np.zeros(shares.shape[0], dtype=np.int64), np.zeros(shares.shape[0])
+    cumulative = np.cumsum(shares, axis=1)
+    left = cumulative[:, :-1]
+    right = cumulative[:, -1:] - left
+    n_left = np.arange(1, number, dtype=np.float64)
+    n_right = number - n_left
+    # minimizing the squared error of a split maximizes this term
+    gain = left * left / n_left + right * right / n_right
+    best = np.argmax(gain, axis=1)
+    rows = np.arange(shares.shape[0])
+    shift = right[rows, best] / n_right[best] - left[rows, best] / n_left[best]
+    return best + 1, shift
+
+
+def smoothed(shares, window):
+    """Shares averaged over a centered window of years (shorter at the edges)"""
+    number = shares.shape[1]
+    half = window // 2
+    low = np.maximum(np.arange(number) - half, 0)
+    high = np.minimum(np.arange(number) + window - half, number)
+    return window_means(shares, low, high)
+
+
+def rolling_growth(shares, window):
+    """
+    Growth of the mean share over 'window' years ending at every year
+    relative to the previous 'window' years (NaN if not enough years, inf
+    for styles appearing from nothing)
+    """
+    number = shares.shape[1]
+    end = np.arange(1, number + 1)
+    recent = window_means(shares, np.maximum(end - window, 0), end)
+    previous = window_means(shares, np.maximum(end - 2 * window, 0), np.maximum(end - window, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = recent / previous - 1
+    growth[:, end < 2 * window] = np.nan
+    return growth
+
+
+def detect_trends(counts, totals, years, categories, window=5, threshold=0.5):
+    """
+    Analyze yearly shares of all categories (genres or styles) at once
+    - counts: releases per category and year (categories x years)
+    - totals: releases per year
+    - window: number of years for smoothing and growth
+    - threshold: relative growth to flag categories as emerging or declining
+    Returns a DataFrame indexed by category.
+    """
+    shares, present = share_matrix(np.asarray(counts, dtype=np.float64), np.asarray(totals))
+    years = np.asarray(years)[present]
+    if not len(years):
+        raise ValueError("No releases in the selected years")
+
+    split, shift = changepoints(shares)
+    smooth = smoothed(shares, window)
+    peaks = np.argmax(smooth, axis=1)
+    growth = rolling_growth(shares, window)[:, -1]
+
+    trends = pandas.DataFrame({
+        'releases': np.asarray(counts)[:, present].sum(axis=1),
+        'share': shares.mean(axis=1),
+        'last_share': shares[:, -1],
+        'slope': linear_slopes(shares, years.astype(np.float64)),
+        'changepoint': years[split],
+        'shift': shift,
+        'peak_year': years[peaks],
+        'peak_share': smooth[np.arange(len(shares)), peaks],
+        'growth': growth,
+    }, index=pandas.Index(categories, tupleize_cols=False),
+        columns=['releases', 'share', 'last_share', 'slope', 'changepoint', 'shift',
+                 'peak_year', 'peak_share', 'growth'])
+
+    trends['trend'] = 'stable'
+    trends.loc[growth >= threshold, 'trend'] = 'emerging'
+    trends.loc[growth <= 1. / (1 + threshold) - 1, 'trend'] = 'declining'
+    return trends
+
+
+def taxonomy_styles(data_styles=()):
+    """All (genre, style) pairs of the genre tree, then styles only found in data"""
+    tree = GENRE_TREE
+    styles = [(g, s) for g in sorted(tree) for s in (tree[g] or [])]
+    known = set(styles)
+    return styles + sorted(s for s in data_styles if s not in known)
+
+
+def style_trends(data, start_year=START_YEAR, end_year=END_YEAR, window=5, threshold=0.5,
+                 min_releases=100):
+    """
+    Detect emerging and declining styles over the whole genre tree
+    - data: releases (a DataFrame or a ColumnStore)
+    - window, threshold: see detect_trends
+    - min_releases: do not flag styles with fewer releases in the period
+    Returns DataFrames of style trends (indexed by (genre, style)) and genre
+    trends (indexed by genre), ranked by slope.
+    """
+    if isinstance(data, ColumnStore):
+        data_styles = data.vocab('styles')
+    else:
+        data_styles = set(s for ss in data['styles'] for s in ss)
+    styles = taxonomy_styles(data_styles)
+    styles, years, counts, totals = yearly_counts(data, 'style', styles, start_year, end_year)
+    styles_df = detect_trends(counts, totals, years, styles, window, threshold)
+    styles_df.insert(0, 'genre', [g for g, _ in styles])
+    styles_df.loc[styles_df['releases'] < min_releases, 'trend'] = 'stable'
+
+    genres = sorted(set(GENRE_TREE) | set(styles_df['genre']))
+    genres, years, counts, totals = yearly_counts(data, 'genre', genres, start_year, end_year)
+    genres_df = detect_trends(counts, totals, years, genres, window, threshold)
+    genres_df.loc[genres_df['releases'] < min_releases, 'trend'] = 'stable'
+
+    # roll style trends up to genres
+    flags = pandas.crosstab(styles_df['genre'], styles_df['trend'])
+    for trend in ['emerging', 'declining']:
+        column = flags[trend] if trend in flags else pandas.Series(dtype=np.int64)
+        genres_df[trend + '_styles'] = column.reindex(genres_df.index).fillna(0).astype(int).values
+    ranked = styles_df[styles_df['releases'] >= min_releases].sort_values('slope', ascending=False)
+    top = ranked.groupby('genre').head(1)
+    top_style = dict(zip(top['genre'], [s for _, s in top.index]))
+    genres_df['top_style'] = [top_style.get(g) for g in genres_df.index]
+
+    return styles_df.sort_values('slope', ascending=False), genres_df.sort_values('slope', ascending=False)
+
+
+def print_trends(styles, genres, top=20):
+    columns = ['releases', 'share', 'slope', 'changepoint', 'peak_year', 'growth']
+    emerging = styles[styles['trend'] == 'emerging']
+    declining = styles[styles['trend'] == 'declining'].sort_values('slope')
+    print("Emerging styles (%d):" % len(emerging))
+    print(emerging[columns][:top].to_string())
+    print("\nDeclining styles (%d):" % len(declining))
+    print(declining[columns][:top].to_string())
+    print("\nGenres:")
+    print(genres[columns + ['trend', 'emerging_styles', 'declining_styles', 'top_style']].to_string())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Flag emerging and declining styles in a release dump")
+    parser.add_argument('--dump', default=dump_pandas, help="release dump (HDF file or columnar dump directory)")
+    parser.add_argument('--start-year', type=int, default=START_YEAR)
+    parser.add_argument('--end-year', type=int, default=END_YEAR)
+    parser.add_argument('--window', type=int, default=5, help="years for smoothing and growth")
+    parser.add_argument('--threshold', type=float, default=0.5, help="relative growth to flag a style")
+    parser.add_argument('--min-releases', type=int, default=100, help="minimum releases to flag a style")
+    parser.add_argument('--top', type=int, default=20, help="number of styles to print")
+    args = parser.parse_args()
+
+    from analyze import load_release_dump
+    data = load_release_dump(args.dump, mapped=True)
+    styles, genres = style_trends(data, args.start_year, args.end_year, args.window,
+                                  args.threshold, args.min_releases)
+    print_trends(styles, genres, args.top)